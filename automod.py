@@ -0,0 +1,125 @@
+from typing import Optional
+import os, msgpack, redis
+
+from database import db, rdb
+from utils import log
+
+"""
+Meower Automod Module
+This module provides the durable Redis Streams queue used to submit post attachments to the files automod.
+"""
+
+FILES_STREAM = os.getenv("AUTOMOD_FILES_STREAM", "automod:files:jobs")
+CONSUMER_GROUP = os.getenv("AUTOMOD_CONSUMER_GROUP", "automod")
+STREAM_MAXLEN = int(os.getenv("AUTOMOD_STREAM_MAXLEN", 100000))
+CLAIM_IDLE_MS = 60000  # how long a job can go unacknowledged before another consumer takes it over
+
+# Submission types
+NEW_POST = 1
+REPORTED_POST = 2
+
+# Where each consumer left off taking over stale jobs
+_claim_cursors: dict[str, str] = {}
+
+_submitted = 0
+_dropped = 0
+
+
+def submit_files(
+    type: int,
+    username: str,
+    post_id: str,
+    post_content: str,
+    file_ids: Optional[list[str]] = None,
+    file_hashes: Optional[list[str]] = None
+):
+    """
+    Add a post's attachments to the files automod stream.
+    Either the already resolved file hashes or the file IDs must be given.
+    """
+
+    global _submitted, _dropped
+    try:
+        # Resolve file hashes
+        if file_hashes is None:
+            file_hashes = {file["_id"]: file["hash"] for file in db.files.find(
+                {"_id": {"$in": file_ids}},
+                projection={"hash": 1}
+            )}
+            file_hashes = [file_hashes[file_id] for file_id in file_ids if file_id in file_hashes]
+
+        # Add job to stream
+        rdb.xadd(FILES_STREAM, {"data": msgpack.packb({
+            "type": type,
+            "username": username,
+            "file_bucket": "attachments",
+            "file_hashes": file_hashes,
+            "post_id": post_id,
+            "post_content": post_content
+        })}, maxlen=STREAM_MAXLEN, approximate=True)
+        _submitted += 1
+    except Exception as e:
+        _dropped += 1
+        log(f"Failed to submit post {post_id} to the files automod: {e}")
+
+
+def ensure_consumer_group():
+    try:
+        rdb.xgroup_create(FILES_STREAM, CONSUMER_GROUP, id="0", mkstream=True)
+    except redis.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+def read_jobs(consumer: str, count: int = 10, block: int = 5000) -> list[tuple[str, dict]]:
+    """
+    Read jobs for a files automod consumer, taking over jobs other consumers didn't acknowledge in time.
+    Every job must be acknowledged with ack_jobs once it has been handled.
+    """
+
+    # Take over stale jobs, carrying on from where the last scan of the pending list stopped
+    next_id, messages, *_ = rdb.xautoclaim(
+        FILES_STREAM,
+        CONSUMER_GROUP,
+        consumer,
+        CLAIM_IDLE_MS,
+        start_id=_claim_cursors.get(consumer, "0-0"),
+        count=count
+    )
+    _claim_cursors[consumer] = next_id.decode() if isinstance(next_id, bytes) else next_id
+
+    # Read new jobs
+    if not messages:
+        for _, stream_messages in (rdb.xreadgroup(CONSUMER_GROUP, consumer, {FILES_STREAM: ">"}, count=count, block=block) or []):
+            messages += stream_messages
+
+    # Drop jobs that were trimmed from the stream before being handled
+    ack_jobs(*[job_id.decode() for job_id, fields in messages if not fields])
+
+    return [(job_id.decode(), msgpack.unpackb(fields[b"data"])) for job_id, fields in messages if fields]
+
+
+def ack_jobs(*job_ids: str):
+    if job_ids:
+        rdb.xack(FILES_STREAM, CONSUMER_GROUP, *job_ids)
+
+
+def get_metrics() -> dict:
+    groups = {}
+    try:
+        for group in rdb.xinfo_groups(FILES_STREAM):
+            name = group["name"].decode() if isinstance(group["name"], bytes) else group["name"]
+            groups[name] = {
+                "consumers": group["consumers"],
+                "pending": group["pending"],
+                "lag": group.get("lag")
+            }
+    except redis.ResponseError:  # stream doesn't exist yet
+        pass
+
+    return {
+        "stream_length": rdb.xlen(FILES_STREAM),
+        "groups": groups,
+        "submitted": _submitted,
+        "dropped": _dropped
+    }
@@ -0,0 +1,106 @@
+from typing import Optional
+import os
+
+from database import db, run_blocking
+from cache import Cache
+
+"""
+Meower Blocks Module
+This module provides a cached block graph per user, for block checks and hiding blocked users' posts.
+"""
+
+BLOCK_CACHE_SIZE = int(os.getenv("BLOCK_CACHE_SIZE", 10000))
+BLOCK_CACHE_TTL = int(os.getenv("BLOCK_CACHE_TTL", 300))
+
+BLOCKED_STATE = 2
+
+# Username -> block graph
+block_cache = Cache("blocks", max_size=BLOCK_CACHE_SIZE, ttl=BLOCK_CACHE_TTL)
+
+
+def _fetch_graph(username: str) -> dict:
+    generation = block_cache.generation()
+    relationships = [{
+        "username": r["_id"]["to"],
+        "state": r["state"],
+        "updated_at": r["updated_at"]
+    } for r in db.relationships.find({"_id.from": username})]
+    user_settings = db.user_settings.find_one({"_id": username}, projection={"hide_blocked_users": 1}) or {}
+    graph = {
+        "relationships": relationships,
+        "blocking": frozenset(r["username"] for r in relationships if r["state"] == BLOCKED_STATE),
+        "blocked_by": frozenset(r["_id"]["from"] for r in db.relationships.find(
+            {"_id.to": username, "state": BLOCKED_STATE},
+            projection={"_id": 1}
+        )),
+        "hide_blocked_users": user_settings.get("hide_blocked_users", False)
+    }
+    block_cache.set(username, graph, generation=generation)
+    return graph
+
+
+def get_graph(username: str) -> dict:
+    """
+    Get a user's relationships and who they're blocking or blocked by.
+
+    The returned graph is shared with the cache, so it must not be modified.
+
+    Example return:
+    ```
+    {
+        "relationships": [{"username": str, "state": int, "updated_at": int}],
+        "blocking": frozenset[str],
+        "blocked_by": frozenset[str],
+        "hide_blocked_users": bool
+    }
+    ```
+    """
+
+    graph = block_cache.get(username)
+    if graph is None:
+        graph = _fetch_graph(username)
+    return graph
+
+
+async def get_graph_async(username: str) -> dict:
+    graph = block_cache.get(username)
+    if graph is None:
+        graph = await run_blocking(_fetch_graph, username)
+    return graph
+
+
+def is_blocked(username: str, other_username: str) -> bool:
+    """
+    Whether either user is blocking the other.
+    """
+
+    graph = get_graph(username)
+    return other_username in graph["blocking"] or other_username in graph["blocked_by"]
+
+
+async def is_blocked_async(username: str, other_username: str) -> bool:
+    graph = await get_graph_async(username)
+    return other_username in graph["blocking"] or other_username in graph["blocked_by"]
+
+
+async def get_hidden_users(username: Optional[str]) -> list[str]:
+    """
+    Get the users whose posts should be left out of feeds for a user, which is only
+    the users they're blocking if they have hide_blocked_users enabled.
+    """
+
+    if not username:
+        return []
+    graph = await get_graph_async(username)
+    if not graph["hide_blocked_users"]:
+        return []
+    return list(graph["blocking"])
+
+
+def invalidate_graph(*usernames: str):
+    """
+    Drop block graphs from the cache on every node,
+    must be called for both users whenever a relationship changes.
+    """
+
+    block_cache.invalidate(*usernames)
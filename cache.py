@@ -0,0 +1,114 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Hashable, Optional
+import time, msgpack
+
+from database import rdb
+from utils import log
+
+"""
+Meower Cache Module
+This module provides bounded in-process caches that are kept consistent between nodes over Redis pub/sub.
+"""
+
+INVALIDATIONS_CHANNEL = "cache_invalidations"
+
+caches: dict[str, "Cache"] = {}  # {"name": cache}
+
+
+class Cache:
+    """
+    Bounded LRU cache with a TTL.
+
+    Local reads and writes never touch Redis. Invalidations are applied locally and
+    published so every other node drops the same entries.
+
+    Every deletion bumps the cache's generation. Fills from the database should get the generation
+    before reading and pass it to set, so a result read before an invalidation doesn't get cached after it.
+    """
+
+    def __init__(self, name: str, max_size: int = 10000, ttl: int = 60):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._generation = 0
+        self._lock = Lock()
+        caches[name] = self
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return default
+            if item[0] < time.monotonic():
+                del self._items[key]
+                return default
+            self._items.move_to_end(key)
+            return item[1]
+
+    def generation(self) -> int:
+        with self._lock:
+            return self._generation
+
+    def set(self, key: Hashable, value: Any, generation: Optional[int] = None):
+        with self._lock:
+            # Skip stale fills
+            if generation is not None and generation != self._generation:
+                return
+
+            self._items[key] = (time.monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, *keys: Hashable):
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                self._items.pop(key, None)
+
+    def delete_matching(self, **fields: Any):
+        with self._lock:
+            self._generation += 1
+            for key, (_, value) in list(self._items.items()):
+                if isinstance(value, dict) and all(value.get(k) == v for k, v in fields.items()):
+                    del self._items[key]
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._items.clear()
+
+    def invalidate(self, *keys: Hashable):
+        self.delete(*keys)
+        rdb.publish(INVALIDATIONS_CHANNEL, msgpack.packb({
+            "cache": self.name,
+            "keys": list(keys)
+        }))
+
+    def invalidate_matching(self, **fields: Any):
+        self.delete_matching(**fields)
+        rdb.publish(INVALIDATIONS_CHANNEL, msgpack.packb({
+            "cache": self.name,
+            "match": fields
+        }))
+
+
+def listen_for_invalidations():
+    pubsub = rdb.pubsub()
+    pubsub.subscribe(INVALIDATIONS_CHANNEL)
+    for msg in pubsub.listen():
+        try:
+            if msg["type"] != "message":
+                continue
+            msg = msgpack.loads(msg["data"])
+            cache = caches.get(msg["cache"])
+            if not cache:
+                continue
+            if "keys" in msg:
+                cache.delete(*msg["keys"])
+            if "match" in msg:
+                cache.delete_matching(**msg["match"])
+        except Exception as e:
+            log(f"Failed to apply cache invalidation: {e}")
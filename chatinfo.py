@@ -0,0 +1,171 @@
+from hashlib import sha256
+from typing import Iterable, Optional
+import os, msgpack
+
+from database import db, run_blocking
+from cache import Cache
+
+"""
+Meower Chatinfo Module
+This module provides cached chat metadata (type, owner, members and pinning) for access checks and event fan-out,
+and cached chat emote sets.
+"""
+
+CHAT_CACHE_SIZE = int(os.getenv("CHAT_CACHE_SIZE", 10000))
+CHAT_CACHE_TTL = int(os.getenv("CHAT_CACHE_TTL", 300))
+
+CHAT_PROJECTION = {"type": 1, "owner": 1, "members": 1, "allow_pinning": 1, "deleted": 1}
+EMOTE_PROJECTION = {"created_at": 0, "created_by": 0}
+
+# Chat ID -> chat metadata
+chat_cache = Cache("chats", max_size=CHAT_CACHE_SIZE, ttl=CHAT_CACHE_TTL)
+
+# Chat ID -> {"emojis": list, "stickers": list, "emotes_version": str}
+emote_cache = Cache("chat_emotes", max_size=CHAT_CACHE_SIZE, ttl=CHAT_CACHE_TTL)
+
+
+def _fetch_chat(chat_id: str) -> Optional[dict]:
+    generation = chat_cache.generation()
+    chat = db.chats.find_one({"_id": chat_id}, projection=CHAT_PROJECTION)
+    if chat:
+        chat_cache.set(chat_id, chat, generation=generation)
+    return chat
+
+
+def _filter_chat(chat: Optional[dict], username: Optional[str], include_deleted: bool) -> Optional[dict]:
+    if not chat:
+        return None
+    if chat.get("deleted") and not include_deleted:
+        return None
+    if username is not None and username not in chat["members"]:
+        return None
+    return chat
+
+
+def get_chat(chat_id: str, include_deleted: bool = False) -> Optional[dict]:
+    """
+    Get a chat's metadata, or None if it doesn't exist (or is deleted).
+
+    The returned chat is shared with the cache, so it must not be modified.
+
+    Example return:
+    ```
+    {
+        "_id": str,
+        "type": int,
+        "owner": Optional[str],
+        "members": list[str],
+        "allow_pinning": bool,
+        "deleted": bool
+    }
+    ```
+    """
+
+    chat = chat_cache.get(chat_id)
+    if chat is None:
+        chat = _fetch_chat(chat_id)
+    return _filter_chat(chat, None, include_deleted)
+
+
+def get_member_chat(chat_id: str, username: Optional[str]) -> Optional[dict]:
+    """
+    Get a chat's metadata, or None if it doesn't exist, is deleted or the user isn't a member of it.
+    """
+
+    if username is None:
+        return None
+    chat = chat_cache.get(chat_id)
+    if chat is None:
+        chat = _fetch_chat(chat_id)
+    return _filter_chat(chat, username, False)
+
+
+async def get_chat_async(chat_id: str, include_deleted: bool = False) -> Optional[dict]:
+    chat = chat_cache.get(chat_id)
+    if chat is None:
+        chat = await run_blocking(_fetch_chat, chat_id)
+    return _filter_chat(chat, None, include_deleted)
+
+
+async def get_member_chat_async(chat_id: str, username: Optional[str]) -> Optional[dict]:
+    if username is None:
+        return None
+    chat = chat_cache.get(chat_id)
+    if chat is None:
+        chat = await run_blocking(_fetch_chat, chat_id)
+    return _filter_chat(chat, username, False)
+
+
+def invalidate_chat(*chat_ids: str):
+    """
+    Drop chats from the cache on every node, must be called after any change to their metadata.
+    """
+
+    chat_cache.invalidate(*chat_ids)
+
+
+def _emotes_version(emojis: list[dict], stickers: list[dict]) -> str:
+    return sha256(msgpack.packb([
+        sorted(emojis, key=lambda emote: emote["_id"]),
+        sorted(stickers, key=lambda emote: emote["_id"])
+    ])).hexdigest()[:16]
+
+
+def get_chats_emotes(chat_ids: Iterable[str]) -> dict[str, dict]:
+    """
+    Get the emojis and stickers of many chats, with one query per collection for chats that aren't cached.
+
+    The emotes_version of a chat only changes when its emotes do, so clients can skip unchanged emote sets.
+    The returned emote sets are shared with the cache, so they must not be modified.
+
+    Example return:
+    ```
+    {
+        chat_id: {
+            "emojis": list[dict],
+            "stickers": list[dict],
+            "emotes_version": str
+        }
+    }
+    ```
+    """
+
+    # Get from cache
+    results = {}
+    missing = []
+    for chat_id in set(chat_ids):
+        emotes = emote_cache.get(chat_id)
+        if emotes is None:
+            missing.append(chat_id)
+        else:
+            results[chat_id] = emotes
+    if not missing:
+        return results
+
+    # Get from database
+    generation = emote_cache.generation()
+    grouped = {chat_id: {"emojis": [], "stickers": []} for chat_id in missing}
+    for key, collection in [("emojis", db.chat_emojis), ("stickers", db.chat_stickers)]:
+        for emote in collection.find({"chat_id": {"$in": missing}}, projection=EMOTE_PROJECTION):
+            grouped[emote.pop("chat_id")][key].append(emote)
+    for chat_id, emotes in grouped.items():
+        emotes["emotes_version"] = _emotes_version(emotes["emojis"], emotes["stickers"])
+        emote_cache.set(chat_id, emotes, generation=generation)
+        results[chat_id] = emotes
+
+    return results
+
+
+async def get_chat_emotes_async(chat_id: str) -> dict:
+    emotes = emote_cache.get(chat_id)
+    if emotes is None:
+        emotes = (await run_blocking(get_chats_emotes, [chat_id]))[chat_id]
+    return emotes
+
+
+def invalidate_emotes(chat_id: str):
+    """
+    Drop a chat's emotes from the cache on every node, must be called after any emote is created, updated or deleted.
+    """
+
+    emote_cache.invalidate(chat_id)
@@ -1,13 +1,30 @@
-import websockets, asyncio, json, time, requests, os, msgpack
-from typing import Optional, Iterable, TypedDict, Literal, Any
+import websockets, asyncio, json, time, os, msgpack, secrets
+from threading import Thread, Lock
+from radix import Radix
+from typing import Optional, Iterable, TypedDict, Any
 from inspect import getfullargspec
 from urllib.parse import urlparse, parse_qs
 
 from utils import log, full_stack
-from database import db, rdb
+from database import db, rdb, run_blocking
+import security
 
 VERSION = "0.1.7.10"
 
+# Event bus channels and presence keys
+GLOBAL_CHANNEL = "cl:global"
+NODE_CHANNEL = "cl:node:{}"
+NODES_KEY = "cl:nodes"  # {node_id: last_heartbeat}
+NODE_USERS_KEY = "cl:node:{}:users"  # {username, ...}
+USER_NODES_KEY = "cl:user:{}:nodes"  # {node_id, ...}
+
+NODE_HEARTBEAT_INTERVAL = 10
+NODE_TIMEOUT = 30
+
+# Online user list updates
+ULIST_COALESCE_WINDOW = float(os.getenv("ULIST_COALESCE_WINDOW", 0.5))  # seconds to batch joins/leaves for
+ULIST_LEGACY_INTERVAL = float(os.getenv("ULIST_LEGACY_INTERVAL", 5))  # min seconds between full ulist broadcasts
+
 class CloudlinkPacket(TypedDict):
     cmd: str
     val: any
@@ -64,14 +81,34 @@ class CloudlinkServer:
             "gen_account": CloudlinkCommands.gen_account
         }
         self.clients: set[CloudlinkClient] = set()
+        self.websockets_by_proto: dict[int, set[websockets.WebSocketServerProtocol]] = {0: set(), 1: set()}  # {proto_version: {websocket1, websocket2, ...}}
         self.usernames: dict[str, list[CloudlinkClient]] = {}  # {"username": [cl_client1, cl_client2, ...]}
+
+        # Event bus
+        self.node_id: str = secrets.token_hex(8)
+        self.online_usernames: set[str] = set()  # usernames online across all nodes
+        self.ulist: str = ""  # pre-joined online_usernames, only rebuilt when it changes
+        self.ulist_dirty: bool = False
+        self.ulist_delta_websockets: set[websockets.WebSocketServerProtocol] = set()  # v1 clients that get ulist_update events
+        self.presence_lock = Lock()  # held while writing this node's presence to Redis
+        self.presence_version: int = 0  # bumped on every presence change, so the heartbeat can tell its snapshot is stale
     
     async def client_handler(self, websocket: websockets.WebSocketServerProtocol):
         # Create CloudlinkClient
         cl_client = CloudlinkClient(self, websocket)
 
+        # Automatic login
+        if "token" in cl_client.req_params:
+            try:
+                await cl_client.login_with_token(cl_client.req_params.get("token")[0])
+            except:
+                print(full_stack())
+
         # Add to websockets and clients sets
         self.clients.add(cl_client)
+        self.websockets_by_proto.setdefault(cl_client.proto_version, set()).add(websocket)
+        if cl_client.ulist_deltas:
+            self.ulist_delta_websockets.add(websocket)
 
         # Send ulist
         cl_client.send("ulist", self.get_ulist())
@@ -144,39 +181,16 @@ class CloudlinkServer:
         except: pass
         finally:
             self.clients.remove(cl_client)
+            self.websockets_by_proto[cl_client.proto_version].discard(websocket)
+            self.ulist_delta_websockets.discard(websocket)
             cl_client.logout()
 
-    def send_event(
-        self,
-        cmd: str,
-        val: Any,
-        extra: Optional[dict] = None,
-        clients: Optional[Iterable] = None,
-        usernames: Optional[Iterable] = None
-    ):
-        if extra is None:
-            extra = {}
+    def encode_packet(self, cmd: str, val: Any, extra: dict, proto_version: int) -> str:
+        # v1 packet
+        if proto_version == 1:
+            return json.dumps({"cmd": cmd, "val": val, **extra})
 
-        # Get clients
-        if clients is None and usernames is None:
-            clients = self.clients
-        else:
-            clients = [] if clients is None else clients
-            if usernames is not None:
-                for username in usernames:
-                    clients += self.usernames.get(username, [])
-
-        # Parse post
-        if cmd == "post" or cmd == "update_post":
-            val = self.supporter.parse_posts_v0([val])[0]
-
-        # Send v1 packet
-        websockets.broadcast({
-            client.websocket for client in clients
-            if client.proto_version == 1
-        }, json.dumps({"cmd": cmd, "val": val, **extra}))
-
-        # Send v0 packet
+        # v0 packet
         if cmd in ["statuscode", "ulist", "pmsg", "pvar"]:  # root commands
             val = {"cmd": cmd, "val": val, **extra}
         else:
@@ -197,21 +211,264 @@ class CloudlinkServer:
             else:
                 val = {"mode": cmd, "payload": val}
             val = {"cmd": "direct", "val": val, **extra}
-        websockets.broadcast({
-            client.websocket for client in clients
-            if client.proto_version == 0
-        }, json.dumps(val))
+        return json.dumps(val)
 
-    def get_ulist(self):
-        ulist = ";".join(self.usernames.keys())
-        if ulist:
-            ulist += ";"
-        return ulist
+    def send_event(
+        self,
+        cmd: str,
+        val: Any,
+        extra: Optional[dict] = None,
+        clients: Optional[Iterable] = None,
+        usernames: Optional[Iterable] = None
+    ):
+        """
+        Send an event to clients. Posts must already be parsed.
+        Events for users (or everyone) go through the event bus so they reach clients on every node,
+        local clients get sent to directly.
+        """
+
+        if extra is None:
+            extra = {}
+
+        # Send to local clients
+        if clients is not None:
+            self.deliver_event(cmd, val, extra, clients=clients)
+            if usernames is None:
+                return
 
-    def send_ulist(self):
-        return self.send_event("ulist", self.get_ulist())
+        # Send to users (or everyone) on all nodes
+        self.publish_op("event", usernames=usernames, cmd=cmd, val=val, extra=extra)
+
+    def deliver_event(self, cmd: str, val: Any, extra: dict, clients: Optional[Iterable] = None):
+        """
+        Send an event to clients on this node (or all of them).
+        Each frame is encoded once per protocol version, no matter how many clients receive it.
+        """
+
+        # Get websockets for each protocol version
+        if clients is None:
+            websockets_by_proto = self.websockets_by_proto
+        else:
+            websockets_by_proto = {}
+            for client in clients:
+                websockets_by_proto.setdefault(client.proto_version, set()).add(client.websocket)
+
+        # Send packets
+        for proto_version in (1, 0):
+            if websockets_by_proto.get(proto_version):
+                websockets.broadcast(
+                    websockets_by_proto[proto_version],
+                    self.encode_packet(cmd, val, extra, proto_version)
+                )
+
+    def kick_users(self, usernames: Optional[Iterable[str]] = None):
+        """
+        Kick clients of the specified users (or all clients) on every node.
+        """
+
+        self.publish_op("kick", usernames=usernames)
+
+    def logout_users(self, usernames: Iterable[str]):
+        """
+        Log out clients of the specified users on every node without disconnecting them.
+        """
+
+        self.publish_op("logout", usernames=usernames)
+
+    def kick_netblock(self, *cidrs: str):
+        """
+        Kick clients connecting from any of the netblocks on every node.
+        """
+
+        self.publish_op("kick_netblock", cidrs=list(cidrs))
+
+    def publish_op(self, op: str, usernames: Optional[Iterable[str]] = None, **data):
+        # Send to all nodes
+        if usernames is None:
+            rdb.publish(GLOBAL_CHANNEL, msgpack.packb({"op": op, **data}))
+            return
+
+        # Only send to nodes the users are connected to
+        usernames = list(set(usernames))
+        if not usernames:
+            return
+        pipe = rdb.pipeline(transaction=False)
+        for username in usernames:
+            pipe.smembers(USER_NODES_KEY.format(username))
+        node_usernames: dict[str, list[str]] = {}
+        for username, node_ids in zip(usernames, pipe.execute()):
+            for node_id in node_ids:
+                node_usernames.setdefault(node_id.decode(), []).append(username)
+        pipe = rdb.pipeline(transaction=False)
+        for node_id, _usernames in node_usernames.items():
+            pipe.publish(NODE_CHANNEL.format(node_id), msgpack.packb({
+                "op": op,
+                "usernames": _usernames,
+                **data
+            }))
+        pipe.execute()
+
+    def handle_op(self, msg: dict):
+        # Get local clients
+        if msg.get("usernames") is None:
+            clients = list(self.clients)
+        else:
+            clients = [client for username in msg["usernames"] for client in self.usernames.get(username, [])]
+
+        # Run op
+        match msg["op"]:
+            case "event":
+                self.deliver_event(msg["cmd"], msg["val"], msg["extra"], clients=(
+                    None if msg.get("usernames") is None else clients
+                ))
+            case "kick":
+                for client in clients:
+                    client.kick()
+            case "logout":
+                for client in clients:
+                    client.logout()
+            case "kick_netblock":
+                netblock = Radix()
+                for cidr in msg.get("cidrs", [msg.get("cidr")]):
+                    netblock.add(cidr)
+                for client in clients:
+                    if netblock.search_best(client.ip):
+                        client.kick()
+
+    def listen_for_events(self):
+        pubsub = rdb.pubsub()
+        pubsub.subscribe(GLOBAL_CHANNEL, NODE_CHANNEL.format(self.node_id))
+        for msg in pubsub.listen():
+            try:
+                if msg["type"] != "message":
+                    continue
+                msg = msgpack.loads(msg["data"])
+
+                # Online users get refetched by the ulist loop
+                if msg["op"] == "ulist_changed":
+                    self.ulist_dirty = True
+                    continue
+
+                self.loop.call_soon_threadsafe(self.handle_op, msg)
+            except:
+                print(full_stack())
+
+    def add_presence(self, username: str):
+        pipe = rdb.pipeline()
+        pipe.sadd(NODE_USERS_KEY.format(self.node_id), username)
+        pipe.sadd(USER_NODES_KEY.format(username), self.node_id)
+        pipe.publish(GLOBAL_CHANNEL, msgpack.packb({"op": "ulist_changed"}))
+        with self.presence_lock:
+            self.presence_version += 1
+            pipe.execute()
+
+    def remove_presence(self, username: str):
+        pipe = rdb.pipeline()
+        pipe.srem(NODE_USERS_KEY.format(self.node_id), username)
+        pipe.srem(USER_NODES_KEY.format(username), self.node_id)
+        pipe.publish(GLOBAL_CHANNEL, msgpack.packb({"op": "ulist_changed"}))
+        with self.presence_lock:
+            self.presence_version += 1
+            pipe.execute()
+
+    async def get_presence(self) -> tuple[int, list[str]]:
+        # Runs on the event loop, so it can't race with clients connecting or disconnecting
+        return self.presence_version, list(self.usernames.keys())
+
+    def fetch_online_usernames(self) -> set[str]:
+        node_ids = [node_id.decode() for node_id in rdb.zrangebyscore(NODES_KEY, time.time()-NODE_TIMEOUT, "+inf")]
+        if not node_ids:
+            return set()
+        return {username.decode() for username in rdb.sunion([NODE_USERS_KEY.format(node_id) for node_id in node_ids])}
+
+    def set_online_usernames(self, usernames: set[str]):
+        self.online_usernames = usernames
+        self.ulist = ";".join(sorted(usernames))
+        if self.ulist:
+            self.ulist += ";"
+
+    async def ulist_loop(self):
+        last_legacy_broadcast = 0
+        legacy_broadcast_pending = False
+        while True:
+            await asyncio.sleep(ULIST_COALESCE_WINDOW)
+            try:
+                # Get joins and leaves since the last window
+                if self.ulist_dirty:
+                    self.ulist_dirty = False
+                    usernames = await run_blocking(self.fetch_online_usernames)
+                    joined = usernames - self.online_usernames
+                    left = self.online_usernames - usernames
+                    if joined or left:
+                        self.set_online_usernames(usernames)
+
+                        # Send delta to clients that support it
+                        websockets.broadcast(self.ulist_delta_websockets, self.encode_packet("ulist_update", {
+                            "joined": sorted(joined),
+                            "left": sorted(left)
+                        }, {}, 1))
+                        legacy_broadcast_pending = True
+
+                # Send full ulist to every other client (throttled)
+                if legacy_broadcast_pending and (time.time() - last_legacy_broadcast) >= ULIST_LEGACY_INTERVAL:
+                    legacy_broadcast_pending = False
+                    last_legacy_broadcast = time.time()
+                    websockets.broadcast(self.websockets_by_proto.get(0, set()), self.encode_packet("ulist", self.ulist, {}, 0))
+                    websockets.broadcast(
+                        self.websockets_by_proto.get(1, set()) - self.ulist_delta_websockets,
+                        self.encode_packet("ulist", self.ulist, {}, 1)
+                    )
+            except:
+                print(full_stack())
+
+    def heartbeat_loop(self):
+        while True:
+            try:
+                # Keep this node registered
+                rdb.zadd(NODES_KEY, {self.node_id: time.time()})
+
+                # Rebuild this node's users from a snapshot taken on the event loop,
+                # unless a user connected or disconnected since (it'll be rebuilt on the next heartbeat)
+                version, usernames = asyncio.run_coroutine_threadsafe(self.get_presence(), self.loop).result()
+                pipe = rdb.pipeline(transaction=True)
+                pipe.delete(NODE_USERS_KEY.format(self.node_id))
+                if usernames:
+                    pipe.sadd(NODE_USERS_KEY.format(self.node_id), *usernames)
+                    for username in usernames:
+                        pipe.sadd(USER_NODES_KEY.format(username), self.node_id)
+                with self.presence_lock:
+                    if self.presence_version == version:
+                        pipe.execute()
+
+                # Remove dead nodes
+                dead_node_ids = [node_id.decode() for node_id in rdb.zrangebyscore(NODES_KEY, "-inf", time.time()-NODE_TIMEOUT)]
+                for node_id in dead_node_ids:
+                    pipe = rdb.pipeline()
+                    for username in rdb.smembers(NODE_USERS_KEY.format(node_id)):
+                        pipe.srem(USER_NODES_KEY.format(username.decode()), node_id)
+                    pipe.delete(NODE_USERS_KEY.format(node_id))
+                    pipe.zrem(NODES_KEY, node_id)
+                    pipe.execute()
+                if dead_node_ids:
+                    log(f"Removed {len(dead_node_ids)} dead Cloudlink node(s)")
+                    rdb.publish(GLOBAL_CHANNEL, msgpack.packb({"op": "ulist_changed"}))
+            except Exception as e:
+                log(f"Cloudlink heartbeat failed: {e}")
+
+            time.sleep(NODE_HEARTBEAT_INTERVAL)
+
+    def get_ulist(self):
+        return self.ulist
 
     async def run(self, host: str = "0.0.0.0", port: int = 3000):
+        # Start event bus
+        self.loop = asyncio.get_running_loop()
+        rdb.zadd(NODES_KEY, {self.node_id: time.time()})
+        self.set_online_usernames(self.fetch_online_usernames())
+        Thread(target=self.listen_for_events, daemon=True).start()
+        Thread(target=self.heartbeat_loop, daemon=True).start()
+        self.ulist_task = asyncio.create_task(self.ulist_loop())
+
         self.stop = asyncio.Future()
         self.server = await websockets.serve(self.client_handler, host, port)
         await self.stop
@@ -235,13 +492,8 @@ class CloudlinkClient:
             self.proto_version: int = 0
         self.trusted: bool = False
 
-        # Automatic login
-        if "token" in self.req_params:
-            token = self.req_params.get("token")[0]
-            account = self.proxy_api_request("/me", "get", headers={"token": token})
-            if account:
-                del account["error"]
-                self.authenticate(account, token)
+        # Whether the client wants ulist_update events instead of full ulists (v1 only)
+        self.ulist_deltas: bool = (self.proto_version == 1 and self.req_params.get("ulist_deltas", ["0"])[0] == "1")
 
     @property
     def req_params(self):
@@ -256,7 +508,21 @@ class CloudlinkClient:
         else:
             return self.websocket.remote_address
 
-    def authenticate(self, account: dict[str, Any], token: str, listener: Optional[str] = None):
+    async def login_with_token(self, token: str):
+        # Make sure repair mode isn't enabled
+        if self.server.supporter.repair_mode:
+            return self.kick()
+
+        # Get account
+        try:
+            account = await run_blocking(security.authenticate_token, token, self.ip)
+        except security.AuthError as e:
+            return self.send_auth_error(e)
+
+        # Authenticate client
+        await self.authenticate(account, token)
+
+    async def authenticate(self, account: dict[str, Any], token: str, listener: Optional[str] = None):
         if self.username:
             self.logout()
 
@@ -275,16 +541,16 @@ class CloudlinkClient:
             self.server.usernames[self.username].append(self)
         else:
             self.server.usernames[self.username] = [self]
-            self.server.send_ulist()
+            self.server.add_presence(self.username)
 
         # Send auth payload
         self.send("auth", {
             "username": self.username,
             "token": token,
             "account": account,
-            "relationships": self.proxy_api_request("/me/relationships", "get", headers={"token": token})["autoget"],
+            "relationships": await run_blocking(security.get_relationships, account["_id"]),
             **({
-                "chats": self.proxy_api_request("/chats", "get", headers={"token": token})["autoget"]
+                "chats": await run_blocking(self.server.supporter.get_chats, account["_id"])
             } if self.proto_version != 0 else {})
         }, listener=listener)
 
@@ -298,60 +564,37 @@ class CloudlinkClient:
         self.server.usernames[self.username].remove(self)
         if len(self.server.usernames[self.username]) == 0:
             del self.server.usernames[self.username]
-            self.server.send_ulist()
+            self.server.remove_presence(self.username)
         self.username = None
 
-    def proxy_api_request(
-        self, endpoint: str,
-        method: Literal["get", "post", "patch", "delete"],
-        headers: dict[str, str] = {},
-        json: Optional[dict[str, Any]] = None,
-        listener: Optional[str] = None,
-    ):
-        # Set headers
-        headers.update({
-            "X-Internal-Token": os.environ["INTERNAL_API_TOKEN"],
-            "X-Internal-Ip": self.ip,
-        })
-
-        # Make request
-        resp = getattr(requests, method)(
-            f"{os.environ['INTERNAL_API_ENDPOINT']}{endpoint}",
-            headers=headers,
-            json=json,
-        ).json()
-        if not resp["error"]:
-            return resp
-        else:
-            match resp["type"]:
-                case "repairModeEnabled":
-                    self.kick()
-                case "ipBlocked"|"registrationBlocked":
-                    self.send_statuscode("Blocked", listener)
-                case "badRequest":
-                    self.send_statuscode("Syntax", listener)
-                case "usernameExists":
-                    self.send_statuscode("IDExists", listener)
-                case "Unauthorized":
-                    self.send_statuscode("PasswordInvalid", listener)
-                case "mfaRequired":
-                    self.send_statuscode("2FARequired", listener)
-                case "accountDeleted":
-                    self.send_statuscode("Deleted", listener)
-                case "accountBanned":
-                    self.send_statuscode("Banned", listener)
-                case "tooManyRequests":
-                    self.send_statuscode("RateLimit", listener)
-                case _:
-                    log(f"Unknown error type received from '{endpoint}' API endpoint: {resp['type']}")
-                    self.send_statuscode("InternalServerError", listener)
+    def send_auth_error(self, e: security.AuthError, listener: Optional[str] = None):
+        match e.type:
+            case "ipBlocked"|"registrationBlocked":
+                self.send_statuscode("Blocked", listener)
+            case "badRequest":
+                self.send_statuscode("Syntax", listener)
+            case "usernameExists":
+                self.send_statuscode("IDExists", listener)
+            case "Unauthorized":
+                self.send_statuscode("PasswordInvalid", listener)
+            case "mfaRequired":
+                self.send_statuscode("2FARequired", listener)
+            case "accountDeleted":
+                self.send_statuscode("Deleted", listener)
+            case "accountBanned":
+                self.send_statuscode("Banned", listener)
+            case "tooManyRequests":
+                self.send_statuscode("RateLimit", listener)
+            case _:
+                log(f"Unknown authentication error type: {e.type}")
+                self.send_statuscode("InternalServerError", listener)
 
     def send(self, cmd: str, val: Any, extra: Optional[dict] = None, listener: Optional[str] = None):
         if extra is None:
             extra = {}
         if listener:
             extra["listener"] = listener
-        return self.server.send_event(cmd, val, extra=extra, clients=[self])
+        websockets.broadcast([self.websocket], self.server.encode_packet(cmd, val, extra, self.proto_version))
 
     def send_statuscode(self, statuscode: str, listener: Optional[str] = None):
         return self.send("statuscode", self.server.statuscodes[statuscode], listener=listener)
@@ -380,22 +623,25 @@ class CloudlinkCommands:
         if not isinstance(val, dict):
             return client.send_statuscode("Datatype", listener)
 
-        # Send API request
+        # Make sure repair mode isn't enabled
+        if client.server.supporter.repair_mode:
+            return client.kick()
+
+        # Get account and token
         try:
-            resp = client.proxy_api_request("/auth/login", "post", json={
-                "username": val.get("username"),
-                "password": val.get("pswd"),
-            }, listener=listener)
-        except:
-            print(full_stack())
-            client.send_statuscode("InternalServerError", listener)
+            account, token = await security.login(
+                val.get("username"),
+                val.get("pswd"),
+                client.ip
+            )
+        except security.AuthError as e:
+            client.send_auth_error(e, listener)
         else:
-            if resp and not resp["error"]:
-                # Authenticate client
-                client.authenticate(resp["account"], resp["token"], listener=listener)
-                
-                # Tell the client it is authenticated
-                client.send_statuscode("OK", listener)
+            # Authenticate client
+            await client.authenticate(account, token, listener=listener)
+
+            # Tell the client it is authenticated
+            client.send_statuscode("OK", listener)
 
     @staticmethod
     async def gen_account(client: CloudlinkClient, val, listener: Optional[str] = None):
@@ -407,19 +653,27 @@ class CloudlinkCommands:
         if not isinstance(val, dict):
             return client.send_statuscode("Datatype", listener)
 
-        # Send API request
+        # Make sure repair mode isn't enabled
+        if client.server.supporter.repair_mode:
+            return client.kick()
+
+        # Make sure registration isn't disabled
+        if not client.server.supporter.registration:
+            return client.send_statuscode("Blocked", listener)
+
+        # Get account and token
         try:
-            resp = client.proxy_api_request("/auth/register", "post", json={
-                "username": val.get("username"),
-                "password": val.get("pswd"),
-            }, listener=listener)
-        except:
-            print(full_stack())
-            client.send_statuscode("InternalServerError", listener)
+            account, token = await security.register(
+                val.get("username"),
+                val.get("pswd"),
+                client.ip,
+                bypass_captcha=True
+            )
+        except security.AuthError as e:
+            client.send_auth_error(e, listener)
         else:
-            if resp and not resp["error"]:
-                # Authenticate client
-                client.authenticate(resp["account"], resp["token"], listener=listener)
-                
-                # Tell the client it is authenticated
-                client.send_statuscode("OK", listener)
+            # Authenticate client
+            await client.authenticate(account, token, listener=listener)
+
+            # Tell the client it is authenticated
+            client.send_statuscode("OK", listener)
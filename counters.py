@@ -0,0 +1,240 @@
+from threading import Lock
+from typing import Optional
+from pymongo import UpdateOne
+import time, os
+
+from database import db, rdb
+from utils import log
+
+"""
+Meower Counters Module
+This module provides Redis-backed post counts so paginated endpoints don't have to count posts on every request,
+and atomic post reaction counts.
+"""
+
+POST_COUNTER_TTL = int(os.getenv("POST_COUNTER_TTL", 86400))
+RECONCILE_INTERVAL = int(os.getenv("POST_COUNTER_RECONCILE_INTERVAL", 3600))
+REACTION_HOT_THRESHOLD = int(os.getenv("REACTION_HOT_THRESHOLD", 5))  # reactions per second on one post before coalescing
+REACTION_FLUSH_INTERVAL = float(os.getenv("REACTION_FLUSH_INTERVAL", 1))
+REACTION_RECONCILE_INTERVAL = int(os.getenv("REACTION_RECONCILE_INTERVAL", 60))
+
+# Only adjust counters that already exist, missing counters get recounted on the next read
+_incr_existing = rdb.register_script("""
+for i, key in ipairs(KEYS) do
+    if redis.call("EXISTS", key) == 1 then
+        redis.call("INCRBY", key, ARGV[1])
+    end
+end
+""")
+
+
+def post_counter_key(origin: str, author: Optional[str] = None) -> str:
+    return f"post_count:{origin}:{author}" if author else f"post_count:{origin}"
+
+
+def post_counter_query(origin: str, author: Optional[str] = None) -> dict:
+    query = {"post_origin": origin, "isDeleted": False}
+    if author:
+        query["u"] = author
+    return query
+
+
+def get_post_count(origin: str, author: Optional[str] = None) -> int:
+    key = post_counter_key(origin, author)
+
+    # Get counter
+    count = rdb.get(key)
+    if count is not None:
+        return int(count.decode())
+
+    # Recount and store it
+    count = db.posts.count_documents(post_counter_query(origin, author))
+    rdb.set(key, count, ex=POST_COUNTER_TTL, nx=True)
+    return count
+
+
+def get_visible_post_count(origin: str, hidden_authors: list[str]) -> int:
+    """
+    Get the post count of an origin without the posts of hidden authors,
+    by subtracting their per-author counters from the origin counter.
+    """
+
+    total = get_post_count(origin)
+    if not hidden_authors:
+        return total
+
+    # Get counters of hidden authors, recounting any that are missing
+    counts = rdb.mget([post_counter_key(origin, author) for author in hidden_authors])
+    hidden = 0
+    for author, count in zip(hidden_authors, counts):
+        hidden += (int(count.decode()) if count is not None else get_post_count(origin, author))
+
+    return max(total-hidden, 0)
+
+
+def incr_post_count(origin: str, author: str, amount: int = 1):
+    if origin == "livechat":
+        return
+    _incr_existing(keys=[post_counter_key(origin), post_counter_key(origin, author)], args=[amount])
+
+
+def reset_post_counts(origin: str, author: Optional[str] = None):
+    """
+    Drop counters for an origin (and optionally one of its authors) after a bulk change
+    so they get recounted on the next read.
+    """
+
+    rdb.delete(post_counter_key(origin, author))
+    if author:
+        rdb.delete(post_counter_key(origin))
+
+
+def reconcile_post_counts() -> int:
+    """
+    Recount every stored post counter.
+    Returns how many counters were reconciled.
+    """
+
+    reconciled = 0
+    for key in rdb.scan_iter(match="post_count:*", count=1000):
+        try:
+            _, origin, *author = key.decode().split(":", 2)
+            count = db.posts.count_documents(post_counter_query(origin, (author[0] if author else None)))
+            rdb.set(key, count, ex=POST_COUNTER_TTL)
+            reconciled += 1
+        except Exception as e:
+            log(f"Failed to reconcile post counter {key}: {e}")
+    return reconciled
+
+
+# Reaction count deltas for hot posts waiting to be flushed, and posts that need reconciling
+_reactions_lock = Lock()
+_reaction_deltas: dict[tuple[str, str], int] = {}  # {(post_id, emoji): delta}
+_reaction_rates: dict[str, tuple[int, int]] = {}  # {post_id: (second, reactions)}
+_dirty_reaction_posts: set[str] = set()
+
+
+def _reaction_count_update(emoji: str, amount: int) -> list[dict]:
+    """
+    Update pipeline that adds amount to an emoji's count (appending it if it's missing)
+    and drops reactions that hit 0, as a single atomic update.
+    """
+
+    emoji = {"$literal": emoji}
+    return [{"$set": {"reactions": {"$filter": {
+        "input": {"$cond": [
+            {"$in": [emoji, {"$ifNull": ["$reactions.emoji", []]}]},
+            {"$map": {"input": "$reactions", "in": {"$cond": [
+                {"$eq": ["$$this.emoji", emoji]},
+                {"emoji": "$$this.emoji", "count": {"$add": ["$$this.count", amount]}},
+                "$$this"
+            ]}}},
+            {"$concatArrays": [{"$ifNull": ["$reactions", []]}, [{"emoji": emoji, "count": amount}]]}
+        ]},
+        "cond": {"$gt": ["$$this.count", 0]}
+    }}}}]
+
+
+def incr_reaction_count(post_id: str, emoji: str, amount: int = 1):
+    """
+    Adjust a post's count for an emoji.
+
+    Posts getting more than REACTION_HOT_THRESHOLD reactions a second have their
+    deltas buffered and written in bulk by flush_reaction_counts on every REACTION_FLUSH_INTERVAL.
+    """
+
+    now = int(time.time())
+    with _reactions_lock:
+        _dirty_reaction_posts.add(post_id)
+
+        # Track how hot the post is
+        second, reactions = _reaction_rates.get(post_id, (now, 0))
+        if second != now:
+            second, reactions = now, 0
+        _reaction_rates[post_id] = (second, reactions+1)
+
+        # Coalesce hot posts
+        if reactions+1 > REACTION_HOT_THRESHOLD:
+            key = (post_id, emoji)
+            _reaction_deltas[key] = _reaction_deltas.get(key, 0) + amount
+            return
+
+    db.posts.update_one({"_id": post_id}, _reaction_count_update(emoji, amount))
+
+
+def flush_reaction_counts() -> int:
+    """
+    Write buffered reaction deltas for hot posts.
+    Returns how many counts were written.
+    """
+
+    # Swap out buffered deltas
+    global _reaction_deltas
+    now = int(time.time())
+    with _reactions_lock:
+        deltas, _reaction_deltas = _reaction_deltas, {}
+        for post_id, (second, _) in list(_reaction_rates.items()):
+            if second < now:
+                del _reaction_rates[post_id]
+
+    # Write deltas
+    ops = [
+        UpdateOne({"_id": post_id}, _reaction_count_update(emoji, amount))
+        for (post_id, emoji), amount in deltas.items() if amount
+    ]
+    if ops:
+        db.posts.bulk_write(ops, ordered=False)
+    return len(ops)
+
+
+def reconcile_reaction_counts(post_ids: list[str]):
+    """
+    Recount reactions for posts from post_reactions.
+
+    Posts with buffered deltas are skipped and left for the next run.
+    """
+
+    # Count reactions
+    counts: dict[str, dict[str, int]] = {}
+    for reaction in db.post_reactions.aggregate([
+        {"$match": {"_id.post_id": {"$in": post_ids}}},
+        {"$group": {"_id": {"post_id": "$_id.post_id", "emoji": "$_id.emoji"}, "count": {"$sum": 1}}}
+    ]):
+        counts.setdefault(reaction["_id"]["post_id"], {})[reaction["_id"]["emoji"]] = reaction["count"]
+
+    # Skip posts with pending deltas, they'd get counted twice
+    with _reactions_lock:
+        pending = {post_id for post_id, _ in _reaction_deltas.keys()}
+        _dirty_reaction_posts.update(pending.intersection(post_ids))
+    post_ids = [post_id for post_id in post_ids if post_id not in pending]
+
+    # Fix counts, keeping the existing order of reactions
+    ops = []
+    for post in db.posts.find({"_id": {"$in": post_ids}}, projection={"reactions": 1}):
+        post_counts = counts.get(post["_id"], {})
+        reactions = [
+            {"emoji": reaction["emoji"], "count": post_counts.pop(reaction["emoji"])}
+            for reaction in post.get("reactions", []) if reaction["emoji"] in post_counts
+        ]
+        reactions += [{"emoji": emoji, "count": count} for emoji, count in post_counts.items()]
+        if reactions != post.get("reactions"):
+            ops.append(UpdateOne({"_id": post["_id"]}, {"$set": {"reactions": reactions}}))
+    if ops:
+        db.posts.bulk_write(ops, ordered=False)
+
+
+def reconcile_dirty_reaction_counts() -> int:
+    """
+    Reconcile reaction counts of posts reacted to on this node since the last run.
+    Returns how many posts were checked.
+    """
+
+    global _dirty_reaction_posts
+    with _reactions_lock:
+        post_ids, _dirty_reaction_posts = list(_dirty_reaction_posts), set()
+    for i in range(0, len(post_ids), 1000):
+        try:
+            reconcile_reaction_counts(post_ids[i:i+1000])
+        except Exception as e:
+            log(f"Failed to reconcile reaction counts: {e}")
+    return len(post_ids)
@@ -1,12 +1,21 @@
 import pymongo
 import redis
 import os
-import secrets
-from radix import Radix
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from pymongo.collection import Collection
+from pymongo.command_cursor import CommandCursor
+from pymongo.cursor import Cursor
+from pymongo.database import Database
+from typing import Optional
 
 from utils import log
 
-CURRENT_DB_VERSION = 10
+CURRENT_DB_VERSION = 11
+RETENTION = 2419200  # 28 days before netinfo, netlogs, post revisions, ephemeral audit logs and deleted posts expire
 
 # Create Redis connection
 log("Connecting to Redis...")
@@ -31,317 +40,369 @@ else:
     log("Successfully connected to database!")
 
 
-# Create database collections
-existing_collections = db.list_collection_names()
-for collection_name in []:
-    if collection_name not in existing_collections:
-        log(f"Creating {collection_name} database collection...")
-        db.create_collection(collection_name)
-
-# Create usersv0 indexes
-try: db.usersv0.create_index([("lower_username", pymongo.ASCENDING)], name="lower_username", unique=True)
-except: pass
-try: db.usersv0.create_index([("tokens", pymongo.ASCENDING)], name="tokens", unique=True)
-except: pass
-try: db.usersv0.create_index([("created", pymongo.DESCENDING)], name="recent_users")
-except: pass
-try:
-    db.usersv0.create_index([
-        ("lower_username", pymongo.TEXT),
-        ("quote", pymongo.TEXT)
-    ], name="search", partialFilterExpression={"pswd": {"$type": "string"}})
-except: pass
-"""
-try: db.usersv0.create_index([
-        ("delete_after", pymongo.ASCENDING)
-    ], name="scheduled_deletions", partialFilterExpression={"delete_after": {"$type": "number"}})
-except: pass
-"""
-
-# Create authenticators indexes
-try: db.authenticators.create_index([("user", pymongo.ASCENDING)], name="user")
-except: pass
-
-# Create data exports indexes
-try: db.data_exports.create_index([("user", pymongo.ASCENDING)], name="user")
-except: pass
-
-# Create relationships indexes
-try: db.relationships.create_index([("_id.from", pymongo.ASCENDING)], name="from")
-except: pass
-
-"""
-try: db.netinfo.create_index([("last_refreshed", pymongo.ASCENDING)], name="last_refreshed")
-except: pass
-"""
-
-# Create netlog indexes
-try: db.netlog.create_index([("_id.ip", pymongo.ASCENDING)], name="ip")
-except: pass
-try: db.netlog.create_index([("_id.user", pymongo.ASCENDING)], name="user")
-except: pass
-"""
-try: db.netlog.create_index([("last_used", pymongo.ASCENDING)], name="last_used")
-except: pass
-"""
-
-# Create posts indexes
-try:
-    db.posts.create_index([
-        ("post_origin", pymongo.ASCENDING),
-        ("isDeleted", pymongo.ASCENDING),
-        ("t.e", pymongo.DESCENDING)
-    ], name="default")
-except: pass
-try:
-    db.posts.create_index([
-        ("u", pymongo.ASCENDING),
-        ("post_origin", pymongo.ASCENDING),
-        ("t.e", pymongo.DESCENDING)
-    ], name="user")
-except: pass
-try:
-    db.posts.create_index([
-        ("p", pymongo.TEXT)
-    ], name="search", partialFilterExpression={"post_origin": "home", "isDeleted": False})
-except: pass
-"""
-try:
-    db.posts.create_index([
-        ("deleted_at", pymongo.ASCENDING)
-    ], name="scheduled_purges", partialFilterExpression={"isDeleted": True, "mod_deleted": False})
-except: pass
-"""
-try:
-    db.posts.create_index([
-        ("post_origin", pymongo.ASCENDING),
-        ("pinned", pymongo.ASCENDING),
-        ("t.e", pymongo.DESCENDING)
-    ], name="pinned_posts", partialFilterExpression={"pinned": True})
-except: pass
-
-"""
-# Create post revisions indexes
-try:
-    db.post_revisions.create_index([
-        ("post_id", pymongo.ASCENDING),
-        ("time", pymongo.DESCENDING)
-    ], name="post_revisions")
-except: pass
-try:
-    db.post_revisions.create_index([
-        ("time", pymongo.ASCENDING)
-    ], name="scheduled_purges")
-except: pass
-"""
+def ensure_indexes():
+    """
+    Create collections, indexes and default database items.
+    Run by `python main.py ensure-indexes` and `python main.py migrate`, not on startup.
+    """
 
-# Create chats indexes
-try:
-    db.chats.create_index([
-        ("members", pymongo.ASCENDING),
-        ("type", pymongo.ASCENDING),
-    ], name="user_chats")
-except: pass
+    # Create database collections
+    existing_collections = db.list_collection_names()
+    for collection_name in []:
+        if collection_name not in existing_collections:
+            log(f"Creating {collection_name} database collection...")
+            db.create_collection(collection_name)
 
-# Create chat_emojis indexes
-try:
-    db.chat_emojis.create_index([
-        ("chat_id", pymongo.ASCENDING),
-    ], name="chat_id")
-except: pass
+    # Create usersv0 indexes
+    try: db.usersv0.create_index([("lower_username", pymongo.ASCENDING)], name="lower_username", unique=True)
+    except: pass
+    try: db.usersv0.create_index([("tokens", pymongo.ASCENDING)], name="tokens", unique=True)
+    except: pass
+    try: db.usersv0.create_index([("created", pymongo.DESCENDING)], name="recent_users")
+    except: pass
+    try:
+        db.usersv0.create_index([
+            ("lower_username", pymongo.TEXT),
+            ("quote", pymongo.TEXT)
+        ], name="search", partialFilterExpression={"pswd": {"$type": "string"}})
+    except: pass
+    try: db.usersv0.create_index([
+            ("delete_after", pymongo.ASCENDING)
+        ], name="scheduled_deletions", partialFilterExpression={"delete_after": {"$type": "number"}})
+    except: pass
 
-# Create chat_stickers indexes
-try:
-    db.chat_stickers.create_index([
-        ("chat_id", pymongo.ASCENDING),
-    ], name="chat_id")
-except: pass
+    # Create authenticators indexes
+    try: db.authenticators.create_index([("user", pymongo.ASCENDING)], name="user")
+    except: pass
 
-# Create reports indexes
-try:
-    db.reports.create_index([
-        ("content_id", pymongo.ASCENDING)
-    ], name="pending_reports", partialFilterExpression={"status": "pending"})
-except: pass
-try:
-    db.reports.create_index([
-        ("escalated", pymongo.DESCENDING),
-        ("reports.time", pymongo.DESCENDING),
-        ("status", pymongo.ASCENDING),
-        ("type", pymongo.ASCENDING)
-    ], name="all_reports")
-except: pass
-
-"""
-# Create audit log indexes
-try:
-    db.audit_log.create_index([
-        ("time", pymongo.ASCENDING),
-        ("type", pymongo.ASCENDING)
-    ], name="scheduled_purges")
-except: pass
-"""
-
-# Create post reactions index
-try:
-    db.post_reactions.create_index([("_id.post_id", pymongo.ASCENDING), ("_id.emoji", pymongo.ASCENDING)])
-except: pass
+    # Create data exports indexes
+    try: db.data_exports.create_index([("user", pymongo.ASCENDING)], name="user")
+    except: pass
 
-# Create files indexes
-try:
-    db.files.create_index([("hash", pymongo.ASCENDING)], name="hash")
-except: pass
-try:
-    db.files.create_index([("uploaded_by", pymongo.ASCENDING)], name="uploaded_by")
-except: pass
-try:
-    db.files.create_index([
-        ("claimed", pymongo.ASCENDING),
-        ("uploaded_by", pymongo.ASCENDING)
-    ], name="unclaimed", partialFilterExpression={"claimed": False})
-except: pass
+    # Create relationships indexes
+    try: db.relationships.create_index([("_id.from", pymongo.ASCENDING)], name="from")
+    except: pass
+    try: db.relationships.create_index([("_id.to", pymongo.ASCENDING), ("state", pymongo.ASCENDING)], name="to")
+    except: pass
+
+    # Create netinfo indexes
+    try: db.netinfo.create_index([("expires_at", pymongo.ASCENDING)], name="expiry", expireAfterSeconds=0)
+    except: pass
+
+    # Create netlog indexes
+    try: db.netlog.create_index([("_id.ip", pymongo.ASCENDING)], name="ip")
+    except: pass
+    try: db.netlog.create_index([("_id.user", pymongo.ASCENDING)], name="user")
+    except: pass
+    try: db.netlog.create_index([("expires_at", pymongo.ASCENDING)], name="expiry", expireAfterSeconds=0)
+    except: pass
+
+    # Create posts indexes
+    try:
+        db.posts.create_index([
+            ("post_origin", pymongo.ASCENDING),
+            ("isDeleted", pymongo.ASCENDING),
+            ("t.e", pymongo.DESCENDING),
+            ("_id", pymongo.DESCENDING)
+        ], name="timeline")
+    except: pass
+    try:
+        db.posts.create_index([
+            ("u", pymongo.ASCENDING),
+            ("post_origin", pymongo.ASCENDING),
+            ("t.e", pymongo.DESCENDING),
+            ("_id", pymongo.DESCENDING)
+        ], name="user_timeline")
+    except: pass
+    try:
+        # Replaced by the timeline indexes, which can also order posts from the same second
+        for name in ("default", "user"):
+            if name in db.posts.index_information():
+                db.posts.drop_index(name)
+    except: pass
+    try:
+        db.posts.create_index([
+            ("p", pymongo.TEXT)
+        ], name="search", partialFilterExpression={"post_origin": "home", "isDeleted": False})
+    except: pass
+    try:
+        # Deleted posts get purged by a scheduler task (along with their reactions), not a TTL index
+        if "expireAfterSeconds" in db.posts.index_information().get("expiry", {}):
+            db.posts.drop_index("expiry")
+        db.posts.create_index([
+            ("expires_at", pymongo.ASCENDING)
+        ], name="expiry", partialFilterExpression={"isDeleted": True})
+    except: pass
+    try:
+        db.posts.create_index([
+            ("post_origin", pymongo.ASCENDING),
+            ("pinned", pymongo.ASCENDING),
+            ("t.e", pymongo.DESCENDING)
+        ], name="pinned_posts", partialFilterExpression={"pinned": True})
+    except: pass
+
+    # Create post revisions indexes
+    try:
+        db.post_revisions.create_index([
+            ("post_id", pymongo.ASCENDING),
+            ("time", pymongo.DESCENDING)
+        ], name="post_revisions")
+    except: pass
+    try:
+        db.post_revisions.create_index([
+            ("expires_at", pymongo.ASCENDING)
+        ], name="expiry", expireAfterSeconds=0)
+    except: pass
+
+    # Create chats indexes
+    try:
+        db.chats.create_index([
+            ("members", pymongo.ASCENDING),
+            ("type", pymongo.ASCENDING),
+        ], name="user_chats")
+    except: pass
+
+    # Create chat_emojis indexes
+    try:
+        db.chat_emojis.create_index([
+            ("chat_id", pymongo.ASCENDING),
+        ], name="chat_id")
+    except: pass
+
+    # Create chat_stickers indexes
+    try:
+        db.chat_stickers.create_index([
+            ("chat_id", pymongo.ASCENDING),
+        ], name="chat_id")
+    except: pass
+
+    # Create reports indexes
+    try:
+        db.reports.create_index([
+            ("content_id", pymongo.ASCENDING)
+        ], name="pending_reports", partialFilterExpression={"status": "pending"})
+    except: pass
+    try:
+        db.reports.create_index([
+            ("escalated", pymongo.DESCENDING),
+            ("reports.time", pymongo.DESCENDING),
+            ("status", pymongo.ASCENDING),
+            ("type", pymongo.ASCENDING)
+        ], name="all_reports")
+    except: pass
+
+    # Create audit log indexes
+    try:
+        db.audit_log.create_index([
+            ("expires_at", pymongo.ASCENDING)
+        ], name="expiry", expireAfterSeconds=0)
+    except: pass
+
+    # Create post reactions index
+    try:
+        db.post_reactions.create_index([("_id.post_id", pymongo.ASCENDING), ("_id.emoji", pymongo.ASCENDING)])
+    except: pass
+    try:
+        db.post_reactions.create_index([
+            ("_id.user", pymongo.ASCENDING),
+            ("_id.post_id", pymongo.ASCENDING)
+        ], name="user_reactions")
+    except: pass
+
+    # Create files indexes
+    try:
+        db.files.create_index([("hash", pymongo.ASCENDING)], name="hash")
+    except: pass
+    try:
+        db.files.create_index([("uploaded_by", pymongo.ASCENDING)], name="uploaded_by")
+    except: pass
+    try:
+        db.files.create_index([
+            ("claimed", pymongo.ASCENDING),
+            ("uploaded_by", pymongo.ASCENDING)
+        ], name="unclaimed", partialFilterExpression={"claimed": False})
+    except: pass
 
 
-# Create default database items
-for username in ["Server", "Deleted", "Meower", "Admin", "username"]:
+    # Create default database items
+    for username in ["Server", "Deleted", "Meower", "Admin", "username"]:
+        try:
+            db.usersv0.insert_one({
+                "_id": username,
+                "lower_username": username.lower(),
+                "uuid": None,
+                "created": None,
+                "pfp_data": None,
+                "avatar": None,
+                "avatar_color": None,
+                "quote": None,
+                "pswd": None,
+                "tokens": None,
+                "flags": 1,
+                "permissions": None,
+                "ban": None,
+                "last_seen": None,
+                "delete_after": None
+            })
+        except: pass
     try:
-        db.usersv0.insert_one({
-            "_id": username,
-            "lower_username": username.lower(),
-            "uuid": None,
-            "created": None,
-            "pfp_data": None,
-            "avatar": None,
-            "avatar_color": None,
-            "quote": None,
-            "pswd": None,
-            "tokens": None,
-            "flags": 1,
-            "permissions": None,
-            "ban": None,
-            "last_seen": None,
-            "delete_after": None
+        db.config.insert_one({
+            "_id": "migration",
+            "database": 1
         })
     except: pass
-try:
-    db.config.insert_one({
-        "_id": "migration",
-        "database": 1
-    })
-except: pass
-try:
-    db.config.insert_one({
-        "_id": "status",
-        "repair_mode": False,
-        "registration": True
-    })
-except: pass
-
-
-# Load netblocks
-blocked_ips = Radix()
-registration_blocked_ips = Radix()
-for netblock in db.netblock.find({}):
     try:
-        if netblock["type"] == 0:
-            blocked_ips.add(netblock["_id"])
-        if netblock["type"] == 1:
-            registration_blocked_ips.add(netblock["_id"])
-    except Exception as e:
-        log(f"Failed to load netblock {netblock['_id']}: {e}")
-log(f"Successfully loaded {len(blocked_ips.nodes())} netblock(s) into Radix!")
-log(f"Successfully loaded {len(registration_blocked_ips.nodes())} registration netblock(s) into Radix!")
-
-
-def get_total_pages(collection: str, query: dict, page_size: int = 25) -> int:
-    item_count = db[collection].count_documents(query)
+        db.config.insert_one({
+            "_id": "status",
+            "repair_mode": False,
+            "registration": True
+        })
+    except: pass
+
+
+def get_expiry(seconds: int = RETENTION) -> datetime:
+    """
+    Get an expiry date for documents removed by a TTL index or the purge_deleted_posts task (expires_at fields).
+    """
+
+    return datetime.now(timezone.utc) + timedelta(seconds=seconds)
+
+
+# Create executor for blocking database calls made from async code
+db_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("DB_EXECUTOR_WORKERS", 32)),
+    thread_name_prefix="db"
+)
+
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Run a blocking function on the database executor without stalling the event loop.
+    """
+
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(db_executor, functools.partial(ctx.run, func, *args, **kwargs))
+
+
+def _call_and_exhaust(func, args, kwargs):
+    result = func(*args, **kwargs)
+    if isinstance(result, (Cursor, CommandCursor)):
+        result = list(result)
+    return result
+
+
+class AsyncProxy:
+    """
+    Exposes the same surface as a pymongo database/collection or Redis client,
+    but every method call runs on the database executor and must be awaited.
+
+    Cursors (find, aggregate, etc.) are exhausted on the executor and returned as lists.
+    """
+
+    def __init__(self, obj):
+        self._obj = obj
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._obj, name)
+        if isinstance(attr, (Database, Collection)):
+            return AsyncProxy(attr)
+        elif not callable(attr):
+            return attr
+
+        async def wrapper(*args, **kwargs):
+            return await run_blocking(_call_and_exhaust, attr, args, kwargs)
+        return wrapper
+
+    def __getitem__(self, name: str):
+        return AsyncProxy(self._obj[name])
+
+
+adb = AsyncProxy(db)
+ardb = AsyncProxy(rdb)
+
+
+async def get_total_pages(collection: str, query: dict, page_size: int = 25, item_count: Optional[int] = None) -> int:
+    # Count items if a maintained count wasn't given
+    if item_count is None:
+        item_count = await adb[collection].count_documents(query)
     pages = (item_count // page_size)
     if (item_count % page_size) > 0:
         pages += 1
     return pages
 
-if db.config.find_one({"_id": "migration", "database": {"$ne": CURRENT_DB_VERSION}}):
-    log(f"[Migrator] Migrating DB to version {CURRENT_DB_VERSION}. ")
-    log(f"[Migrator] Please do not shut the server down until it is done.")
-
-    # Chat pinning
-    log("[Migrator] Adding pinned messages to database")
-    db.posts.update_many({"pinned": {"$exists": False}}, {"$set": {"pinned": False}})
-
-    log("[Migrator] Adding perm for pinning posts")
-    db.chats.update_many({"allow_pinning": {"$exists": False}}, {"$set": {"allow_pinning": False}})
-
-    # Experiments
-    log("[Migrator] Removing experiments from database")
-    db.usersv0.update_many({"experiments": {"$exists": True}}, {"$unset": {"experiments": ""}})
-
-    # Custom profile pictures
-    log("[Migrator] Adding custom profile pictures to database")
-    db.usersv0.update_many({"pswd": {"$ne": None}, "avatar": {"$exists": False}}, {"$set": {"avatar": ""}})
-    db.usersv0.update_many({"pswd": {"$ne": None}, "avatar_color": {"$exists": False}}, {"$set": {"avatar_color": "000000"}})
-
-    # Chat icons
-    log("[Migrator] Adding chat icons to database")
-    db.chats.update_many({"icon": {"$exists": False}}, {"$set": {"icon": ""}})
-    db.chats.update_many({"icon_color": {"$exists": False}}, {"$set": {"icon_color": "000000"}})
-
-    # Post attachments
-    log("[Migrator] Adding post attachments to database")
-    db.posts.update_many({"attachments": {"$exists": False}}, {"$set": {"attachments": []}})
-
-    # Profanity filter
-    log("[Migrator] Removing profanity filter")
-    db.config.delete_one({"_id": "filter"})
-    db.posts.update_many({"unfiltered_p": {"$exists": True}}, [{"$set": {"p": "$unfiltered_p"}}])
-    db.posts.update_many({"unfiltered_p": {"$exists": True}}, {"$unset": {"unfiltered_p": ""}})
-
-    # MFA recovery codes
-    log("[Migrator] Adding MFA recovery codes")
-    for user in db.usersv0.find({"pswd": {"$ne": None}, "mfa_recovery_code": {"$exists": False}}, projection={"_id": 1}):
-        db.usersv0.update_one({"_id": user["_id"]}, {"$set": {
-            "mfa_recovery_code": secrets.token_hex(5)
-        }})
-    
-    # Post reactions
-    log("[Migrator] Adding post reactions to database")
-    db.posts.update_many({"reactions": {"$exists": False}}, {"$set": {"reactions": []}})
-
-    # Remove type and post_id fields in posts database
-    log("[Migrator] Removing type and post_id fields from posts database")
-    db.posts.update_many({}, {"$unset": {"type": "", "post_id": ""}})
-
-    # Post replies
-    log("[Migrator] Adding post replies to database")
-    db.posts.update_many({"reply_to": {"$exists": False}}, {"$set": {"reply_to": []}})
-
-    # Fix MFA recovery codes
-    log("[Migrator] Fixing MFA recovery codes")
-    for user in db.usersv0.aggregate([
-        {"$match": {"mfa_recovery_code": {"$ne": None}}},
-        {"$project": {
-            "mfa_recovery_code": 1,
-            "length": {"$strLenCP": "$mfa_recovery_code"}
-        }},
-        {"$match": {
-            "length": {"$gt": 10}
-        }}
-    ]):
-        db.usersv0.update_one({"_id": user["_id"]}, {"$set": {
-            "mfa_recovery_code": user["mfa_recovery_code"][:10]
-        }})
-
-    # Post attachments
-    log("[Migrator] Converting post attachments")
-    updates = []
-    for post in db.posts.find({"attachments.id": {"$exists": True}}):
-        updates.append(pymongo.UpdateOne(
-            {"_id": post["_id"]},
-            {"$set": {"attachments": [attachment["id"] for attachment in post["attachments"]]}}
-        ))
-    if len(updates):
-        db.posts.bulk_write(updates)
-
-    db.config.update_one({"_id": "migration"}, {"$set": {"database": CURRENT_DB_VERSION}})
-    log(f"[Migrator] Finished Migrating DB to version {CURRENT_DB_VERSION}")
-
-print("") # finished startup logs
+
+async def get_posts_page(
+    query: dict,
+    page: int = 1,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    page_size: int = 25
+) -> Optional[list[dict]]:
+    """
+    Get a page of posts ordered newest first by (t.e, _id).
+
+    before/after are post IDs to seek from using the timeline indexes rather than skipping
+    over every previous page. Without a cursor, page is used as a legacy offset.
+    Returns None if the cursor post doesn't exist or doesn't match the query.
+    """
+
+    # Legacy offset pagination
+    if not (before or after):
+        return await adb.posts.find(
+            query,
+            sort=[("t.e", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)],
+            skip=(page-1)*page_size,
+            limit=page_size
+        )
+
+    # Going forwards in time walks the index in reverse
+    if after:
+        direction, op = pymongo.ASCENDING, "$gt"
+    else:
+        direction, op = pymongo.DESCENDING, "$lt"
+
+    # Get cursor post
+    cursor_post = await adb.posts.find_one({**query, "_id": (before or after)}, projection={"_id": 1, "t.e": 1})
+    if not cursor_post:
+        return None
+
+    # Get remaining posts from the same second as the cursor post
+    posts = await adb.posts.find({
+        **query,
+        "t.e": cursor_post["t"]["e"],
+        "_id": {op: cursor_post["_id"]}
+    }, sort=[("_id", direction)], limit=page_size)
+
+    # Seek the rest of the page
+    if len(posts) < page_size:
+        posts += await adb.posts.find(
+            {**query, "t.e": {op: cursor_post["t"]["e"]}},
+            sort=[("t.e", direction), ("_id", direction)],
+            limit=page_size-len(posts)
+        )
+
+    # Always return newest first
+    if after:
+        posts.reverse()
+
+    return posts
+
+
+def get_db_version() -> Optional[int]:
+    config = db.config.find_one({"_id": "migration"}, projection={"database": 1})
+    return config["database"] if config else None
+
+
+def check_db_version() -> bool:
+    """
+    Make sure the database has been migrated to the version this code expects.
+    This is the only schema check done on startup, migrations and indexes are applied by `python main.py migrate`.
+    """
+
+    version = get_db_version()
+    if version != CURRENT_DB_VERSION:
+        log(f"Database is at version {version} but version {CURRENT_DB_VERSION} is required! Please run `python main.py migrate`.")
+        return False
+    return True
+
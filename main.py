@@ -4,17 +4,49 @@ load_dotenv()
 
 import asyncio
 import os
+import sys
 import uvicorn
 
 from threading import Thread
 
+from database import ensure_indexes, check_db_version
+from netblocks import load_netblocks, listen_for_netblocks
+from passwords import start_pool as start_passwords_pool
+from migrations import migrate
 from cloudlink import CloudlinkServer
 from supporter import Supporter
-#from security import background_tasks_loop
+from automod import ensure_consumer_group as ensure_automod_consumer_group
+from tasks import scheduler
 from rest_api import app as rest_api
 
 
 if __name__ == "__main__":
+    # Run CLI commands
+    command = (sys.argv[1] if len(sys.argv) > 1 else "run")
+    if command == "ensure-indexes":
+        ensure_indexes()
+        sys.exit()
+    elif command == "migrate":
+        dry_run = ("--dry-run" in sys.argv[2:])
+        if not dry_run:
+            ensure_indexes()
+        migrate(dry_run=dry_run)
+        sys.exit()
+    elif command != "run":
+        print("Usage: python main.py [run|migrate [--dry-run]|ensure-indexes]")
+        sys.exit(1)
+
+    # Make sure the database is up to date
+    if not check_db_version():
+        sys.exit(1)
+
+    # Start password hashing workers
+    start_passwords_pool()
+
+    # Load netblocks and keep them in sync with other nodes
+    load_netblocks()
+    Thread(target=listen_for_netblocks, daemon=True).start()
+
     # Create Cloudlink server
     cl = CloudlinkServer()
 
@@ -22,8 +54,11 @@ if __name__ == "__main__":
     supporter = Supporter(cl)
     cl.supporter = supporter
 
-    # Start background tasks loop
-    #Thread(target=background_tasks_loop, daemon=True).start()
+    # Start background tasks scheduler
+    Thread(target=asyncio.run, args=(scheduler.run(),), daemon=True).start()
+
+    # Make sure files automod jobs are kept until a consumer handles them
+    ensure_automod_consumer_group()
 
     # Initialise REST API
     rest_api.cl = cl
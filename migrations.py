@@ -0,0 +1,252 @@
+from typing import Any, Callable, Iterator, Optional
+import pymongo, secrets, time, os
+
+from database import db, CURRENT_DB_VERSION, RETENTION
+from utils import log
+import security
+
+"""
+Meower Migrations Module
+This module provides numbered, resumable database migrations that work through collections in bounded batches.
+"""
+
+MIGRATION_BATCH_SIZE = int(os.getenv("MIGRATION_BATCH_SIZE", 1000))
+
+# [(step, db version, description, func)]
+MIGRATIONS: list[tuple[int, int, str, Callable[["MigrationContext"], None]]] = []
+
+
+def migration(step: int, version: int, description: str):
+    """
+    Register a migration step. Steps run in order and each one must be safe to re-run,
+    since a crash in the middle of a batch will repeat that batch.
+    """
+
+    def decorator(func):
+        MIGRATIONS.append((step, version, description, func))
+        return func
+    return decorator
+
+
+class MigrationContext:
+    """
+    Passed to migration steps to work through collections in batches.
+
+    Every batch saves a checkpoint (the task within the step and the last _id done) to the
+    migration config document, so a crashed migration picks up where it left off.
+    """
+
+    def __init__(self, step: int, checkpoint: Optional[dict] = None, dry_run: bool = False):
+        self.step = step
+        self.dry_run = dry_run
+        self.matched = 0
+        self._checkpoint = checkpoint or {}
+        self._task = 0
+
+    def _batches(self, collection: str, query: dict, projection: Optional[dict] = None) -> Iterator[list[dict]]:
+        self._task += 1
+
+        # Skip tasks that were finished before a crash
+        if self._checkpoint.get("task", 0) > self._task:
+            return
+        last_id = (self._checkpoint.get("last_id") if self._checkpoint.get("task") == self._task else None)
+
+        while True:
+            # Get next batch
+            docs = list(db[collection].find(
+                ({"$and": [query, {"_id": {"$gt": last_id}}]} if last_id is not None else query),
+                projection=projection,
+                sort=[("_id", pymongo.ASCENDING)],
+                limit=MIGRATION_BATCH_SIZE
+            ))
+            if not docs:
+                return
+
+            yield docs
+
+            # Save checkpoint
+            last_id = docs[-1]["_id"]
+            self.matched += len(docs)
+            if not self.dry_run:
+                db.config.update_one({"_id": "migration"}, {"$set": {"checkpoint": {
+                    "task": self._task,
+                    "last_id": last_id
+                }}})
+
+    def update_many(self, collection: str, query: dict, update: Any):
+        for docs in self._batches(collection, query, projection={"_id": 1}):
+            if not self.dry_run:
+                db[collection].update_many(
+                    {"$and": [query, {"_id": {"$in": [doc["_id"] for doc in docs]}}]},
+                    update
+                )
+
+    def update_each(
+        self,
+        collection: str,
+        query: dict,
+        func: Callable[[dict], Optional[pymongo.UpdateOne]],
+        projection: Optional[dict] = None
+    ):
+        for docs in self._batches(collection, query, projection=projection):
+            updates = [update for update in map(func, docs) if update]
+            if updates and not self.dry_run:
+                db[collection].bulk_write(updates, ordered=False)
+
+
+def migrate(dry_run: bool = False):
+    # Get completed steps
+    config = db.config.find_one({"_id": "migration"}) or {"database": 0}
+    completed_step = config.get("step")
+    if completed_step is None:  # databases migrated before steps were tracked
+        completed_step = max((step for step, version, _, _ in MIGRATIONS if version <= config["database"]), default=0)
+
+    # Make sure the database needs migrating
+    pending = [m for m in sorted(MIGRATIONS, key=lambda m: m[0]) if m[0] > completed_step]
+    if not pending:
+        if config["database"] != CURRENT_DB_VERSION and not dry_run:
+            db.config.update_one({"_id": "migration"}, {"$set": {"database": CURRENT_DB_VERSION}})
+        log(f"[Migrator] Database is already at version {CURRENT_DB_VERSION}")
+        return
+
+    if dry_run:
+        log(f"[Migrator] Dry run of migrating DB to version {CURRENT_DB_VERSION}, nothing will be written.")
+    else:
+        log(f"[Migrator] Migrating DB to version {CURRENT_DB_VERSION}.")
+        log(f"[Migrator] It's safe to stop and re-run the migrator, it will resume from the last checkpoint.")
+
+    # Run pending steps
+    for step, _, description, func in pending:
+        log(f"[Migrator] Step {step}: {description}")
+        ctx = MigrationContext(
+            step,
+            checkpoint=(config.get("checkpoint") if step == completed_step+1 else None),
+            dry_run=dry_run
+        )
+        started = time.monotonic()
+        func(ctx)
+        log(f"[Migrator] Step {step} {'would update' if dry_run else 'updated'} up to {ctx.matched} document(s) in {round(time.monotonic()-started, 2)}s")
+
+        # Mark step as done
+        if not dry_run:
+            db.config.update_one({"_id": "migration"}, {"$set": {"step": step, "checkpoint": None}})
+
+    if not dry_run:
+        db.config.update_one({"_id": "migration"}, {"$set": {"database": CURRENT_DB_VERSION}})
+        log(f"[Migrator] Finished Migrating DB to version {CURRENT_DB_VERSION}")
+
+
+@migration(1, 10, "Adding pinned messages to database")
+def add_pinned_posts(m: MigrationContext):
+    m.update_many("posts", {"pinned": {"$exists": False}}, {"$set": {"pinned": False}})
+    m.update_many("chats", {"allow_pinning": {"$exists": False}}, {"$set": {"allow_pinning": False}})
+
+
+@migration(2, 10, "Removing experiments from database")
+def remove_experiments(m: MigrationContext):
+    m.update_many("usersv0", {"experiments": {"$exists": True}}, {"$unset": {"experiments": ""}})
+
+
+@migration(3, 10, "Adding custom profile pictures to database")
+def add_custom_pfps(m: MigrationContext):
+    m.update_many("usersv0", {"pswd": {"$ne": None}, "avatar": {"$exists": False}}, {"$set": {"avatar": ""}})
+    m.update_many("usersv0", {"pswd": {"$ne": None}, "avatar_color": {"$exists": False}}, {"$set": {"avatar_color": "000000"}})
+
+
+@migration(4, 10, "Adding chat icons to database")
+def add_chat_icons(m: MigrationContext):
+    m.update_many("chats", {"icon": {"$exists": False}}, {"$set": {"icon": ""}})
+    m.update_many("chats", {"icon_color": {"$exists": False}}, {"$set": {"icon_color": "000000"}})
+
+
+@migration(5, 10, "Adding post attachments to database")
+def add_post_attachments(m: MigrationContext):
+    m.update_many("posts", {"attachments": {"$exists": False}}, {"$set": {"attachments": []}})
+
+
+@migration(6, 10, "Removing profanity filter")
+def remove_profanity_filter(m: MigrationContext):
+    if not m.dry_run:
+        db.config.delete_one({"_id": "filter"})
+    m.update_many("posts", {"unfiltered_p": {"$exists": True}}, [
+        {"$set": {"p": "$unfiltered_p"}},
+        {"$unset": "unfiltered_p"}
+    ])
+
+
+@migration(7, 10, "Adding MFA recovery codes")
+def add_mfa_recovery_codes(m: MigrationContext):
+    m.update_each(
+        "usersv0",
+        {"pswd": {"$ne": None}, "mfa_recovery_code": {"$exists": False}},
+        lambda user: pymongo.UpdateOne({"_id": user["_id"]}, {"$set": {
+            "mfa_recovery_code": secrets.token_hex(5)
+        }}),
+        projection={"_id": 1}
+    )
+
+
+@migration(8, 10, "Adding post reactions to database")
+def add_post_reactions(m: MigrationContext):
+    m.update_many("posts", {"reactions": {"$exists": False}}, {"$set": {"reactions": []}})
+
+
+@migration(9, 10, "Removing type and post_id fields from posts database")
+def remove_post_type_and_id(m: MigrationContext):
+    m.update_many(
+        "posts",
+        {"$or": [{"type": {"$exists": True}}, {"post_id": {"$exists": True}}]},
+        {"$unset": {"type": "", "post_id": ""}}
+    )
+
+
+@migration(10, 10, "Adding post replies to database")
+def add_post_replies(m: MigrationContext):
+    m.update_many("posts", {"reply_to": {"$exists": False}}, {"$set": {"reply_to": []}})
+
+
+@migration(11, 10, "Fixing MFA recovery codes")
+def fix_mfa_recovery_codes(m: MigrationContext):
+    m.update_each(
+        "usersv0",
+        {
+            "mfa_recovery_code": {"$type": "string"},
+            "$expr": {"$gt": [{"$strLenCP": "$mfa_recovery_code"}, 10]}
+        },
+        lambda user: pymongo.UpdateOne({"_id": user["_id"]}, {"$set": {
+            "mfa_recovery_code": user["mfa_recovery_code"][:10]
+        }}),
+        projection={"_id": 1, "mfa_recovery_code": 1}
+    )
+
+
+@migration(12, 10, "Converting post attachments")
+def convert_post_attachments(m: MigrationContext):
+    m.update_each(
+        "posts",
+        {"attachments.id": {"$exists": True}},
+        lambda post: pymongo.UpdateOne({"_id": post["_id"]}, {"$set": {
+            "attachments": [attachment["id"] for attachment in post["attachments"]]
+        }}),
+        projection={"_id": 1, "attachments": 1}
+    )
+
+
+def _expiry_from(field: str) -> list[dict]:
+    # Expire RETENTION seconds after a unix timestamp field, or from now if it's missing
+    return [{"$set": {"expires_at": {"$add": [
+        {"$ifNull": [{"$toDate": {"$multiply": [f"${field}", 1000]}}, "$$NOW"]},
+        RETENTION*1000
+    ]}}}]
+
+
+@migration(13, 11, "Adding expiry dates for TTL indexes")
+def add_expiry_dates(m: MigrationContext):
+    m.update_many("netinfo", {"expires_at": {"$exists": False}}, _expiry_from("last_refreshed"))
+    m.update_many("netlog", {"expires_at": {"$exists": False}}, _expiry_from("last_used"))
+    m.update_many("post_revisions", {"expires_at": {"$exists": False}}, _expiry_from("time"))
+    m.update_many("audit_log", {
+        "type": {"$in": list(security.EPHEMERAL_AUDIT_LOG_TYPES)},
+        "expires_at": {"$exists": False}
+    }, _expiry_from("time"))
+    m.update_many("posts", {"isDeleted": True, "expires_at": {"$exists": False}}, _expiry_from("deleted_at"))
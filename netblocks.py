@@ -0,0 +1,283 @@
+from ipaddress import ip_network
+from threading import Lock
+from typing import Callable, Iterable, Optional
+from radix import Radix
+import time, os, msgpack, pymongo
+
+from database import db, rdb
+from utils import log
+
+"""
+Meower Netblocks Module
+This module provides the IP netblock matcher, kept in sync on every node over Redis.
+"""
+
+NETBLOCKS_CHANNEL = "netblocks"
+VERSION_KEY = "netblocks:version"
+NETBLOCK_IMPORT_BATCH_SIZE = int(os.getenv("NETBLOCK_IMPORT_BATCH_SIZE", 5000))
+
+# Netblock types
+BLOCKED = 0
+REGISTRATION_BLOCKED = 1
+TYPES = (BLOCKED, REGISTRATION_BLOCKED)
+
+# Bumps the netblocks version and publishes a change with it, so nodes can tell when they missed one
+_publish = rdb.register_script("""
+local version = redis.call("INCR", KEYS[1])
+redis.call("PUBLISH", ARGV[1], version .. ":" .. ARGV[2])
+return version
+""")
+
+
+class Matcher:
+    """
+    A Radix tree per netblock type.
+
+    Single changes are applied to the trees in place, full reloads build new trees
+    and swap them in, so lookups never see a half loaded set of netblocks.
+    """
+
+    def __init__(self):
+        self.trees: dict[int, Radix] = {type: Radix() for type in TYPES}
+        self.version = 0
+        self.lookups = {type: 0 for type in TYPES}
+        self.hits = {type: 0 for type in TYPES}
+        self.last_load = {"time": None, "duration": None}
+        self._lock = Lock()
+
+    def match(self, type: int, ip_address: str) -> bool:
+        # The lookup/hit counters are only for metrics, so they're updated without the lock
+        # and may miss the odd increment when threads race, rather than serializing every lookup
+        self.lookups[type] += 1
+        try:
+            matched = (self.trees[type].search_best(ip_address) is not None)
+        except ValueError:  # invalid IP
+            return False
+        if matched:
+            self.hits[type] += 1
+        return matched
+
+    def covering(self, ip_address: str) -> list[str]:
+        try:
+            return [node.prefix for type in TYPES for node in self.trees[type].search_covering(ip_address)]
+        except ValueError:  # invalid IP
+            return []
+
+    def add(self, cidr: str, type: int):
+        with self._lock:
+            self._delete(cidr)
+            self.trees[type].add(cidr)
+
+    def delete(self, cidr: str):
+        with self._lock:
+            self._delete(cidr)
+
+    def _delete(self, cidr: str):
+        for tree in self.trees.values():
+            if tree.search_exact(cidr):
+                tree.delete(cidr)
+
+    def load(self):
+        started = time.monotonic()
+
+        # Anything changed after getting the version is either in the query results or gets published after it
+        version = int(rdb.get(VERSION_KEY) or 0)
+
+        # Build new trees
+        trees = {type: Radix() for type in TYPES}
+        failed = 0
+        for netblock in db.netblock.find({}, projection={"type": 1}, batch_size=10000):
+            try:
+                trees[netblock["type"]].add(netblock["_id"])
+            except Exception:
+                failed += 1
+
+        # Swap trees
+        with self._lock:
+            self.trees = trees
+            self.version = version
+
+        self.last_load = {"time": int(time.time()), "duration": round(time.monotonic()-started, 3)}
+        if failed:
+            log(f"Failed to load {failed} netblock(s)")
+        log(f"Loaded {len(trees[BLOCKED].prefixes())} netblock(s) and {len(trees[REGISTRATION_BLOCKED].prefixes())} registration netblock(s) in {self.last_load['duration']}s")
+
+
+matcher = Matcher()
+
+
+def normalize_cidr(cidr: str) -> str:
+    """
+    Get the canonical form of an IPv4/IPv6 address or CIDR, with host bits cleared.
+    Raises ValueError if it's invalid.
+    """
+
+    return ip_network(cidr.strip(), strict=False).compressed
+
+
+def is_blocked(ip_address: str) -> bool:
+    return matcher.match(BLOCKED, ip_address)
+
+
+def is_registration_blocked(ip_address: str) -> bool:
+    return matcher.match(REGISTRATION_BLOCKED, ip_address)
+
+
+def get_covering(ip_address: str) -> list[str]:
+    """
+    Get the CIDRs of every netblock (of any type) that an IP address is in.
+    """
+
+    return matcher.covering(ip_address)
+
+
+def load_netblocks():
+    matcher.load()
+
+
+def publish(op: str, **data) -> int:
+    return _publish(keys=[VERSION_KEY], args=[NETBLOCKS_CHANNEL, msgpack.packb({"op": op, **data})])
+
+
+def add_netblock(cidr: str, type: int) -> dict:
+    """
+    Add or replace a netblock on every node.
+    Returns the netblock.
+    """
+
+    # Construct netblock obj
+    netblock = {
+        "_id": normalize_cidr(cidr),
+        "type": type,
+        "created": int(time.time())
+    }
+
+    # Add netblock to database
+    db.netblock.update_one({"_id": netblock["_id"]}, {"$set": netblock}, upsert=True)
+
+    # Apply change
+    publish("add", cidr=netblock["_id"], type=type)
+    matcher.add(netblock["_id"], type)
+
+    return netblock
+
+
+def delete_netblock(cidr: str):
+    """
+    Remove a netblock on every node.
+    """
+
+    try:
+        cidr = normalize_cidr(cidr)
+    except ValueError:  # may have been added before CIDRs were validated
+        pass
+
+    # Remove from database
+    db.netblock.delete_one({"_id": cidr})
+
+    # Apply change
+    publish("delete", cidr=cidr)
+    matcher.delete(cidr)
+
+
+def import_netblocks(
+    cidrs: Iterable[str],
+    type: int,
+    on_imported: Optional[Callable[[list[str]], None]] = None
+) -> dict:
+    """
+    Add many netblocks at once, NETBLOCK_IMPORT_BATCH_SIZE at a time.
+    Every node reloads its netblocks once the import is done, instead of applying each netblock.
+    If given, on_imported gets called with each batch of imported (normalized) CIDRs after the reload is published.
+
+    Returns how many were imported, and the CIDRs that were invalid.
+    """
+
+    imported = []
+    invalid = []
+    created = int(time.time())
+
+    def write(batch: list[str]):
+        if batch:
+            db.netblock.bulk_write([pymongo.UpdateOne(
+                {"_id": cidr},
+                {"$set": {"type": type, "created": created}},
+                upsert=True
+            ) for cidr in batch], ordered=False)
+            imported.extend(batch)
+
+    # Add netblocks to database
+    batch = []
+    for cidr in cidrs:
+        try:
+            batch.append(normalize_cidr(cidr))
+        except ValueError:
+            invalid.append(cidr)
+            continue
+        if len(batch) >= NETBLOCK_IMPORT_BATCH_SIZE:
+            write(batch)
+            batch = []
+    write(batch)
+
+    # Reload netblocks on every node
+    if imported:
+        publish("reload")
+
+    # Hand off imported CIDRs
+    if on_imported:
+        for i in range(0, len(imported), NETBLOCK_IMPORT_BATCH_SIZE):
+            on_imported(imported[i:i+NETBLOCK_IMPORT_BATCH_SIZE])
+
+    return {"imported": len(imported), "invalid": invalid}
+
+
+def _apply(op: dict):
+    match op["op"]:
+        case "add":
+            matcher.add(op["cidr"], op["type"])
+        case "delete":
+            matcher.delete(op["cidr"])
+        case "reload":
+            matcher.load()
+
+
+def listen_for_netblocks():
+    while True:
+        try:
+            pubsub = rdb.pubsub()
+            pubsub.subscribe(NETBLOCKS_CHANNEL)
+            pubsub.get_message(timeout=5)  # wait for the subscription to be confirmed
+
+            # Reload if anything changed while not subscribed
+            if int(rdb.get(VERSION_KEY) or 0) != matcher.version:
+                matcher.load()
+
+            for msg in pubsub.listen():
+                if msg["type"] != "message":
+                    continue
+                version, op = msg["data"].split(b":", 1)
+                version = int(version)
+
+                # Already in the loaded netblocks
+                if version <= matcher.version:
+                    continue
+
+                # Reload if changes were missed, otherwise apply the change
+                if version > matcher.version+1:
+                    matcher.load()
+                else:
+                    _apply(msgpack.unpackb(op))
+                    matcher.version = max(matcher.version, version)
+        except Exception as e:
+            log(f"Netblocks listener failed, resubscribing: {e}")
+            time.sleep(1)
+
+
+def get_metrics() -> dict:
+    return {
+        "version": matcher.version,
+        "netblocks": {str(type): len(matcher.trees[type].prefixes()) for type in TYPES},
+        "lookups": {str(type): matcher.lookups[type] for type in TYPES},
+        "hits": {str(type): matcher.hits[type] for type in TYPES},
+        "last_load": matcher.last_load
+    }
@@ -0,0 +1,237 @@
+from abc import ABC, abstractmethod
+from hashlib import sha256
+from typing import Optional
+from radix import Radix
+import asyncio, time, os, csv, requests, pymongo
+
+from database import db, run_blocking, get_expiry
+from cache import Cache
+from utils import log
+
+"""
+Meower Netinfo Module
+This module provides IP address info (location, ISP and VPN detection) from pluggable providers.
+"""
+
+NETINFO_PROVIDERS = os.getenv("NETINFO_PROVIDERS", "local,ip-api").split(",")
+NETINFO_LOCAL_DB = os.getenv("NETINFO_LOCAL_DB")
+NETINFO_CACHE_SIZE = int(os.getenv("NETINFO_CACHE_SIZE", 10000))
+NETINFO_CACHE_TTL = int(os.getenv("NETINFO_CACHE_TTL", 3600))
+NETINFO_NEGATIVE_TTL = int(os.getenv("NETINFO_NEGATIVE_TTL", 300))
+
+NETINFO_FIELDS = ["country_code", "country_name", "region", "city", "timezone", "currency", "as", "isp"]
+
+# IP hash -> netinfo, and IP hashes that no provider could look up recently
+netinfo_cache = Cache("netinfo", max_size=NETINFO_CACHE_SIZE, ttl=NETINFO_CACHE_TTL)
+failed_lookups = Cache("netinfo_failures", max_size=NETINFO_CACHE_SIZE, ttl=NETINFO_NEGATIVE_TTL)
+
+
+def hash_ip(ip_address: str) -> str:
+    return sha256(ip_address.encode()).hexdigest()
+
+
+def unknown_netinfo(ip_address: str) -> dict:
+    return {
+        "_id": hash_ip(ip_address),
+        **{field: "Unknown" for field in NETINFO_FIELDS},
+        "vpn": False,
+        "last_refreshed": int(time.time())
+    }
+
+
+class NetinfoProvider(ABC):
+    """
+    Looks up netinfo for IP addresses.
+    lookup_many returns {ip_address: {country_code, country_name, ..., vpn}} for the addresses it found.
+    """
+
+    name: str
+
+    @abstractmethod
+    async def lookup_many(self, ip_addresses: list[str]) -> dict[str, dict]:
+        ...
+
+
+class LocalProvider(NetinfoProvider):
+    """
+    Offline provider backed by a CSV file with a network (CIDR) column and any of the netinfo fields.
+    The most specific matching network wins.
+    """
+
+    name = "local"
+
+    def __init__(self, path: str):
+        self.networks = Radix()
+        with open(path, newline="") as f:
+            for row in csv.DictReader(f):
+                try:
+                    node = self.networks.add(row["network"])
+                    node.data["netinfo"] = {
+                        **{field: (row.get(field) or "Unknown") for field in NETINFO_FIELDS},
+                        "vpn": (row.get("vpn", "").lower() in ["1", "true", "yes"])
+                    }
+                except Exception as e:
+                    log(f"Failed to load local netinfo network {row.get('network')}: {e}")
+        log(f"Loaded {len(self.networks.nodes())} local netinfo network(s)")
+
+    async def lookup_many(self, ip_addresses: list[str]) -> dict[str, dict]:
+        results = {}
+        for ip_address in ip_addresses:
+            try:
+                node = self.networks.search_best(ip_address)
+            except ValueError:  # invalid IP
+                continue
+            if node:
+                results[ip_address] = node.data["netinfo"].copy()
+        return results
+
+
+class IPAPIProvider(NetinfoProvider):
+    """
+    ip-api.com provider, uses the batch endpoint to look up 100 addresses per request
+    with requests running concurrently on the database executor.
+    """
+
+    name = "ip-api"
+    BATCH_SIZE = 100
+
+    def _lookup_batch(self, ip_addresses: list[str]) -> dict[str, dict]:
+        resp = requests.post(
+            "http://ip-api.com/batch?fields=25349915",
+            json=ip_addresses,
+            timeout=5
+        )
+        resp.raise_for_status()
+
+        results = {}
+        for ip_address, resp_json in zip(ip_addresses, resp.json()):
+            if resp_json.get("status") != "success":
+                continue
+            results[ip_address] = {
+                "country_code": resp_json["countryCode"],
+                "country_name": resp_json["country"],
+                "region": resp_json["regionName"],
+                "city": resp_json["city"],
+                "timezone": resp_json["timezone"],
+                "currency": resp_json["currency"],
+                "as": resp_json["as"],
+                "isp": resp_json["isp"],
+                "vpn": bool(resp_json.get("hosting") or resp_json.get("proxy"))
+            }
+        return results
+
+    async def lookup_many(self, ip_addresses: list[str]) -> dict[str, dict]:
+        results = {}
+        for batch_results in await asyncio.gather(*[
+            run_blocking(self._lookup_batch, ip_addresses[i:i+self.BATCH_SIZE])
+            for i in range(0, len(ip_addresses), self.BATCH_SIZE)
+        ], return_exceptions=True):
+            if isinstance(batch_results, Exception):
+                log(f"Failed to look up netinfo from ip-api: {batch_results}")
+            else:
+                results.update(batch_results)
+        return results
+
+
+# Init providers
+providers: list[NetinfoProvider] = []
+for provider_name in NETINFO_PROVIDERS:
+    match provider_name.strip():
+        case "local":
+            if NETINFO_LOCAL_DB:
+                try:
+                    providers.append(LocalProvider(NETINFO_LOCAL_DB))
+                except Exception as e:
+                    log(f"Failed to load local netinfo database: {e}")
+        case "ip-api":
+            providers.append(IPAPIProvider())
+        case "":
+            pass
+        case _:
+            log(f"Unknown netinfo provider: {provider_name}")
+
+
+async def get_netinfos(ip_addresses: list[str]) -> dict[str, dict]:
+    """
+    Get netinfo for many IP addresses at once.
+
+    Checks the in-memory cache, then the netinfo collection, then each provider in order.
+    Addresses no provider could look up get "Unknown" netinfo and aren't retried for NETINFO_NEGATIVE_TTL.
+    """
+
+    results = {}
+    hashes = {ip_address: hash_ip(ip_address) for ip_address in set(ip_addresses)}
+
+    # Get from cache
+    missing = []
+    for ip_address, ip_hash in hashes.items():
+        netinfo = netinfo_cache.get(ip_hash)
+        if netinfo:
+            results[ip_address] = netinfo
+        elif failed_lookups.get(ip_hash):
+            results[ip_address] = unknown_netinfo(ip_address)
+        else:
+            missing.append(ip_address)
+
+    # Get from database
+    if missing:
+        stored = {netinfo["_id"]: netinfo for netinfo in await run_blocking(lambda: list(db.netinfo.find(
+            {"_id": {"$in": [hashes[ip_address] for ip_address in missing]}},
+            projection={"expires_at": 0}
+        )))}
+        for ip_address in missing.copy():
+            netinfo = stored.get(hashes[ip_address])
+            if netinfo:
+                netinfo_cache.set(netinfo["_id"], netinfo)
+                results[ip_address] = netinfo
+                missing.remove(ip_address)
+
+    # Get from providers
+    updates = []
+    for provider in providers:
+        if not missing:
+            break
+        for ip_address, netinfo in (await provider.lookup_many(missing)).items():
+            netinfo.update({"_id": hashes[ip_address], "last_refreshed": int(time.time())})
+            netinfo_cache.set(netinfo["_id"], netinfo)
+            results[ip_address] = netinfo
+            missing.remove(ip_address)
+            updates.append(pymongo.UpdateOne(
+                {"_id": netinfo["_id"]},
+                {"$set": {**netinfo, "expires_at": get_expiry()}},
+                upsert=True
+            ))
+    if updates:
+        await run_blocking(db.netinfo.bulk_write, updates, ordered=False)
+
+    # Negative cache addresses that couldn't be looked up
+    for ip_address in missing:
+        failed_lookups.set(hashes[ip_address], True)
+        results[ip_address] = unknown_netinfo(ip_address)
+
+    return results
+
+
+async def get_netinfo(ip_address: str) -> dict:
+    """
+    Get netinfo for an IP address.
+
+    Example return:
+    ```
+    {
+        "_id": str,
+        "country_code": str,
+        "country_name": str,
+        "region": str,
+        "city": str,
+        "timezone": str,
+        "currency": str,
+        "as": str,
+        "isp": str,
+        "vpn": bool,
+        "last_refreshed": int
+    }
+    ```
+    """
+
+    return (await get_netinfos([ip_address]))[ip_address]
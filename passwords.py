@@ -0,0 +1,122 @@
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock
+from typing import Optional
+import multiprocessing, asyncio, os, bcrypt
+
+"""
+Meower Passwords Module
+This module provides password hashing and verification on a dedicated process pool,
+so bcrypt never ties up the event loop or the database executor.
+"""
+
+BCRYPT_SALT_ROUNDS = int(os.getenv("BCRYPT_SALT_ROUNDS", 14))
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS") or os.cpu_count() or 1)
+PASSWORD_QUEUE_LIMIT = int(os.getenv("PASSWORD_QUEUE_LIMIT", 64))  # max hashes/checks running or waiting per node
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = Lock()
+_pending = 0
+_pending_lock = Lock()
+
+
+class PoolOverloaded(Exception):
+    """
+    Raised when too many password hashes/checks are already waiting,
+    so requests get rejected straight away instead of queueing for seconds.
+    """
+
+
+def _hash(password: bytes, rounds: int) -> bytes:
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds=rounds))
+
+
+def _check(password: bytes, hashed_password: bytes) -> bool:
+    return bcrypt.checkpw(password, hashed_password)
+
+
+def start_pool():
+    """
+    Start the worker processes, called on startup so the first login doesn't wait on them.
+
+    The workers come from a fork server that only has this module loaded, so they never inherit
+    the MongoDB/Redis clients (or the locks and sockets of their threads) like forked workers would.
+    """
+
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            mp_context = multiprocessing.get_context("forkserver")
+            mp_context.set_forkserver_preload([__name__])
+            _pool = ProcessPoolExecutor(
+                max_workers=PASSWORD_WORKERS,
+                mp_context=mp_context
+            )
+            _pool.submit(int).result()  # starts the fork server and workers
+
+
+def _reset_pool(pool: ProcessPoolExecutor):
+    """
+    Drop a broken pool (i.e. a worker got killed), so the next hash/check starts a new one.
+    """
+
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _release(_: Future):
+    global _pending
+    with _pending_lock:
+        _pending -= 1
+
+
+def _submit(func, *args) -> Future:
+    global _pending
+
+    # Reject if the pool is overloaded
+    with _pending_lock:
+        if _pending >= PASSWORD_QUEUE_LIMIT:
+            raise PoolOverloaded()
+        _pending += 1
+
+    # Submit to pool (starting a new one if a worker died)
+    try:
+        for attempt in range(2):
+            start_pool()
+            pool = _pool
+            try:
+                future = pool.submit(func, *args)
+            except BrokenProcessPool:
+                _reset_pool(pool)
+                if attempt:
+                    raise
+            else:
+                break
+    except:
+        _release(None)
+        raise
+    future.add_done_callback(_release)
+
+    return future
+
+
+async def hash_password_async(password: str) -> str:
+    return (await asyncio.wrap_future(_submit(_hash, password.encode(), BCRYPT_SALT_ROUNDS))).decode()
+
+
+async def check_password_async(password: str, hashed_password: str) -> bool:
+    return await asyncio.wrap_future(_submit(_check, password.encode(), hashed_password.encode()))
+
+
+def needs_rehash(hashed_password: str) -> bool:
+    """
+    Whether a password hash was made with a different cost factor than BCRYPT_SALT_ROUNDS.
+    """
+
+    try:
+        return int(hashed_password.split("$")[2]) != BCRYPT_SALT_ROUNDS
+    except (IndexError, ValueError):
+        return False
@@ -0,0 +1,180 @@
+from contextvars import ContextVar
+from typing import Optional, TypedDict
+import time, secrets
+
+from database import rdb
+
+"""
+Meower Ratelimits Module
+This module provides atomic Redis ratelimits, every check-and-consume is a single round trip.
+"""
+
+FIXED_WINDOW = "fixed_window"
+SLIDING_WINDOW = "sliding_window"
+TOKEN_BUCKET = "token_bucket"
+
+# The most restrictive ratelimit hit while handling the current request, used for ratelimit headers.
+# Set through record, in the request's own context (not on the database executor, which runs in a copy of it)
+current: ContextVar[Optional["Ratelimit"]] = ContextVar("ratelimit", default=None)
+
+
+class Ratelimit(TypedDict):
+    bucket: str
+    limited: bool
+    limit: Optional[int]
+    remaining: int
+    reset: float  # seconds until the bucket can be hit again (when limited) or resets
+
+
+# Keeps the same "rtl:{bucket}" remaining count + TTL layout the API has always used
+_fixed_window = rdb.register_script("""
+local limit = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local remaining = tonumber(redis.call("GET", KEYS[1]))
+local ttl = redis.call("PTTL", KEYS[1])
+if remaining == nil then
+    remaining = limit
+end
+if ttl <= 0 then
+    ttl = window
+end
+if remaining < cost then
+    return {0, remaining, ttl}
+end
+remaining = remaining - cost
+redis.call("SET", KEYS[1], remaining, "PX", ttl)
+return {1, remaining, ttl}
+""")
+
+# Log of hit timestamps, so bursts at window boundaries can't exceed the limit
+_sliding_window = rdb.register_script("""
+local limit = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local now = tonumber(ARGV[4])
+redis.call("ZREMRANGEBYSCORE", KEYS[1], "-inf", now - window)
+local count = redis.call("ZCARD", KEYS[1])
+local reset = window
+local oldest = redis.call("ZRANGE", KEYS[1], 0, 0, "WITHSCORES")
+if oldest[2] then
+    reset = tonumber(oldest[2]) + window - now
+end
+if count + cost > limit then
+    return {0, limit - count, reset}
+end
+for i = 1, cost do
+    redis.call("ZADD", KEYS[1], now, ARGV[5] .. ":" .. i)
+end
+redis.call("PEXPIRE", KEYS[1], window)
+return {1, limit - count - cost, reset}
+""")
+
+# Refills limit tokens per window, allowing short bursts up to the limit
+_token_bucket = rdb.register_script("""
+local limit = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local now = tonumber(ARGV[4])
+local rate = limit / window
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "ts")
+local tokens = tonumber(bucket[1]) or limit
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(limit, tokens + math.max(0, now - ts) * rate)
+if tokens < cost then
+    return {0, math.floor(tokens), math.ceil((cost - tokens) / rate)}
+end
+tokens = tokens - cost
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "ts", now)
+redis.call("PEXPIRE", KEYS[1], math.ceil((limit - tokens) / rate) + 1)
+return {1, math.floor(tokens), math.ceil((limit - tokens) / rate)}
+""")
+
+
+def _key(bucket_id: str, policy: str) -> str:
+    if policy == FIXED_WINDOW:
+        return f"rtl:{bucket_id}"
+    elif policy == SLIDING_WINDOW:
+        return f"rtl:sw:{bucket_id}"
+    elif policy == TOKEN_BUCKET:
+        return f"rtl:tb:{bucket_id}"
+    else:
+        raise ValueError(f"Unknown ratelimit policy: {policy}")
+
+
+def record(result: Ratelimit):
+    """
+    Keep a hit/peek result for the current request's ratelimit headers, if it's the most restrictive one so far.
+    """
+
+    prev = current.get()
+    if prev is None or \
+        (result["limited"] and not prev["limited"]) or \
+        (result["limited"] == prev["limited"] and result["remaining"] < prev["remaining"]):
+        current.set(result)
+
+
+def hit(
+    bucket_id: str,
+    limit: int,
+    seconds: int,
+    policy: str = FIXED_WINDOW,
+    cost: int = 1
+) -> Ratelimit:
+    """
+    Atomically check a bucket and consume from it if it isn't limited.
+
+    Nothing is consumed from a bucket that's already limited.
+    The result must be passed to record for it to show up in the request's ratelimit headers.
+    """
+
+    # Run script
+    key = _key(bucket_id, policy)
+    if policy == FIXED_WINDOW:
+        allowed, remaining, reset = _fixed_window(keys=[key], args=[limit, seconds*1000, cost])
+    else:
+        now = int(time.time()*1000)
+        if policy == SLIDING_WINDOW:
+            allowed, remaining, reset = _sliding_window(
+                keys=[key],
+                args=[limit, seconds*1000, cost, now, f"{now}:{secrets.token_hex(4)}"]
+            )
+        else:
+            allowed, remaining, reset = _token_bucket(keys=[key], args=[limit, seconds*1000, cost, now])
+
+    return {
+        "bucket": bucket_id,
+        "limited": not allowed,
+        "limit": limit,
+        "remaining": max(int(remaining), 0),
+        "reset": max(int(reset), 0)/1000
+    }
+
+
+def peek(bucket_id: str) -> Optional[Ratelimit]:
+    """
+    Get the state of a fixed window bucket without consuming from it.
+
+    Returns None if the bucket hasn't been hit in its current window.
+    """
+
+    # Get remaining and TTL
+    pipe = rdb.pipeline(transaction=False)
+    pipe.get(_key(bucket_id, FIXED_WINDOW))
+    pipe.pttl(_key(bucket_id, FIXED_WINDOW))
+    remaining, ttl = pipe.execute()
+    if remaining is None:
+        return None
+
+    remaining = int(remaining.decode())
+    return {
+        "bucket": bucket_id,
+        "limited": remaining < 1,
+        "limit": None,
+        "remaining": max(remaining, 0),
+        "reset": max(ttl, 0)/1000
+    }
+
+
+def clear(bucket_id: str):
+    rdb.delete(*[_key(bucket_id, policy) for policy in (FIXED_WINDOW, SLIDING_WINDOW, TOKEN_BUCKET)])
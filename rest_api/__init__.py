@@ -2,15 +2,15 @@ from quart import Quart, request, abort
 from quart_cors import cors
 from quart_schema import QuartSchema, RequestSchemaValidationError, validate_headers, hide
 from pydantic import BaseModel
-import time, os, msgpack
+import time, os, msgpack, math
 
 from .v0 import v0
 
 
 from .admin import admin_bp
 
-from database import db, rdb, blocked_ips, registration_blocked_ips
-import security
+from database import adb, run_blocking
+import security, ratelimits, netblocks, passwords
 
 
 # Init app
@@ -51,7 +51,7 @@ async def check_ip():
         request.ip = request.internal_ip
     else:
         request.ip = (request.headers.get("Cf-Connecting-Ip", request.remote_addr))
-    if request.path != "/status" and blocked_ips.search_best(request.ip):
+    if request.path != "/status" and netblocks.is_blocked(request.ip):
         return {"error": True, "type": "ipBlocked"}, 403
 
 
@@ -61,19 +61,15 @@ async def check_auth(headers: TokenHeader):
     # Init request user and permissions
     request.user = None
     request.permissions = 0
+    request.ban = None
 
     # Authenticate request
     account = None
     if request.path != "/status":
         if headers.token:
-            account = db.usersv0.find_one({"tokens": headers.token}, projection={
-                "_id": 1,
-                "uuid": 1,
-                "flags": 1,
-                "permissions": 1,
-                "ban.state": 1,
-                "ban.expires": 1
-            })
+            account = security.token_cache.get(headers.token)
+            if not account:
+                account = await run_blocking(security.get_account_by_token, headers.token)
         
             if account:
                 if account["ban"]["state"] == "perm_ban" or (account["ban"]["state"] == "temp_ban" and account["ban"]["expires"] > time.time()):
@@ -81,6 +77,20 @@ async def check_auth(headers: TokenHeader):
                 request.user = account["_id"]
                 request.flags = account["flags"]
                 request.permissions = account["permissions"]
+                request.ban = account["ban"]
+
+
+@app.after_request
+async def add_ratelimit_headers(response):
+    rtl = ratelimits.current.get()
+    if rtl:
+        if rtl["limit"] is not None:
+            response.headers["X-RateLimit-Limit"] = str(rtl["limit"])
+        response.headers["X-RateLimit-Remaining"] = str(rtl["remaining"])
+        response.headers["X-RateLimit-Reset"] = str(math.ceil(rtl["reset"]))
+        if response.status_code == 429:
+            response.headers["Retry-After"] = str(math.ceil(rtl["reset"]))
+    return response
 
 
 @app.get("/")  # Welcome message
@@ -105,8 +115,8 @@ async def get_status():
         "scratchDeprecated": True,
         "registrationEnabled": app.supporter.registration,
         "isRepairMode": app.supporter.repair_mode,
-        "ipBlocked": (blocked_ips.search_best(request.ip) is not None),
-        "ipRegistrationBlocked": (registration_blocked_ips.search_best(request.ip) is not None)
+        "ipBlocked": netblocks.is_blocked(request.ip),
+        "ipRegistrationBlocked": netblocks.is_registration_blocked(request.ip)
     }, 200
 
 
@@ -114,9 +124,9 @@ async def get_status():
 async def get_statistics():
     return {
         "error": False,
-        "users": db.usersv0.estimated_document_count(),
-        "posts": db.posts.estimated_document_count(),
-        "chats": db.chats.estimated_document_count()
+        "users": await adb.usersv0.estimated_document_count(),
+        "posts": await adb.posts.estimated_document_count(),
+        "chats": await adb.chats.estimated_document_count()
     }, 200
 
 
@@ -129,7 +139,7 @@ async def get_ulist():
         page = 1
 
     # Get online usernames
-    usernames = list(app.cl.usernames.keys())
+    usernames = [username for username in app.cl.get_ulist().split(";") if username]
 
     # Get total pages
     pages = (len(usernames) // 25)
@@ -139,10 +149,13 @@ async def get_ulist():
     # Truncate list
     usernames = usernames[((page-1)*25):(((page-1)*25)+25)]
 
+    # Get accounts
+    accounts = await run_blocking(security.get_accounts, usernames)
+
     # Return users
     return {
         "error": False,
-        "autoget": [security.get_account(username) for username in usernames],
+        "autoget": [accounts.get(username) for username in usernames],
         "page#": page,
         "pages": pages
     }, 200
@@ -183,6 +196,11 @@ async def too_many_requests(e):
     return {"error": True, "type": "tooManyRequests"}, 429
 
 
+@app.errorhandler(passwords.PoolOverloaded)  # Too many password hashes/checks waiting
+async def passwords_overloaded(e):
+    return {"error": True, "type": "tooManyRequests"}, 429
+
+
 @app.errorhandler(500)  # Internal
 async def internal(e):
     return {"error": True, "type": "Internal"}, 500
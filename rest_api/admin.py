@@ -3,11 +3,11 @@ from quart_schema import validate_querystring, validate_request
 from pydantic import BaseModel, Field
 from typing import Optional, Literal
 from base64 import b64decode
-from copy import copy
 import time, pymongo
 
-import security
-from database import db, get_total_pages, blocked_ips, registration_blocked_ips
+import security, automod, scheduler, netinfo, netblocks, chatinfo
+from database import adb, run_blocking, get_total_pages, get_expiry
+from counters import incr_post_count, reset_post_counts
 
 
 admin_bp = Blueprint("admin_bp", __name__, url_prefix="/admin")
@@ -100,6 +100,13 @@ class NetblockBody(BaseModel):
     class Config:
         validate_assignment = True
 
+class ImportNetblocksBody(BaseModel):
+    type: Literal[0, 1] = Field()
+    cidrs: list[str] = Field(min_length=1, max_length=500000)
+
+    class Config:
+        validate_assignment = True
+
 class GetAnnouncementsQueryArgs(BaseModel):
     page: Optional[int] = Field(default=1, ge=1)
 
@@ -127,7 +134,7 @@ async def get_reports(query_args: GetReportsQueryArgs):
 
     # Get reports
     reports = list(
-        db.reports.find(
+        await adb.reports.find(
             query,
             projection={"reports.ip": 0},
             sort=[("escalated", pymongo.DESCENDING), ("reports.time", pymongo.DESCENDING)],
@@ -137,18 +144,22 @@ async def get_reports(query_args: GetReportsQueryArgs):
     )
 
     # Get content
+    accounts = await run_blocking(security.get_accounts, [
+        report.get("content_id") for report in reports if report["type"] == "user"
+    ])
     for report in reports:
         if report["type"] == "post":
-            post = db.posts.find_one({"_id": report.get("content_id")})
+            post = await adb.posts.find_one({"_id": report.get("content_id")})
             if post:
-                report["content"] = app.supporter.parse_posts_v0([post])[0]
+                report["content"] = (await run_blocking(app.supporter.parse_posts_v0, [post]))[0]
             else:
                 report["content"] = None
         elif report["type"] == "user":
-            report["content"] = security.get_account(report.get("content_id"))
+            report["content"] = accounts.get(report.get("content_id"))
 
     # Add log
-    security.add_audit_log(
+    await run_blocking(
+        security.add_audit_log,
         "got_reports",
         request.user,
         request.ip,
@@ -164,7 +175,7 @@ async def get_reports(query_args: GetReportsQueryArgs):
         "error": False,
         "autoget": reports,
         "page#": query_args.page,
-        "pages": get_total_pages("reports", query),
+        "pages": await get_total_pages("reports", query),
     }, 200
 
 
@@ -175,7 +186,7 @@ async def get_report(report_id):
         abort(403)
 
     # Get report
-    report = db.reports.find_one(
+    report = await adb.reports.find_one(
         {"_id": report_id}, projection={"reports.ip": 0}
     )
     if not report:
@@ -183,16 +194,17 @@ async def get_report(report_id):
 
     # Get content
     if report["type"] == "post":
-        post = db.posts.find_one({"_id": report.get("content_id")})
+        post = await adb.posts.find_one({"_id": report.get("content_id")})
         if post:
-            report["content"] = app.supporter.parse_posts_v0([post])[0]
+            report["content"] = (await run_blocking(app.supporter.parse_posts_v0, [post]))[0]
         else:
             report["content"] = None
     elif report["type"] == "user":
-        report["content"] = security.get_account(report.get("content_id"))
+        report["content"] = await run_blocking(security.get_account, report.get("content_id"))
 
     # Add log
-    security.add_audit_log(
+    await run_blocking(
+        security.add_audit_log,
         "got_report", request.user, request.ip, {"report_id": report_id}
     )
 
@@ -209,7 +221,7 @@ async def update_report(report_id, data: UpdateReportBody):
         abort(403)
 
     # Get report
-    report = db.reports.find_one(
+    report = await adb.reports.find_one(
         {"_id": report_id}, projection={"reports.ip": 0}
     )
     if not report:
@@ -218,22 +230,23 @@ async def update_report(report_id, data: UpdateReportBody):
     # Update report
     report["status"] = data.status
     report["escalated"] = False
-    db.reports.update_one(
+    await adb.reports.update_one(
         {"_id": report_id}, {"$set": {"status": data.status, "escalated": False}}
     )
 
     # Get content
     if report["type"] == "post":
-        post = db.posts.find_one({"_id": report.get("content_id")})
+        post = await adb.posts.find_one({"_id": report.get("content_id")})
         if post:
-            report["content"] = app.supporter.parse_posts_v0([post])[0]
+            report["content"] = (await run_blocking(app.supporter.parse_posts_v0, [post]))[0]
         else:
             report["content"] = None
     elif report["type"] == "user":
-        report["content"] = security.get_account(report.get("content_id"))
+        report["content"] = await run_blocking(security.get_account, report.get("content_id"))
 
     # Add log
-    security.add_audit_log(
+    await run_blocking(
+        security.add_audit_log,
         "updated_report",
         request.user,
         request.ip,
@@ -252,7 +265,7 @@ async def escalate_report(report_id):
         abort(403)
 
     # Get report
-    report = db.reports.find_one(
+    report = await adb.reports.find_one(
         {"_id": report_id}, projection={"reports.ip": 0}
     )
     if not report:
@@ -261,22 +274,23 @@ async def escalate_report(report_id):
     # Update report
     report["status"] = "pending"
     report["escalated"] = True
-    db.reports.update_one(
+    await adb.reports.update_one(
         {"_id": report_id}, {"$set": {"status": "pending", "escalated": True}}
     )
 
     # Get content
     if report["type"] == "post":
-        post = db.posts.find_one({"_id": report.get("content_id")})
+        post = await adb.posts.find_one({"_id": report.get("content_id")})
         if post:
-            report["content"] = app.supporter.parse_posts_v0([post])[0]
+            report["content"] = (await run_blocking(app.supporter.parse_posts_v0, [post]))[0]
         else:
             report["content"] = None
     elif report["type"] == "user":
-        report["content"] = security.get_account(report.get("content_id"))
+        report["content"] = await run_blocking(security.get_account, report.get("content_id"))
 
     # Add log
-    security.add_audit_log(
+    await run_blocking(
+        security.add_audit_log,
         "updated_report",
         request.user,
         request.ip,
@@ -295,10 +309,11 @@ async def get_admin_notes(identifier):
         abort(403)
 
     # Get notes
-    notes = db.admin_notes.find_one({"_id": identifier})
+    notes = await adb.admin_notes.find_one({"_id": identifier})
 
     # Add log
-    security.add_audit_log(
+    await run_blocking(
+        security.add_audit_log,
         "got_notes", request.user, request.ip, {"identifier": identifier}
     )
 
@@ -330,12 +345,13 @@ async def edit_admin_note(identifier, data: UpdateNotesBody):
         "last_modified_by": request.user,
         "last_modified_at": int(time.time()),
     }
-    db.admin_notes.update_one(
+    await adb.admin_notes.update_one(
         {"_id": identifier}, {"$set": notes}, upsert=True
     )
 
     # Add log
-    security.add_audit_log(
+    await run_blocking(
+        security.add_audit_log,
         "updated_notes",
         request.user,
         request.ip,
@@ -354,17 +370,18 @@ async def get_post(post_id):
         abort(403)
 
     # Get post
-    post = db.posts.find_one({"_id": post_id})
+    post = await adb.posts.find_one({"_id": post_id})
     if not post:
         abort(404)
 
     # Return post
     post["error"] = False
-    return app.supporter.parse_posts_v0(
+    return (await run_blocking(
+        app.supporter.parse_posts_v0,
         [post],
         include_revisions=True,
         requester=request.user
-    )[0], 200
+    ))[0], 200
 
 
 @admin_bp.delete("/posts/<post_id>")
@@ -374,55 +391,56 @@ async def delete_post(post_id):
         abort(403)
 
     # Get post
-    post = db.posts.find_one({"_id": post_id})
+    post = await adb.posts.find_one({"_id": post_id})
     if not post:
         abort(404)
 
     # Update post
+    if not post["isDeleted"]:
+        await run_blocking(incr_post_count, post["post_origin"], post["u"], -1)
     post["isDeleted"] = True
     post["deleted_at"] = int(time.time())
     post["mod_deleted"] = True
-    db.posts.update_one(
+    await adb.posts.update_one(
         {"_id": post_id},
         {
             "$set": {
                 "isDeleted": True,
                 "deleted_at": int(time.time()),
                 "mod_deleted": True,
+                "expires_at": get_expiry(),
             }
         },
     )
 
     # Send delete post event
     if post["post_origin"] == "home" or (post["post_origin"] == "inbox" and post["u"] == "Server"):
-        app.cl.send_event("delete_post", {
+        await run_blocking(app.cl.send_event, "delete_post", {
             "chat_id": post["post_origin"],
             "post_id": post_id
         })
     elif post["post_origin"] == "inbox":
-        app.cl.send_event("delete_post", {
+        await run_blocking(app.cl.send_event, "delete_post", {
             "chat_id": post["post_origin"],
             "post_id": post_id
         }, usernames=[post["u"]])
     else:
-        chat = db.chats.find_one({
-            "_id": post["post_origin"],
-            "deleted": False
-        }, projection={"members": 1})
+        chat = await chatinfo.get_chat_async(post["post_origin"])
         if chat:
-            app.cl.send_event("delete_post", {
+            await run_blocking(app.cl.send_event, "delete_post", {
                 "chat_id": post["post_origin"],
                 "post_id": post_id
             }, usernames=chat["members"])
 
     # Return updated post
     post["error"] = False
-    return app.supporter.parse_posts_v0(
+    return (await run_blocking(
+        app.supporter.parse_posts_v0,
         [post],
         include_replies=True,
         include_revisions=True,
         requester=request.user
-    )[0], 200
+    ))[0], 200
 
 
 @admin_bp.post("/posts/<post_id>/restore")
@@ -432,53 +450,57 @@ async def restore_post(post_id):
         abort(403)
 
     # Get post
-    post = db.posts.find_one({"_id": post_id})
+    post = await adb.posts.find_one({"_id": post_id})
     if not post:
         abort(404)
 
     # Update post
+    if post["isDeleted"]:
+        await run_blocking(incr_post_count, post["post_origin"], post["u"])
     post["isDeleted"] = False
     if "deleted_at" in post:
         del post["deleted_at"]
     if "mod_deleted" in post:
         del post["mod_deleted"]
-    db.posts.update_one(
+    await adb.posts.update_one(
         {"_id": post_id},
-        {"$set": {"isDeleted": False}, "$unset": {"deleted_at": "", "mod_deleted": ""}},
+        {"$set": {"isDeleted": False}, "$unset": {"deleted_at": "", "mod_deleted": "", "expires_at": ""}},
     )
 
     # Return updated post
     post["error"] = False
-    return app.supporter.parse_posts_v0(
+    return (await run_blocking(
+        app.supporter.parse_posts_v0,
         [post],
         include_replies=True,
         include_revisions=True,
         requester=request.user
-    )[0], 200
+    ))[0], 200
 
 
 @admin_bp.get("/users")
 @validate_querystring(GetUsersQueryArgs)
 async def get_users(query_args: GetUsersQueryArgs):
     # Get usernames
-    usernames = [user["_id"] for user in db.usersv0.find({}, sort=[("created", pymongo.DESCENDING)], skip=(query_args.page-1)*25, limit=25)]
+    usernames = [user["_id"] for user in await adb.usersv0.find({}, sort=[("created", pymongo.DESCENDING)], skip=(query_args.page-1)*25, limit=25, projection={"_id": 1})]
+    accounts = await run_blocking(security.get_accounts, usernames)
 
     # Add log
-    security.add_audit_log("got_users", request.user, request.ip, {"page": query_args.page})
+    await run_blocking(security.add_audit_log, "got_users", request.user, request.ip, {"page": query_args.page})
 
     # Return users
     return {
         "error": False,
-        "autoget": [security.get_account(username) for username in usernames],
+        "autoget": [accounts.get(username) for username in usernames],
         "page#": query_args.page,
-        "pages": get_total_pages("usersv0", {}),
+        "pages": await get_total_pages("usersv0", {}),
     }, 200
 
 
 @admin_bp.get("/users/<username>")
 async def get_user(username):
     # Get account
-    account = db.usersv0.find_one({"_id": username})
+    account = await adb.usersv0.find_one({"_id": username})
     if not account:
         abort(404)
 
@@ -504,7 +526,7 @@ async def get_user(username):
         # Add user settings or unread inbox state
         if security.has_permission(request.permissions, security.AdminPermissions.SYSADMIN):
             payload.update({"settings": security.DEFAULT_USER_SETTINGS})
-            user_settings = db.user_settings.find_one({"_id": username})
+            user_settings = await adb.user_settings.find_one({"_id": username})
             if user_settings:
                 del user_settings["_id"]
                 payload["settings"].update(user_settings)
@@ -512,7 +534,7 @@ async def get_user(username):
             payload.update(
                 {"settings": {"unread_inbox": security.DEFAULT_USER_SETTINGS["unread_inbox"]}}
             )
-            user_settings = db.user_settings.find_one(
+            user_settings = await adb.user_settings.find_one(
                 {"_id": username}, projection={"unread_inbox": 1}
             )
             if user_settings:
@@ -534,7 +556,7 @@ async def get_user(username):
                     "user": netlog["_id"]["user"],
                     "last_used": netlog["last_used"],
                 }
-                for netlog in db.netlog.find(
+                for netlog in await adb.netlog.find(
                     {"_id.user": username}, sort=[("last_used", pymongo.DESCENDING)]
                 )
             ]
@@ -542,7 +564,7 @@ async def get_user(username):
             # Get alts
             alts = [
                 netlog["_id"]["user"]
-                for netlog in db.netlog.find(
+                for netlog in await adb.netlog.find(
                     {"_id.ip": {"$in": [netlog["ip"] for netlog in netlogs]}}
                 )
             ]
@@ -552,27 +574,21 @@ async def get_user(username):
 
             # Get recent IP info
             if security.has_permission(request.permissions, security.AdminPermissions.VIEW_IPS):
+                netinfos = await netinfo.get_netinfos([netlog["ip"] for netlog in netlogs])
                 payload["recent_ips"] = [
                     {
                         "ip": netlog["ip"],
-                        "netinfo": security.get_netinfo(netlog["ip"]),
+                        "netinfo": netinfos[netlog["ip"]],
                         "last_used": netlog["last_used"],
-                        "blocked": (
-                            blocked_ips.search_best(netlog["ip"])
-                            is not None
-                        ),
-                        "registration_blocked": (
-                            registration_blocked_ips.search_best(
-                                netlog["ip"]
-                            )
-                            is not None
-                        ),
+                        "blocked": netblocks.is_blocked(netlog["ip"]),
+                        "registration_blocked": netblocks.is_registration_blocked(netlog["ip"]),
                     }
                     for netlog in netlogs
                 ]
 
     # Add log
-    security.add_audit_log(
+    await run_blocking(
+        security.add_audit_log,
         "got_user",
         request.user,
         request.ip,
@@ -591,7 +607,7 @@ async def update_user(username, data: UpdateUserBody):
         abort(403)
 
     # Make sure user exists
-    if not security.account_exists(username):
+    if not await run_blocking(security.account_exists, username):
         abort(404)
 
     # Create updated fields var
@@ -600,7 +616,8 @@ async def update_user(username, data: UpdateUserBody):
     # Permissions
     if data.permissions is not None:
         updated_fields["permissions"] = data.permissions
-        security.add_audit_log(
+        await run_blocking(
+            security.add_audit_log,
             "updated_permissions",
             request.user,
             request.ip,
@@ -608,13 +625,15 @@ async def update_user(username, data: UpdateUserBody):
         )
 
     # Update user
-    db.usersv0.update_one({"_id": username}, {"$set": updated_fields})
+    await adb.usersv0.update_one({"_id": username}, {"$set": updated_fields})
+    await run_blocking(security.invalidate_tokens, username)
+    await run_blocking(security.invalidate_account, username)
 
     # Sync config between sessions
-    app.cl.send_event("update_config", updated_fields, usernames=[username])
+    await run_blocking(app.cl.send_event, "update_config", updated_fields, usernames=[username])
 
     # Send updated values to other clients
-    app.cl.send_event("update_profile", {
+    await run_blocking(app.cl.send_event, "update_profile", {
         "_id": username,
         "permissions": data.permissions,
     })
@@ -630,12 +649,12 @@ async def delete_user(username, query_args: DeleteUserQueryArgs):
         abort(403)
 
     # Make sure user exists
-    if not security.account_exists(username):
+    if not await run_blocking(security.account_exists, username):
         abort(404)
 
     # Make sure user isn't protected
     if not security.has_permission(request.permissions, security.AdminPermissions.SYSADMIN):
-        account = db.usersv0.find_one(
+        account = await adb.usersv0.find_one(
             {"_id": username}, projection={"flags": 1}
         )
         if (account["flags"] & security.UserFlags.PROTECTED) == security.UserFlags.PROTECTED:
@@ -646,11 +665,11 @@ async def delete_user(username, query_args: DeleteUserQueryArgs):
 
     # Delete account (or not, depending on the mode)
     if deletion_mode == "cancel":
-        db.usersv0.update_one(
+        await adb.usersv0.update_one(
             {"_id": username}, {"$set": {"delete_after": None}}
         )
     elif deletion_mode in ["schedule", "immediate", "purge"]:
-        db.usersv0.update_one(
+        await adb.usersv0.update_one(
             {"_id": username},
             {
                 "$set": {
@@ -659,10 +678,10 @@ async def delete_user(username, query_args: DeleteUserQueryArgs):
                 }
             },
         )
-        for client in app.cl.usernames.get(username, []):
-            client.kick()
+        await run_blocking(security.invalidate_tokens, username)
+        await run_blocking(app.cl.kick_users, [username])
         if deletion_mode in ["immediate", "purge"]:
-            security.delete_account(username, purge=(deletion_mode == "purge"))
+            await run_blocking(security.delete_account, username, purge=(deletion_mode == "purge"))
     else:
         abort(400)
 
@@ -679,24 +698,28 @@ async def ban_user(username, data: UpdateUserBanBody):
         abort(403)
 
     # Make sure user exists
-    if not security.account_exists(username):
+    if not await run_blocking(security.account_exists, username):
         abort(404)
 
     # Make sure user isn't protected
     if not security.has_permission(request.permissions, security.AdminPermissions.SYSADMIN):
-        account = db.usersv0.find_one(
+        account = await adb.usersv0.find_one(
             {"_id": username}, projection={"flags": 1}
         )
         if (account["flags"] & security.UserFlags.PROTECTED) == security.UserFlags.PROTECTED:
             abort(403)
 
     # Update user
-    db.usersv0.update_one(
+    await adb.usersv0.update_one(
         {"_id": username}, {"$set": {"ban": data.model_dump()}}
     )
+    await run_blocking(security.invalidate_tokens, username)
+    await run_blocking(security.invalidate_account, username)
+    await run_blocking(security.invalidate_ban, username)
 
     # Add log
-    security.add_audit_log(
+    await run_blocking(
+        security.add_audit_log,
         "banned",
         request.user,
         request.ip,
@@ -707,10 +730,9 @@ async def ban_user(username, data: UpdateUserBanBody):
     if (data.state == "perm_ban") or (
         data.state == "temp_ban" and data.expires > time.time()
     ):
-        for client in app.cl.usernames.get(username, []):
-            client.kick()
+        await run_blocking(app.cl.kick_users, [username])
     else:
-        app.cl.send_event("update_config", {"ban": data.model_dump()}, usernames=[username])
+        await run_blocking(app.cl.send_event, "update_config", {"ban": data.model_dump()}, usernames=[username])
 
     return {"error": False}, 200
 
@@ -730,12 +752,13 @@ async def get_user_posts(username, query_args: GetUserPostsQueryArgs):
         }
     else:
         query = {"u": username}
-    posts = db.posts.find(
+    posts = await adb.posts.find(
         query, sort=[("t.e", pymongo.DESCENDING)], skip=(query_args.page - 1) * 25, limit=25
     )
 
     # Add log
-    security.add_audit_log(
+    await run_blocking(
+        security.add_audit_log,
         "got_user_posts",
         request.user,
         request.ip,
@@ -745,9 +768,9 @@ async def get_user_posts(username, query_args: GetUserPostsQueryArgs):
     # Return posts
     return {
         "error": False,
-        "autoget": app.supporter.parse_posts_v0(posts, requester=request.user),
+        "autoget": await run_blocking(app.supporter.parse_posts_v0, posts, requester=request.user),
         "page#": query_args.page,
-        "pages": get_total_pages("posts", query),
+        "pages": await get_total_pages("posts", query),
     }, 200
 
 
@@ -760,7 +783,7 @@ async def clear_user_posts(username, query_args: ClearUserPostsQueryArgs):
 
     # Make sure user isn't protected
     if not security.has_permission(request.permissions, security.AdminPermissions.SYSADMIN):
-        account = db.usersv0.find_one(
+        account = await adb.usersv0.find_one(
             {"_id": username}, projection={"flags": 1}
         )
         if account and (account["flags"] & security.UserFlags.PROTECTED) == security.UserFlags.PROTECTED:
@@ -771,19 +794,24 @@ async def clear_user_posts(username, query_args: ClearUserPostsQueryArgs):
         query = {"u": username, "post_origin": query_args.origin, "isDeleted": False}
     else:
         query = {"u": username, "isDeleted": False}
-    db.posts.update_many(
+    origins = await adb.posts.distinct("post_origin", query)
+    await adb.posts.update_many(
         query,
         {
             "$set": {
                 "isDeleted": True,
                 "mod_deleted": True,
                 "deleted_at": int(time.time()),
+                "expires_at": get_expiry(),
             }
         },
     )
+    for origin in origins:
+        await run_blocking(reset_post_counts, origin, username)
 
     # Add log
-    security.add_audit_log(
+    await run_blocking(
+        security.add_audit_log,
         "clear_user_posts",
         request.user,
         request.ip,
@@ -801,14 +829,15 @@ async def send_alert(username, data: InboxMessageBody):
         abort(401)
 
     # Make sure user exists
-    if not security.account_exists(username):
+    if not await run_blocking(security.account_exists, username):
         abort(404)
 
     # Create inbox message
-    post = app.supporter.create_post("inbox", username, data.content)
+    post = await run_blocking(app.supporter.create_post, "inbox", username, data.content)
 
     # Add log
-    security.add_audit_log(
+    await run_blocking(
+        security.add_audit_log,
         "alerted",
         request.user,
         request.ip,
@@ -817,7 +846,7 @@ async def send_alert(username, data: InboxMessageBody):
 
     # Return new post
     post["error"] = False
-    return app.supporter.parse_posts_v0([post], requester=request.user)[0], 200
+    return post, 200
 
 
 @admin_bp.post("/users/<username>/kick")
@@ -827,14 +856,15 @@ async def kick_user(username):
         abort(401)
 
     # Revoke tokens
-    db.usersv0.update_one({"_id": username}, {"$set": {"tokens": []}})
+    await adb.usersv0.update_one({"_id": username}, {"$set": {"tokens": []}})
+    await run_blocking(security.invalidate_tokens, username)
 
     # Kick clients
-    for client in app.cl.usernames.get(username, []):
-        client.kick()
+    await run_blocking(app.cl.kick_users, [username])
 
     # Add log
-    security.add_audit_log(
+    await run_blocking(
+        security.add_audit_log,
         "kicked", request.user, request.ip, {"username": username}
     )
 
@@ -851,25 +881,27 @@ async def clear_avatar(username):
 
     # Make sure user isn't protected
     if not security.has_permission(request.permissions, security.AdminPermissions.SYSADMIN):
-        account = db.usersv0.find_one(
+        account = await adb.usersv0.find_one(
             {"_id": username}, projection={"flags": 1}
         )
         if account and (account["flags"] & security.UserFlags.PROTECTED) == security.UserFlags.PROTECTED:
             abort(403)
 
     # Update user
-    db.usersv0.update_one(
+    await adb.usersv0.update_one(
         {"_id": username, "avatar": {"$ne": None}}, {"$set": {"avatar": ""}}
     )
+    await run_blocking(security.invalidate_account, username)
 
     # Sync config between sessions
-    app.cl.send_event("update_config", {"avatar": ""}, usernames=[username])
+    await run_blocking(app.cl.send_event, "update_config", {"avatar": ""}, usernames=[username])
 
     # Send updated avatar to other clients
-    app.cl.send_event("update_profile", {"_id": username, "avatar": ""})
+    await run_blocking(app.cl.send_event, "update_profile", {"_id": username, "avatar": ""})
 
     # Add log
-    security.add_audit_log(
+    await run_blocking(
+        security.add_audit_log,
         "cleared_avatar", request.user, request.ip, {"username": username}
     )
 
@@ -886,25 +918,27 @@ async def clear_quote(username):
 
     # Make sure user isn't protected
     if not security.has_permission(request.permissions, security.AdminPermissions.SYSADMIN):
-        account = db.usersv0.find_one(
+        account = await adb.usersv0.find_one(
             {"_id": username}, projection={"flags": 1}
         )
         if account and (account["flags"] & security.UserFlags.PROTECTED) == security.UserFlags.PROTECTED:
             abort(403)
 
     # Update user
-    db.usersv0.update_one(
+    await adb.usersv0.update_one(
         {"_id": username, "quote": {"$ne": None}}, {"$set": {"quote": ""}}
     )
+    await run_blocking(security.invalidate_account, username)
 
     # Sync config between sessions
-    app.cl.send_event("update_config", {"quote": ""}, usernames=[username])
+    await run_blocking(app.cl.send_event, "update_config", {"quote": ""}, usernames=[username])
 
     # Send updated quote to other clients
-    app.cl.send_event("update_profile", {"_id": username, "quote": ""})
+    await run_blocking(app.cl.send_event, "update_profile", {"_id": username, "quote": ""})
 
     # Add log
-    security.add_audit_log(
+    await run_blocking(
+        security.add_audit_log,
         "cleared_quote", request.user, request.ip, {"username": username}
     )
 
@@ -918,22 +952,17 @@ async def get_chat(chat_id):
         abort(403)
 
     # Get chat
-    chat = db.chats.find_one({"_id": chat_id})
+    chat = await adb.chats.find_one({"_id": chat_id})
     if not chat:
         abort(404)
 
     # Add log
-    security.add_audit_log("got_chat", request.user, request.ip, {"chat_id": chat_id})
+    await run_blocking(security.add_audit_log, "got_chat", request.user, request.ip, {"chat_id": chat_id})
 
     # Return chat
     chat.update({
         "error": False,
-        "emojis": list(db.chat_emojis.find({
-            "chat_id": chat["_id"]
-        }, projection={"chat_id": 0, "created_at": 0, "created_by": 0})),
-        "stickers": list(db.chat_stickers.find({
-            "chat_id": chat["_id"]
-        }, projection={"chat_id": 0, "created_at": 0, "created_by": 0}))
+        **(await chatinfo.get_chat_emotes_async(chat["_id"]))
     })
     return chat, 200
 
@@ -946,7 +975,7 @@ async def update_chat(chat_id, data: UpdateChatBody):
         abort(403)
 
     # Get chat
-    chat = db.chats.find_one({"_id": chat_id})
+    chat = await adb.chats.find_one({"_id": chat_id})
     if not chat:
         abort(404)
 
@@ -962,14 +991,15 @@ async def update_chat(chat_id, data: UpdateChatBody):
         updated_vals["allow_pinning"] = data.allow_pinning
     
     # Update chat
-    db.chats.update_one({"_id": chat_id}, {"$set": updated_vals})
+    await adb.chats.update_one({"_id": chat_id}, {"$set": updated_vals})
+    await run_blocking(chatinfo.invalidate_chat, chat_id)
 
     # Send update chat event
-    app.cl.send_event("update_chat", updated_vals, usernames=chat["members"])
+    await run_blocking(app.cl.send_event, "update_chat", updated_vals, usernames=chat["members"])
 
     # Add log
     updated_vals["chat_id"] = updated_vals.pop("_id")
-    security.add_audit_log("updated_chat", request.user, request.ip, updated_vals)
+    await run_blocking(security.add_audit_log, "updated_chat", request.user, request.ip, updated_vals)
 
     # Return chat
     chat["error"] = False
@@ -983,19 +1013,20 @@ async def delete_chat(chat_id):
         abort(403)
 
     # Get chat
-    chat = db.chats.find_one({"_id": chat_id})
+    chat = await adb.chats.find_one({"_id": chat_id})
     if not chat:
         abort(404)
 
     # Update chat
     chat["deleted"] = True
-    db.chats.update_one({"_id": chat_id}, {"$set": {"deleted": True}})
+    await adb.chats.update_one({"_id": chat_id}, {"$set": {"deleted": True}})
+    await run_blocking(chatinfo.invalidate_chat, chat_id)
 
     # Send delete chat event
-    app.cl.send_event("delete_chat", {"chat_id": chat_id}, usernames=chat["members"])
+    await run_blocking(app.cl.send_event, "delete_chat", {"chat_id": chat_id}, usernames=chat["members"])
 
     # Add log
-    security.add_audit_log("deleted_chat", request.user, request.ip, {"chat_id": chat_id})
+    await run_blocking(security.add_audit_log, "deleted_chat", request.user, request.ip, {"chat_id": chat_id})
 
     # Return chat
     chat["error"] = False
@@ -1009,19 +1040,20 @@ async def restore_chat(chat_id):
         abort(403)
 
     # Get chat
-    chat = db.chats.find_one({"_id": chat_id})
+    chat = await adb.chats.find_one({"_id": chat_id})
     if not chat:
         abort(404)
 
     # Update chat
     chat["deleted"] = False
-    db.chats.update_one({"_id": chat_id}, {"$set": {"deleted": False}})
+    await adb.chats.update_one({"_id": chat_id}, {"$set": {"deleted": False}})
+    await run_blocking(chatinfo.invalidate_chat, chat_id)
 
     # Send create chat event
-    app.cl.send_event("create_chat", chat, usernames=chat["members"])
+    await run_blocking(app.cl.send_event, "create_chat", chat, usernames=chat["members"])
 
     # Add log
-    security.add_audit_log("restored_chat", request.user, request.ip, {"chat_id": chat_id})
+    await run_blocking(security.add_audit_log, "restored_chat", request.user, request.ip, {"chat_id": chat_id})
 
     # Return chat
     chat["error"] = False
@@ -1035,7 +1067,7 @@ async def transfer_chat_ownership(chat_id, username):
         abort(403)
 
     # Get chat
-    chat = db.chats.find_one({
+    chat = await adb.chats.find_one({
         "_id": chat_id,
         "members": username
     })
@@ -1049,13 +1081,14 @@ async def transfer_chat_ownership(chat_id, username):
 
     # Update chat
     chat["owner"] = username
-    db.chats.update_one({"_id": chat_id}, {"$set": {"owner": username}})
+    await adb.chats.update_one({"_id": chat_id}, {"$set": {"owner": username}})
+    await run_blocking(chatinfo.invalidate_chat, chat_id)
 
     # Send update chat event
-    app.cl.send_event("update_chat", {"_id": chat_id, "owner": chat["owner"]}, usernames=chat["members"])
+    await run_blocking(app.cl.send_event, "update_chat", {"_id": chat_id, "owner": chat["owner"]}, usernames=chat["members"])
 
     # Add log
-    security.add_audit_log("transferred_chat_ownership", request.user, request.ip, {"chat_id": chat_id, "username": username})
+    await run_blocking(security.add_audit_log, "transferred_chat_ownership", request.user, request.ip, {"chat_id": chat_id, "username": username})
 
     # Return chat
     chat["error"] = False
@@ -1070,23 +1103,23 @@ async def get_chat_posts(chat_id, query_args: GetChatPostsQueryArgs):
         abort(403)
 
     # Make sure chat exists
-    if db.chats.count_documents({
+    if await adb.chats.count_documents({
         "_id": chat_id
     }, limit=1) < 1:
         abort(404)
 
     # Get posts
     query = {"post_origin": chat_id, "$or": [{"isDeleted": False}, {"isDeleted": True}]}
-    posts = db.posts.find(
+    posts = await adb.posts.find(
         query, sort=[("t.e", pymongo.DESCENDING)], skip=(query_args.page - 1) * 25, limit=25
     )
 
     # Return posts
     return {
         "error": False,
-        "autoget": app.supporter.parse_posts_v0(posts, requester=request.user),
+        "autoget": await run_blocking(app.supporter.parse_posts_v0, posts, requester=request.user),
         "page#": query_args.page,
-        "pages": get_total_pages("posts", query)
+        "pages": await get_total_pages("posts", query)
     }, 200
 
 
@@ -1097,14 +1130,10 @@ async def get_netinfo(ip):
         abort(403)
 
     # Get netinfo
-    netinfo = security.get_netinfo(ip)
+    ip_netinfo = await netinfo.get_netinfo(ip)
 
     # Get netblocks
-    netblocks = []
-    for radix_node in blocked_ips.search_covering(ip):
-        netblocks.append(db.netblock.find_one({"_id": radix_node.prefix}))
-    for radix_node in registration_blocked_ips.search_covering(ip):
-        netblocks.append(db.netblock.find_one({"_id": radix_node.prefix}))
+    ip_netblocks = await adb.netblock.find({"_id": {"$in": netblocks.get_covering(ip)}})
 
     # Get netlogs
     netlogs = [
@@ -1113,19 +1142,19 @@ async def get_netinfo(ip):
             "user": netlog["_id"]["user"],
             "last_used": netlog["last_used"],
         }
-        for netlog in db.netlog.find(
+        for netlog in await adb.netlog.find(
             {"_id.ip": ip}, sort=[("last_used", pymongo.DESCENDING)]
         )
     ]
 
     # Add log
-    security.add_audit_log("got_netinfo", request.user, request.ip, {"ip": ip})
+    await run_blocking(security.add_audit_log, "got_netinfo", request.user, request.ip, {"ip": ip})
 
     # Return netinfo, netblocks, and netlogs
     return {
         "error": False,
-        "netinfo": netinfo,
-        "netblocks": netblocks,
+        "netinfo": ip_netinfo,
+        "netblocks": ip_netblocks,
         "netlogs": netlogs,
     }, 200
 
@@ -1138,17 +1167,17 @@ async def get_netblocks(query_args: GetNetblocksQueryArgs):
         abort(401)
 
     # Get netblocks
-    netblocks = list(db.netblock.find({}, sort=[("created", pymongo.DESCENDING)], skip=(query_args.page-1)*25, limit=25))
+    page_netblocks = await adb.netblock.find({}, sort=[("created", pymongo.DESCENDING)], skip=(query_args.page-1)*25, limit=25)
 
     # Add log
-    security.add_audit_log("got_netblocks", request.user, request.ip, {"page": query_args.page})
+    await run_blocking(security.add_audit_log, "got_netblocks", request.user, request.ip, {"page": query_args.page})
 
     # Return netblocks
     return {
         "error": False,
-        "autoget": netblocks,
+        "autoget": page_netblocks,
         "page#": query_args.page,
-        "pages": get_total_pages("netblock", {})
+        "pages": await get_total_pages("netblock", {})
     }, 200
 
 
@@ -1162,12 +1191,13 @@ async def get_netblock(cidr):
     cidr = b64decode(cidr.encode()).decode()
 
     # Get netblock
-    netblock = db.netblock.find_one({"_id": cidr})
+    netblock = await adb.netblock.find_one({"_id": cidr})
     if not netblock:
         abort(404)
 
     # Add log
-    security.add_audit_log(
+    await run_blocking(
+        security.add_audit_log,
         "got_netblock", request.user, request.ip, {"cidr": cidr, "netblock": netblock}
     )
 
@@ -1186,41 +1216,19 @@ async def create_netblock(cidr, data: NetblockBody):
     # b64 decode CIDR
     cidr = b64decode(cidr.encode()).decode()
 
-    # Construct netblock obj
-    netblock = {
-        "_id": cidr,
-        "type": data.type,
-        "created": int(time.time())
-    }
-
-    # Remove from Radix
-    if blocked_ips.search_exact(cidr):
-        blocked_ips.delete(cidr)
-    if registration_blocked_ips.search_exact(cidr):
-        registration_blocked_ips.delete(cidr)
-
-    # Add to Radix
-    if data.type == 0:
-        radix_node = blocked_ips.add(cidr)
-    elif data.type == 1:
-        radix_node = registration_blocked_ips.add(cidr)
-
-    # Modify netblock with new Radix node prefix
-    netblock["_id"] = radix_node.prefix
-
-    # Add netblock to database
-    db.netblock.update_one(
-        {"_id": netblock["_id"]}, {"$set": netblock}, upsert=True
-    )
+    # Add netblock
+    try:
+        netblock = await run_blocking(netblocks.add_netblock, cidr, data.type)
+    except ValueError:
+        return {"error": True, "type": "badRequest"}, 400
 
     # Kick clients
-    if data.type == 0:
-        for client in copy(app.cl.clients):
-            if blocked_ips.search_best(client.ip):
-                client.kick()
+    if data.type == netblocks.BLOCKED:
+        await run_blocking(app.cl.kick_netblock, netblock["_id"])
 
     # Add log
-    security.add_audit_log(
+    await run_blocking(
+        security.add_audit_log,
         "created_netblock",
         request.user,
         request.ip,
@@ -1241,23 +1249,48 @@ async def delete_netblock(cidr):
     # b64 decode CIDR
     cidr = b64decode(cidr.encode()).decode()
 
-    # Remove from database
-    db.netblock.delete_one({"_id": cidr})
-
-    # Remove from Radix
-    if blocked_ips.search_exact(cidr):
-        blocked_ips.delete(cidr)
-    if registration_blocked_ips.search_exact(cidr):
-        registration_blocked_ips.delete(cidr)
+    # Remove netblock
+    await run_blocking(netblocks.delete_netblock, cidr)
 
     # Add log
-    security.add_audit_log(
+    await run_blocking(
+        security.add_audit_log,
         "deleted_netblock", request.user, request.ip, {"cidr": cidr}
     )
 
     return {"error": False}, 200
 
 
+@admin_bp.post("/netblocks/import")
+@validate_request(ImportNetblocksBody)
+async def import_netblocks(data: ImportNetblocksBody):
+    # Check permissions
+    if not security.has_permission(request.permissions, security.AdminPermissions.BLOCK_IPS):
+        abort(401)
+
+    # Import netblocks (and kick clients from blocked netblocks)
+    result = await run_blocking(
+        netblocks.import_netblocks,
+        data.cidrs,
+        data.type,
+        on_imported=(
+            (lambda cidrs: app.cl.kick_netblock(*cidrs))
+            if data.type == netblocks.BLOCKED else None
+        )
+    )
+
+    # Add log
+    await run_blocking(
+        security.add_audit_log,
+        "imported_netblocks",
+        request.user,
+        request.ip,
+        {"type": data.type, "imported": result["imported"], "invalid": len(result["invalid"])},
+    )
+
+    return {"error": False, **result}, 200
+
+
 @admin_bp.get("/announcements")
 @validate_querystring(GetAnnouncementsQueryArgs)
 async def get_announcements(query_args: GetAnnouncementsQueryArgs):
@@ -1271,21 +1304,22 @@ async def get_announcements(query_args: GetAnnouncementsQueryArgs):
         "$or": [{"isDeleted": False}, {"isDeleted": True}],
         "u": "Server",
     }
-    posts = db.posts.find(
+    posts = await adb.posts.find(
         query, sort=[("t.e", pymongo.DESCENDING)], skip=(query_args.page - 1) * 25, limit=25
     )
 
     # Add log
-    security.add_audit_log(
+    await run_blocking(
+        security.add_audit_log,
         "got_announcements", request.user, request.ip, {"page": query_args.page}
     )
 
     # Return posts
     return {
         "error": False,
-        "autoget": app.supporter.parse_posts_v0(posts, requester=request.user),
+        "autoget": await run_blocking(app.supporter.parse_posts_v0, posts, requester=request.user),
         "page#": query_args.page,
-        "pages": get_total_pages("posts", query),
+        "pages": await get_total_pages("posts", query),
     }, 200
 
 
@@ -1299,16 +1333,53 @@ async def send_announcement(data: InboxMessageBody):
         abort(401)
 
     # Create announcement
-    post = app.supporter.create_post("inbox", "Server", data.content)
+    post = await run_blocking(app.supporter.create_post, "inbox", "Server", data.content)
 
     # Add log
-    security.add_audit_log(
+    await run_blocking(
+        security.add_audit_log,
         "sent_announcement", request.user, request.ip, {"content": data.content}
     )
 
     # Return new post
     post["error"] = False
-    return app.supporter.parse_posts_v0([post], requester=request.user)[0], 200
+    return post, 200
+
+
+@admin_bp.get("/server/automod-queue")
+async def get_automod_queue_metrics():
+    # Check permissions
+    if not security.has_permission(request.permissions, security.AdminPermissions.SYSADMIN):
+        abort(401)
+
+    # Get metrics
+    metrics = await run_blocking(automod.get_metrics)
+
+    return {"error": False, **metrics}, 200
+
+
+@admin_bp.get("/server/tasks")
+async def get_background_tasks_metrics():
+    # Check permissions
+    if not security.has_permission(request.permissions, security.AdminPermissions.SYSADMIN):
+        abort(401)
+
+    # Get metrics
+    metrics = await run_blocking(scheduler.get_metrics)
+
+    return {"error": False, "tasks": metrics}, 200
+
+
+@admin_bp.get("/server/netblocks")
+async def get_netblocks_metrics():
+    # Check permissions
+    if not security.has_permission(request.permissions, security.AdminPermissions.SYSADMIN):
+        abort(401)
+
+    # Get metrics
+    metrics = netblocks.get_metrics()
+
+    return {"error": False, **metrics}, 200
 
 
 @admin_bp.post("/server/kick-all")
@@ -1318,11 +1389,10 @@ async def kick_all_clients():
         abort(401)
 
     # Kick all clients
-    for client in copy(app.cl.clients):
-        client.kick()
+    await run_blocking(app.cl.kick_users)
 
     # Add log
-    security.add_audit_log("kicked_all", request.user, request.ip, {})
+    await run_blocking(security.add_audit_log, "kicked_all", request.user, request.ip, {})
 
     return {"error": False}, 200
 
@@ -1334,17 +1404,16 @@ async def enable_repair_mode():
         abort(401)
 
     # Update database item
-    db.config.update_one({"_id": "status"}, {"$set": {"repair_mode": True}})
+    await adb.config.update_one({"_id": "status"}, {"$set": {"repair_mode": True}})
 
     # Update supporter attribute
     app.supporter.repair_mode = True
 
     # Kick all clients
-    for client in copy(app.cl.clients):
-        client.kick()
+    await run_blocking(app.cl.kick_users)
 
     # Add log
-    security.add_audit_log("enabled_repair_mode", request.user, request.ip, {})
+    await run_blocking(security.add_audit_log, "enabled_repair_mode", request.user, request.ip, {})
 
     return {"error": False}, 200
 
@@ -1356,13 +1425,13 @@ async def disable_registration():
         abort(401)
 
     # Update database item
-    db.config.update_one({"_id": "status"}, {"$set": {"registration": False}})
+    await adb.config.update_one({"_id": "status"}, {"$set": {"registration": False}})
 
     # Update supporter attribute
     app.supporter.registration = False
 
     # Add log
-    security.add_audit_log("disabled_registration", request.user, request.ip, {})
+    await run_blocking(security.add_audit_log, "disabled_registration", request.user, request.ip, {})
 
     return {"error": False}, 200
 
@@ -1374,12 +1443,12 @@ async def enable_registration():
         abort(401)
 
     # Update database item
-    db.config.update_one({"_id": "status"}, {"$set": {"registration": True}})
+    await adb.config.update_one({"_id": "status"}, {"$set": {"registration": True}})
 
     # Update supporter attribute
     app.supporter.registration = True
 
     # Add log
-    security.add_audit_log("enabled_registration", request.user, request.ip, {})
+    await run_blocking(security.add_audit_log, "enabled_registration", request.user, request.ip, {})
 
     return {"error": False}, 200
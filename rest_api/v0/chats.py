@@ -2,18 +2,26 @@ from quart import Blueprint, current_app as app, request, abort
 from quart_schema import validate_querystring, validate_request
 from pydantic import BaseModel, Field
 from typing import Optional, Literal
-import pymongo, uuid, time, re, os
+from hashlib import sha256
+import pymongo, uuid, time, re, os, msgpack
 
-import security
-from database import db, get_total_pages
+import security, chatinfo, blocks
+from database import adb, run_blocking, get_total_pages, get_posts_page
+from counters import reset_post_counts
 from uploads import claim_file, unclaim_file
 from utils import log
 
 chats_bp = Blueprint("chats_bp", __name__, url_prefix="/chats")
 
+# Chat fields clients revalidate their chats list on (activity like last_active is left out)
+CHATS_ETAG_FIELDS = ["_id", "type", "nickname", "icon", "icon_color", "owner", "members", "allow_pinning", "emotes_version"]
+
 
 class GetPostsQueryArgs(BaseModel):
     page: Optional[int] = Field(default=1, ge=1)
+    before: Optional[str] = Field(default=None, max_length=50)
+    after: Optional[str] = Field(default=None, max_length=50)
+    count: Optional[bool] = Field(default=True)
 
 class ChatBody(BaseModel):
     nickname: str = Field(default=None, min_length=1, max_length=32)
@@ -36,25 +44,23 @@ async def get_chats():
         abort(401)
 
     # Get chats
-    chats = app.supporter.get_chats(request.user)
+    chats = await run_blocking(app.supporter.get_chats, request.user)
 
-    # Add emotes
-    [chat.update({
-        "emojis": list(db.chat_emojis.find({
-            "chat_id": chat["_id"]
-        }, projection={"chat_id": 0, "created_at": 0, "created_by": 0})),
-        "stickers": list(db.chat_stickers.find({
-            "chat_id": chat["_id"]
-        }, projection={"chat_id": 0, "created_at": 0, "created_by": 0}))
-    }) for chat in chats]
-
-    # Get and return chats
+    # Skip sending chats the client already has
+    etag = sha256(msgpack.packb(sorted(
+        [[chat.get(field) for field in CHATS_ETAG_FIELDS] for chat in chats],
+        key=lambda chat: chat[0]
+    ))).hexdigest()
+    if request.if_none_match.contains(etag):
+        return "", 304, {"ETag": f'"{etag}"'}
+
+    # Return chats
     return {
         "error": False,
         "autoget": chats,
         "page#": 1,
         "pages": 1
-    }, 200
+    }, 200, {"ETag": f'"{etag}"'}
 
 
 @chats_bp.post("/")
@@ -64,25 +70,22 @@ async def create_chat(data: ChatBody):
     if not request.user:
         abort(401)
 
-    # Check ratelimit
-    if security.ratelimited(f"create_chat:{request.user}"):
-        abort(429)
-
     # Ratelimit
-    security.ratelimit(f"create_chat:{request.user}", 5, 30)
+    if await security.ratelimit_async(f"create_chat:{request.user}", 5, 30):
+        abort(429)
 
     # Check restrictions
-    if security.is_restricted(request.user, security.Restrictions.NEW_CHATS):
+    if security.is_restricted(request.user, security.Restrictions.NEW_CHATS, ban=request.ban):
         return {"error": True, "type": "accountBanned"}, 403
     
     # Make sure the requester isn't in too many chats
-    if db.chats.count_documents({"type": 0, "members": request.user}, limit=150) >= 150:
+    if await adb.chats.count_documents({"type": 0, "members": request.user}, limit=150) >= 150:
         return {"error": True, "type": "tooManyChats"}, 403
 
     # Claim icon
     if data.icon:
         try:
-            claim_file(data.icon, "icons", request.user)
+            await run_blocking(claim_file, data.icon, "icons", request.user)
         except Exception as e:
             log(f"Unable to claim icon: {e}")
             return {"error": True, "type": "unableToClaimIcon"}, 500
@@ -107,21 +110,16 @@ async def create_chat(data: ChatBody):
         "deleted": False,
         "allow_pinning": data.allow_pinning
     }
-    db.chats.insert_one(chat)
+    await adb.chats.insert_one(chat)
+    await run_blocking(chatinfo.invalidate_chat, chat["_id"])
 
     # Add emotes
     chat.update({
-        "emojis": list(db.chat_emojis.find({
-            "chat_id": chat["_id"]
-        }, projection={"chat_id": 0, "created_at": 0, "created_by": 0})),
-        "stickers": list(db.chat_stickers.find({
-            "chat_id": chat["_id"]
-        }, projection={"chat_id": 0, "created_at": 0, "created_by": 0}))
+        **(await chatinfo.get_chat_emotes_async(chat["_id"]))
     })
 
-
     # Tell the requester the chat was created
-    app.cl.send_event("create_chat", chat, usernames=[request.user])
+    await run_blocking(app.cl.send_event, "create_chat", chat, usernames=[request.user])
 
     # Return chat
     chat["error"] = False
@@ -134,20 +132,19 @@ async def get_chat(chat_id):
     if not request.user:
         abort(401)
 
+    # Make sure chat exists and requester has access
+    if not await chatinfo.get_member_chat_async(chat_id, request.user):
+        abort(404)
+
     # Get chat
-    chat = db.chats.find_one({"_id": chat_id, "members": request.user, "deleted": False})
+    chat = await adb.chats.find_one({"_id": chat_id})
     if not chat:
         abort(404)
 
     # Return chat
     chat.update({
         "error": False,
-        "emojis": list(db.chat_emojis.find({
-            "chat_id": chat["_id"]
-        }, projection={"chat_id": 0, "created_at": 0, "created_by": 0})),
-        "stickers": list(db.chat_stickers.find({
-            "chat_id": chat["_id"]
-        }, projection={"chat_id": 0, "created_at": 0, "created_by": 0}))
+        **(await chatinfo.get_chat_emotes_async(chat["_id"]))
     })
     return chat, 200
 
@@ -159,36 +156,36 @@ async def update_chat(chat_id, data: ChatBody):
     if not request.user:
         abort(401)
 
-    # Check ratelimit
-    if security.ratelimited(f"update_chat:{request.user}"):
-        abort(429)
-
     # Ratelimit
-    security.ratelimit(f"update_chat:{request.user}", 5, 5)
+    if await security.ratelimit_async(f"update_chat:{request.user}", 5, 5):
+        abort(429)
 
     # Check restrictions
-    if security.is_restricted(request.user, security.Restrictions.EDITING_CHAT_DETAILS):
+    if security.is_restricted(request.user, security.Restrictions.EDITING_CHAT_DETAILS, ban=request.ban):
         return {"error": True, "type": "accountBanned"}, 403
 
-    # Get chat
-    chat = db.chats.find_one({"_id": chat_id, "members": request.user, "deleted": False})
+    # Make sure chat exists and requester is owner
+    chat = await chatinfo.get_member_chat_async(chat_id, request.user)
     if not chat:
         abort(404)
-
-    # Make sure requester is owner
     if chat["owner"] != request.user:
         abort(403)
 
+    # Get chat
+    chat = await adb.chats.find_one({"_id": chat_id})
+    if not chat:
+        abort(404)
+
     # Get updated values
     updated_vals = {"_id": chat_id}
     if data.nickname is not None and chat["nickname"] != data.nickname:
         updated_vals["nickname"] = data.nickname
-        app.supporter.create_post(chat_id, "Server", f"@{request.user} changed the nickname of the group chat to '{data.nickname}'.", chat_members=chat["members"])
+        await run_blocking(app.supporter.create_post, chat_id, "Server", f"@{request.user} changed the nickname of the group chat to '{data.nickname}'.", chat_members=chat["members"])
     if data.icon is not None and chat["icon"] != data.icon:
         # Claim icon (and delete old one)
         if data.icon != "":
             try:
-                claim_file(data.icon, "icons", request.user)
+                await run_blocking(claim_file, data.icon, "icons", request.user)
             except Exception as e:
                 log(f"Unable to claim icon: {e}")
                 return {"error": True, "type": "unableToClaimIcon"}, 500
@@ -196,32 +193,28 @@ async def update_chat(chat_id, data: ChatBody):
                 updated_vals["icon"] = data.icon
         if chat["icon"]:
             try:
-                unclaim_file(chat["icon"])
+                await run_blocking(unclaim_file, chat["icon"])
             except Exception as e:
                 log(f"Unable to delete icon: {e}")
-        app.supporter.create_post(chat_id, "Server", f"@{request.user} changed the icon of the group chat.", chat_members=chat["members"])
+        await run_blocking(app.supporter.create_post, chat_id, "Server", f"@{request.user} changed the icon of the group chat.", chat_members=chat["members"])
     if data.icon_color is not None and chat["icon_color"] != data.icon_color:
         updated_vals["icon_color"] = data.icon_color
         if data.icon is None or chat["icon"] == data.icon:
-            app.supporter.create_post(chat_id, "Server", f"@{request.user} changed the icon of the group chat.", chat_members=chat["members"])
+            await run_blocking(app.supporter.create_post, chat_id, "Server", f"@{request.user} changed the icon of the group chat.", chat_members=chat["members"])
     if data.allow_pinning is not None:
         updated_vals["allow_pinning"] = data.allow_pinning
     
     # Update chat
-    db.chats.update_one({"_id": chat_id}, {"$set": updated_vals})
+    await adb.chats.update_one({"_id": chat_id}, {"$set": updated_vals})
+    await run_blocking(chatinfo.invalidate_chat, chat_id)
 
     # Send update chat event
-    app.cl.send_event("update_chat", updated_vals, usernames=chat["members"])
+    await run_blocking(app.cl.send_event, "update_chat", updated_vals, usernames=chat["members"])
 
     # Return chat
     chat.update({
         "error": False,
-        "emojis": list(db.chat_emojis.find({
-            "chat_id": chat["_id"]
-        }, projection={"chat_id": 0, "created_at": 0, "created_by": 0})),
-        "stickers": list(db.chat_stickers.find({
-            "chat_id": chat["_id"]
-        }, projection={"chat_id": 0, "created_at": 0, "created_by": 0}))
+        **(await chatinfo.get_chat_emotes_async(chat["_id"]))
     })
     return chat, 200
 
@@ -232,61 +225,60 @@ async def leave_chat(chat_id):
     if not request.user:
         abort(401)
 
-    # Check ratelimit
-    if security.ratelimited(f"update_chat:{request.user}"):
-        abort(429)
-
     # Ratelimit
-    security.ratelimit(f"update_chat:{request.user}", 5, 5)
+    if await security.ratelimit_async(f"update_chat:{request.user}", 5, 5):
+        abort(429)
 
     # Get chat
-    chat = db.chats.find_one({"_id": chat_id, "members": request.user, "deleted": False})
+    chat = await chatinfo.get_member_chat_async(chat_id, request.user)
     if not chat:
         abort(404)
 
     if chat["type"] == 0:
-        # Remove member
-        chat["members"].remove(request.user)
+        # Remove member (the cached chat is shared, so it's copied)
+        members = [member for member in chat["members"] if member != request.user]
 
         # Update chat if it's not empty, otherwise delete the chat
-        if len(chat["members"]) > 0:
+        if len(members) > 0:
             # Transfer ownership, if owner
-            if chat["owner"] == request.user:
-                chat["owner"] = chat["members"][0]
+            owner = (members[0] if chat["owner"] == request.user else chat["owner"])
             
             # Update chat
-            db.chats.update_one({"_id": chat_id}, {
-                "$set": {"owner": chat["owner"]},
+            await adb.chats.update_one({"_id": chat_id}, {
+                "$set": {"owner": owner},
                 "$pull": {"members": request.user}
             })
+            await run_blocking(chatinfo.invalidate_chat, chat_id)
 
             # Send update chat event
-            app.cl.send_event("update_chat", {
+            await run_blocking(app.cl.send_event, "update_chat", {
                 "_id": chat_id,
-                "owner": chat["owner"],
-                "members": chat["members"]
-            }, usernames=chat["members"])
+                "owner": owner,
+                "members": members
+            }, usernames=members)
 
             # Send in-chat notification
-            app.supporter.create_post(chat_id, "Server", f"@{request.user} has left the group chat.", chat_members=chat["members"])
+            await run_blocking(app.supporter.create_post, chat_id, "Server", f"@{request.user} has left the group chat.", chat_members=members)
         else:
-            if chat["icon"]:
+            chat = await adb.chats.find_one_and_delete({"_id": chat_id}, projection={"icon": 1})
+            await run_blocking(chatinfo.invalidate_chat, chat_id)
+            if chat and chat["icon"]:
                 try:
-                    unclaim_file(chat["icon"])
+                    await run_blocking(unclaim_file, chat["icon"])
                 except Exception as e:
                     log(f"Unable to delete icon: {e}")
-            db.posts.delete_many({"post_origin": chat_id, "isDeleted": False})
-            db.chats.delete_one({"_id": chat_id})
+            await adb.posts.delete_many({"post_origin": chat_id, "isDeleted": False})
+            await run_blocking(reset_post_counts, chat_id)
     elif chat["type"] == 1:
         # Remove chat from requester's active DMs list
-        db.user_settings.update_one({"_id": request.user}, {
+        await adb.user_settings.update_one({"_id": request.user}, {
             "$pull": {"active_dms": chat_id}
         })
     else:
         abort(500)
 
     # Send delete event to client
-    app.cl.send_event("delete_chat", {"chat_id": chat_id}, usernames=[request.user])
+    await run_blocking(app.cl.send_event, "delete_chat", {"chat_id": chat_id}, usernames=[request.user])
 
     return {"error": False}, 200
 
@@ -297,29 +289,22 @@ async def emit_typing(chat_id):
     if not request.user:
         abort(401)
 
-    # Check ratelimit
-    if security.ratelimited(f"typing:{request.user}"):
-        abort(429)
-
     # Ratelimit
-    security.ratelimit(f"typing:{request.user}", 6, 5)
+    if await security.ratelimit_async(f"typing:{request.user}", 6, 5):
+        abort(429)
 
     # Check restrictions
-    if security.is_restricted(request.user, security.Restrictions.CHAT_POSTS):
+    if security.is_restricted(request.user, security.Restrictions.CHAT_POSTS, ban=request.ban):
         return {"error": True, "type": "accountBanned"}, 403
 
     # Get chat
     if chat_id != "livechat":
-        chat = db.chats.find_one({
-            "_id": chat_id,
-            "members": request.user,
-            "deleted": False
-        }, projection={"members": 1})
+        chat = await chatinfo.get_member_chat_async(chat_id, request.user)
         if not chat:
             abort(404)
 
     # Send typing event
-    app.cl.send_event("typing", {
+    await run_blocking(app.cl.send_event, "typing", {
         "chat_id": chat_id, "username": request.user
     }, usernames=(None if chat_id == "livechat" else chat["members"]))
 
@@ -332,19 +317,16 @@ async def add_chat_member(chat_id, username):
     if not request.user:
         abort(401)
 
-    # Check ratelimit
-    if security.ratelimited(f"update_chat:{request.user}"):
-        abort(429)
-
     # Ratelimit
-    security.ratelimit(f"update_chat:{request.user}", 5, 5)
+    if await security.ratelimit_async(f"update_chat:{request.user}", 5, 5):
+        abort(429)
 
     # Check restrictions
-    if security.is_restricted(request.user, security.Restrictions.NEW_CHATS):
+    if security.is_restricted(request.user, security.Restrictions.NEW_CHATS, ban=request.ban):
         return {"error": True, "type": "accountBanned"}, 403
 
     # Get chat
-    chat = db.chats.find_one({"_id": chat_id, "members": request.user, "deleted": False})
+    chat = await chatinfo.get_member_chat_async(chat_id, request.user)
     if not chat:
         abort(404)
 
@@ -357,51 +339,43 @@ async def add_chat_member(chat_id, username):
         return {"error": True, "type": "chatMemberAlreadyExists"}, 409
 
     # Make sure requested user exists and isn't deleted
-    user = db.usersv0.find_one({"_id": username}, projection={"permissions": 1})
+    user = await adb.usersv0.find_one({"_id": username}, projection={"permissions": 1})
     if (not user) or (user["permissions"] is None):
         abort(404)
 
     # Make sure requested user isn't blocked or is blocking client
-    if db.relationships.count_documents({"$or": [
-        {
-            "_id": {"from": request.user, "to": username},
-            "state": 2
-        },
-        {
-            "_id": {"from": username, "to": request.user},
-            "state": 2
-        }
-    ]}, limit=1) > 0:
+    if await blocks.is_blocked_async(request.user, username):
         abort(403)
 
     # Update chat
-    chat["members"].append(username)
-    db.chats.update_one({"_id": chat_id}, {"$addToSet": {"members": username}})
+    chat = await adb.chats.find_one_and_update(
+        {"_id": chat_id},
+        {"$addToSet": {"members": username}},
+        return_document=pymongo.ReturnDocument.AFTER
+    )
+    await run_blocking(chatinfo.invalidate_chat, chat_id)
+    if not chat:
+        abort(404)
 
     # Send create chat event
-    app.cl.send_event("create_chat", chat, usernames=[username])
+    await run_blocking(app.cl.send_event, "create_chat", chat, usernames=[username])
 
     # Send update chat event
-    app.cl.send_event("update_chat", {
+    await run_blocking(app.cl.send_event, "update_chat", {
         "_id": chat_id,
         "members": chat["members"]
     }, usernames=chat["members"])
 
     # Send inbox message to user
-    app.supporter.create_post("inbox", username, f"You have been added to the group chat '{chat['nickname']}' by @{request.user}!")
+    await run_blocking(app.supporter.create_post, "inbox", username, f"You have been added to the group chat '{chat['nickname']}' by @{request.user}!")
 
     # Send in-chat notification
-    app.supporter.create_post(chat_id, "Server", f"@{request.user} added @{username} to the group chat.", chat_members=chat["members"])
+    await run_blocking(app.supporter.create_post, chat_id, "Server", f"@{request.user} added @{username} to the group chat.", chat_members=chat["members"])
 
     # Return chat
     chat.update({
         "error": False,
-        "emojis": list(db.chat_emojis.find({
-            "chat_id": chat["_id"]
-        }, projection={"chat_id": 0, "created_at": 0, "created_by": 0})),
-        "stickers": list(db.chat_stickers.find({
-            "chat_id": chat["_id"]
-        }, projection={"chat_id": 0, "created_at": 0, "created_by": 0}))
+        **(await chatinfo.get_chat_emotes_async(chat["_id"]))
     })
     return chat, 200
 
@@ -412,20 +386,13 @@ async def remove_chat_member(chat_id, username):
     if not request.user:
         abort(401)
 
-    # Check ratelimit
-    if security.ratelimited(f"update_chat:{request.user}"):
-        abort(429)
-
     # Ratelimit
-    security.ratelimit(f"update_chat:{request.user}", 5, 5)
+    if await security.ratelimit_async(f"update_chat:{request.user}", 5, 5):
+        abort(429)
 
     # Get chat
-    chat = db.chats.find_one({
-        "_id": chat_id,
-        "members": {"$all": [request.user, username]},
-        "deleted": False
-    })
-    if not chat:
+    chat = await chatinfo.get_member_chat_async(chat_id, request.user)
+    if not chat or username not in chat["members"]:
         abort(404)
 
     # Make sure requester is owner
@@ -433,33 +400,34 @@ async def remove_chat_member(chat_id, username):
         abort(403)
 
     # Update chat
-    chat["members"].remove(username)
-    db.chats.update_one({"_id": chat_id}, {"$pull": {"members": username}})
+    chat = await adb.chats.find_one_and_update(
+        {"_id": chat_id},
+        {"$pull": {"members": username}},
+        return_document=pymongo.ReturnDocument.AFTER
+    )
+    await run_blocking(chatinfo.invalidate_chat, chat_id)
+    if not chat:
+        abort(404)
 
     # Send delete chat event to user
-    app.cl.send_event("delete_chat", {"chat_id": chat_id}, usernames=[username])
+    await run_blocking(app.cl.send_event, "delete_chat", {"chat_id": chat_id}, usernames=[username])
 
     # Send update chat event
-    app.cl.send_event("update_chat", {
+    await run_blocking(app.cl.send_event, "update_chat", {
         "_id": chat_id,
         "members": chat["members"]
     }, usernames=chat["members"])
 
     # Send inbox message to user
-    app.supporter.create_post("inbox", username, f"You have been removed from the group chat '{chat['nickname']}' by @{request.user}!")
+    await run_blocking(app.supporter.create_post, "inbox", username, f"You have been removed from the group chat '{chat['nickname']}' by @{request.user}!")
 
     # Send in-chat notification
-    app.supporter.create_post(chat_id, "Server", f"@{request.user} removed @{username} from the group chat.", chat_members=chat["members"])
+    await run_blocking(app.supporter.create_post, chat_id, "Server", f"@{request.user} removed @{username} from the group chat.", chat_members=chat["members"])
 
     # Return chat
     chat.update({
         "error": False,
-        "emojis": list(db.chat_emojis.find({
-            "chat_id": chat["_id"]
-        }, projection={"chat_id": 0, "created_at": 0, "created_by": 0})),
-        "stickers": list(db.chat_stickers.find({
-            "chat_id": chat["_id"]
-        }, projection={"chat_id": 0, "created_at": 0, "created_by": 0}))
+        **(await chatinfo.get_chat_emotes_async(chat["_id"]))
     })
     return chat, 200
 
@@ -470,20 +438,13 @@ async def transfer_chat_ownership(chat_id, username):
     if not request.user:
         abort(401)
 
-    # Check ratelimit
-    if security.ratelimited(f"update_chat:{request.user}"):
-        abort(429)
-
     # Ratelimit
-    security.ratelimit(f"update_chat:{request.user}", 5, 5)
+    if await security.ratelimit_async(f"update_chat:{request.user}", 5, 5):
+        abort(429)
 
     # Get chat
-    chat = db.chats.find_one({
-        "_id": chat_id,
-        "members": {"$all": [request.user, username]},
-        "deleted": False
-    })
-    if not chat:
+    chat = await chatinfo.get_member_chat_async(chat_id, request.user)
+    if not chat or username not in chat["members"]:
         abort(404)
 
     # Make sure requester is owner
@@ -492,66 +453,71 @@ async def transfer_chat_ownership(chat_id, username):
 
     # Make sure requested user isn't already owner
     if chat["owner"] == username:
+        chat = await adb.chats.find_one({"_id": chat_id})
+        if not chat:
+            abort(404)
         chat["error"] = False
         return chat, 200
 
     # Update chat
-    chat["owner"] = username
-    db.chats.update_one({"_id": chat_id}, {"$set": {"owner": username}})
+    chat = await adb.chats.find_one_and_update(
+        {"_id": chat_id},
+        {"$set": {"owner": username}},
+        return_document=pymongo.ReturnDocument.AFTER
+    )
+    await run_blocking(chatinfo.invalidate_chat, chat_id)
+    if not chat:
+        abort(404)
 
     # Send update chat event
-    app.cl.send_event("update_chat", {
+    await run_blocking(app.cl.send_event, "update_chat", {
         "_id": chat_id,
         "owner": chat["owner"]
     }, usernames=chat["members"])
 
     # Send in-chat notification
-    app.supporter.create_post(chat_id, "Server", f"@{request.user} transferred ownership of the group chat to @{username}.", chat_members=chat["members"])
+    await run_blocking(app.supporter.create_post, chat_id, "Server", f"@{request.user} transferred ownership of the group chat to @{username}.", chat_members=chat["members"])
 
     # Return chat
     chat.update({
         "error": False,
-        "emojis": list(db.chat_emojis.find({
-            "chat_id": chat["_id"]
-        }, projection={"chat_id": 0, "created_at": 0, "created_by": 0})),
-        "stickers": list(db.chat_stickers.find({
-            "chat_id": chat["_id"]
-        }, projection={"chat_id": 0, "created_at": 0, "created_by": 0}))
+        **(await chatinfo.get_chat_emotes_async(chat["_id"]))
     })
     return chat, 200
 
 
 @chats_bp.get("/<chat_id>/pins")
 @validate_querystring(GetPostsQueryArgs)
-def get_chat_pins(chat_id, query_args: GetPostsQueryArgs):
+async def get_chat_pins(chat_id, query_args: GetPostsQueryArgs):
     # Check authorization
     if not request.user:
         abort(401)
 
     # Make sure chat exists and requester has access
-    if not db.chats.count_documents({
-        "_id": chat_id,
-        "members": request.user,
-        "deleted": False
-    }, limit=1):
+    if not await chatinfo.get_member_chat_async(chat_id, request.user):
         abort(404)
 
-    # Get and return pinned posts
+    # Make sure only one cursor was specified
+    if query_args.before and query_args.after:
+        abort(400)
+
+    # Get pinned posts
     query = {"post_origin": chat_id, "pinned": True}
+    posts = await get_posts_page(query, query_args.page, query_args.before, query_args.after)
+    if posts is None:
+        abort(404)
+
+    # Return pinned posts
     return {
         "error": False,
-        "autoget": app.supporter.parse_posts_v0(
-            db.posts.find(
-                query,
-                sort=[("t.e", pymongo.DESCENDING)],
-                skip=(query_args.page-1)*25,
-                limit=25
-            ),
+        "autoget": await run_blocking(
+            app.supporter.parse_posts_v0,
+            posts,
             include_replies=True,
             requester=request.user
         ),
         "page#": query_args.page,
-        "pages": (get_total_pages("posts", query) if request.user else 1)
+        "pages": (await get_total_pages("posts", query) if query_args.count else None)
     }, 200
 
 
@@ -566,23 +532,19 @@ async def get_chat_emotes(chat_id: str, emote_type: Literal["emojis", "stickers"
         abort(401)
 
     # Make sure chat exists and requester has access
-    if not db.chats.count_documents({
-        "_id": chat_id,
-        "members": request.user,
-        "deleted": False
-    }, limit=1):
+    if not await chatinfo.get_member_chat_async(chat_id, request.user):
         abort(404)
 
     # Get and return emotes
     return {
         "error": False,
-        "autoget": list(db[f"chat_{emote_type}"].find({
+        "autoget": await adb[f"chat_{emote_type}"].find({
             "chat_id": chat_id
         }, sort=[("created_at", pymongo.DESCENDING)], projection={
             "chat_id": 0,
             "created_at": 0,
             "created_by": 0
-        })),
+        }),
         "page#": 1,
         "pages": 1
     }, 200
@@ -599,15 +561,11 @@ async def get_chat_emote(chat_id: str, emote_type: Literal["emojis", "stickers"]
         abort(401)
 
     # Make sure chat exists and requester has access
-    if not db.chats.count_documents({
-        "_id": chat_id,
-        "members": request.user,
-        "deleted": False
-    }, limit=1):
+    if not await chatinfo.get_member_chat_async(chat_id, request.user):
         abort(404)
 
     # Get emote
-    emote = db[f"chat_{emote_type}"].find_one({
+    emote = await adb[f"chat_{emote_type}"].find_one({
         "_id": emote_id,
         "chat_id": chat_id
     }, projection={"chat_id": 0, "created_at": 0, "created_by": 0})
@@ -630,19 +588,12 @@ async def create_chat_emote(chat_id: str, emote_type: Literal["emojis", "sticker
     if not request.user:
         abort(401)
 
-    # Check ratelimit
-    if security.ratelimited(f"update_chat:{request.user}"):
-        abort(429)
-
     # Ratelimit
-    security.ratelimit(f"update_chat:{request.user}", 5, 5)
+    if await security.ratelimit_async(f"update_chat:{request.user}", 5, 5):
+        abort(429)
 
     # Get chat
-    chat = db.chats.find_one({
-        "_id": chat_id,
-        "members": {"$all": [request.user]},
-        "deleted": False
-    })
+    chat = await chatinfo.get_member_chat_async(chat_id, request.user)
     if not chat:
         abort(404)
 
@@ -652,20 +603,20 @@ async def create_chat_emote(chat_id: str, emote_type: Literal["emojis", "sticker
 
     # Make sure there's not too many emotes in the chat (250 for emojis, 50 for stickers)
     if emote_type == "emojis":
-        if db.chat_emojis.count_documents({"chat_id": chat_id}, limit=250) >= int(os.getenv("CHAT_EMOJIS_LIMIT", 250)):
+        if await adb.chat_emojis.count_documents({"chat_id": chat_id}, limit=250) >= int(os.getenv("CHAT_EMOJIS_LIMIT", 250)):
             return {"error": True, "type": "tooManyEmojis"}, 403
     elif emote_type == "stickers":
-        if db.chat_stickers.count_documents({"chat_id": chat_id}, limit=50) >= int(os.getenv("CHAT_STICKERS_LIMIT", 50)):
+        if await adb.chat_stickers.count_documents({"chat_id": chat_id}, limit=50) >= int(os.getenv("CHAT_STICKERS_LIMIT", 50)):
             return {"error": True, "type": "tooManyStickers"}, 403
 
     # Claim file
     try:
-        claim_file(emote_id, emote_type, request.user)
+        await run_blocking(claim_file, emote_id, emote_type, request.user)
     except Exception as e:
         log(f"Unable to claim emote: {e}")
         return {"error": True, "type": "unableToClaimEmote"}, 500
     else:
-        file = db.files.find_one({"_id": emote_id})
+        file = await adb.files.find_one({"_id": emote_id})
 
     # Fall back to filename if no name is specified
     if not data.name:
@@ -681,10 +632,11 @@ async def create_chat_emote(chat_id: str, emote_type: Literal["emojis", "sticker
         "created_at": int(time.time()),
         "created_by": request.user
     }
-    db[f"chat_{emote_type}"].insert_one(emote)
+    await adb[f"chat_{emote_type}"].insert_one(emote)
+    await run_blocking(chatinfo.invalidate_emotes, chat_id)
     del emote["created_at"]
     del emote["created_by"]
-    app.cl.send_event(f"create_{emote_type[:-1]}", emote, usernames=chat["members"])
+    await run_blocking(app.cl.send_event, f"create_{emote_type[:-1]}", emote, usernames=chat["members"])
 
     # Return new emote
     del emote["chat_id"]
@@ -707,19 +659,12 @@ async def update_chat_emote(chat_id: str, emote_type: Literal["emojis", "sticker
     if not request.user:
         abort(401)
 
-    # Check ratelimit
-    if security.ratelimited(f"update_chat:{request.user}"):
-        abort(429)
-
     # Ratelimit
-    security.ratelimit(f"update_chat:{request.user}", 5, 5)
+    if await security.ratelimit_async(f"update_chat:{request.user}", 5, 5):
+        abort(429)
 
     # Get chat
-    chat = db.chats.find_one({
-        "_id": chat_id,
-        "members": {"$all": [request.user]},
-        "deleted": False
-    })
+    chat = await chatinfo.get_member_chat_async(chat_id, request.user)
     if not chat:
         abort(404)
 
@@ -728,7 +673,7 @@ async def update_chat_emote(chat_id: str, emote_type: Literal["emojis", "sticker
         abort(403)
 
     # Get emote
-    emote = db[f"chat_{emote_type}"].find_one({
+    emote = await adb[f"chat_{emote_type}"].find_one({
         "_id": emote_id,
         "chat_id": chat_id
     }, projection={"chat_id": 0, "created_at": 0, "created_by": 0})
@@ -737,8 +682,9 @@ async def update_chat_emote(chat_id: str, emote_type: Literal["emojis", "sticker
 
     # Update emote name
     emote["name"] = data.name
-    db[f"chat_{emote_type}"].update_one({"_id": emote_id}, {"$set": {"name": data.name}})
-    app.cl.send_event(f"update_{emote_type[:-1]}", {
+    await adb[f"chat_{emote_type}"].update_one({"_id": emote_id}, {"$set": {"name": data.name}})
+    await run_blocking(chatinfo.invalidate_emotes, chat_id)
+    await run_blocking(app.cl.send_event, f"update_{emote_type[:-1]}", {
         "_id": emote_id,
         "chat_id": chat_id,
         "name": data.name
@@ -759,19 +705,12 @@ async def delete_chat_emote(chat_id: str, emote_type: Literal["emojis", "sticker
     if not request.user:
         abort(401)
 
-    # Check ratelimit
-    if security.ratelimited(f"update_chat:{request.user}"):
-        abort(429)
-
     # Ratelimit
-    security.ratelimit(f"update_chat:{request.user}", 5, 5)
+    if await security.ratelimit_async(f"update_chat:{request.user}", 5, 5):
+        abort(429)
 
     # Get chat
-    chat = db.chats.find_one({
-        "_id": chat_id,
-        "members": {"$all": [request.user]},
-        "deleted": False
-    })
+    chat = await chatinfo.get_member_chat_async(chat_id, request.user)
     if not chat:
         abort(404)
 
@@ -780,13 +719,14 @@ async def delete_chat_emote(chat_id: str, emote_type: Literal["emojis", "sticker
         abort(403)
 
     # Delete emote
-    result = db[f"chat_{emote_type}"].delete_one({"_id": emote_id, "chat_id": chat_id})
+    result = await adb[f"chat_{emote_type}"].delete_one({"_id": emote_id, "chat_id": chat_id})
     if not result.deleted_count:
         abort(404)
-    app.cl.send_event(f"delete_{emote_type[:-1]}", {
+    await run_blocking(chatinfo.invalidate_emotes, chat_id)
+    await run_blocking(app.cl.send_event, f"delete_{emote_type[:-1]}", {
         "_id": emote_id,
         "chat_id": chat_id
     }, usernames=chat["members"])
-    unclaim_file(emote_id)
+    await run_blocking(unclaim_file, emote_id)
 
     return {"error": False}, 200
@@ -2,10 +2,11 @@ from quart import Blueprint, current_app as app, request, abort
 from quart_schema import validate_querystring, validate_request
 from pydantic import BaseModel, Field
 from typing import Optional
-import pymongo, copy
+import copy
 
-import security
-from database import db, get_total_pages
+import security, blocks
+from database import adb, run_blocking, get_total_pages, get_posts_page
+from counters import get_visible_post_count
 from uploads import claim_file
 from utils import log
 
@@ -15,6 +16,9 @@ home_bp = Blueprint("home_bp", __name__, url_prefix="/home")
 
 class GetHomeQueryArgs(BaseModel):
     page: Optional[int] = Field(default=1, ge=1)
+    before: Optional[str] = Field(default=None, max_length=50)
+    after: Optional[str] = Field(default=None, max_length=50)
+    count: Optional[bool] = Field(default=True)
 
 class PostBody(BaseModel):
     content: Optional[str] = Field(default="", max_length=4000)
@@ -33,17 +37,32 @@ class PostBody(BaseModel):
 async def get_home_posts(query_args: GetHomeQueryArgs):
     if not request.user:
         query_args.page = 1
+        query_args.before = query_args.after = None
+    if query_args.before and query_args.after:
+        abort(400)
+
+    # Get posts
     query = {"post_origin": "home", "isDeleted": False}
+    hidden_users = await blocks.get_hidden_users(request.user)
+    if hidden_users:
+        query["u"] = {"$nin": hidden_users}
+    posts = await get_posts_page(query, query_args.page, query_args.before, query_args.after)
+    if posts is None:
+        abort(404)
+
+    # Return posts
+    if not request.user:
+        pages = 1
+    elif query_args.count:
+        item_count = await run_blocking(get_visible_post_count, "home", hidden_users)
+        pages = await get_total_pages("posts", query, item_count=item_count)
+    else:
+        pages = None
     return {
         "error": False,
-        "autoget": app.supporter.parse_posts_v0(db.posts.find(
-            query,
-            sort=[("t.e", pymongo.DESCENDING)],
-            skip=(query_args.page-1)*25,
-            limit=25
-        ), requester=request.user),
+        "autoget": await run_blocking(app.supporter.parse_posts_v0, posts, requester=request.user),
         "page#": query_args.page,
-        "pages": (get_total_pages("posts", query) if request.user else 1)
+        "pages": pages
     }, 200
 
 
@@ -55,15 +74,12 @@ async def create_home_post(data: PostBody):
         abort(401)
 
     if not (request.flags & security.UserFlags.POST_RATELIMIT_BYPASS):
-        # Check ratelimit
-        if security.ratelimited(f"post:{request.user}"):
-            abort(429)
-
         # Ratelimit
-        security.ratelimit(f"post:{request.user}", 6, 5)
+        if await security.ratelimit_async(f"post:{request.user}", 6, 5):
+            abort(429)
 
     # Check restrictions
-    if security.is_restricted(request.user, security.Restrictions.HOME_POSTS):
+    if security.is_restricted(request.user, security.Restrictions.HOME_POSTS, ban=request.ban):
         return {"error": True, "type": "accountBanned"}, 403
 
     # Make sure there's not too many attachments
@@ -80,13 +96,13 @@ async def create_home_post(data: PostBody):
     
     # Make sure stickers exist
     for sticker_id in copy.copy(data.stickers):
-        if not db.chat_stickers.count_documents({"_id": sticker_id}, limit=1):
+        if not await adb.chat_stickers.count_documents({"_id": sticker_id}, limit=1):
             data.stickers.remove(sticker_id)
 
     # Make sure replied to post IDs exist and are unique
     unique_reply_to_post_ids = []
     for post_id in data.reply_to:
-        if db.posts.count_documents({"_id": post_id, "post_origin": "home"}, limit=1) and \
+        if await adb.posts.count_documents({"_id": post_id, "post_origin": "home"}, limit=1) and \
             post_id not in unique_reply_to_post_ids:
             unique_reply_to_post_ids.append(post_id)
 
@@ -96,7 +112,7 @@ async def create_home_post(data: PostBody):
         if attachment_id in attachments:
             continue
         try:
-            claim_file(attachment_id, "attachments", request.user)
+            await run_blocking(claim_file, attachment_id, "attachments", request.user)
         except Exception as e:
             log(f"Unable to claim attachment: {e}")
             return {"error": True, "type": "unableToClaimAttachment"}, 500
@@ -108,7 +124,8 @@ async def create_home_post(data: PostBody):
         abort(400)
 
     # Create post
-    post = app.supporter.create_post(
+    post = await run_blocking(
+        app.supporter.create_post,
         "home",
         request.user,
         data.content,
@@ -120,7 +137,7 @@ async def create_home_post(data: PostBody):
 
     # Return new post
     post["error"] = False
-    return app.supporter.parse_posts_v0([post], requester=request.user)[0], 200
+    return post, 200
 
 
 @home_bp.post("/typing")
@@ -129,18 +146,15 @@ async def emit_typing():
     if not request.user:
         abort(401)
 
-    # Check ratelimit
-    if security.ratelimited(f"typing:{request.user}"):
-        abort(429)
-
     # Ratelimit
-    security.ratelimit(f"typing:{request.user}", 6, 5)
+    if await security.ratelimit_async(f"typing:{request.user}", 6, 5):
+        abort(429)
 
     # Check restrictions
-    if security.is_restricted(request.user, security.Restrictions.HOME_POSTS):
+    if security.is_restricted(request.user, security.Restrictions.HOME_POSTS, ban=request.ban):
         return {"error": True, "type": "accountBanned"}, 403
 
     # Send new state
-    app.cl.send_event("typing", {"chat_id": "home", "username": request.user})
+    await run_blocking(app.cl.send_event, "typing", {"chat_id": "home", "username": request.user})
 
     return {"error": False}, 200
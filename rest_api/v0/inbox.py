@@ -2,9 +2,9 @@ from quart import Blueprint, request, abort, current_app as app
 from quart_schema import validate_querystring
 from pydantic import BaseModel, Field
 from typing import Optional
-import pymongo
 
-from database import db, get_total_pages
+from database import run_blocking, get_total_pages, get_posts_page
+from counters import get_post_count
 
 
 inbox_bp = Blueprint("inbox_bp", __name__, url_prefix="/inbox")
@@ -12,6 +12,9 @@ inbox_bp = Blueprint("inbox_bp", __name__, url_prefix="/inbox")
 
 class GetInboxQueryArgs(BaseModel):
     page: Optional[int] = Field(default=1, ge=1)
+    before: Optional[str] = Field(default=None, max_length=50)
+    after: Optional[str] = Field(default=None, max_length=50)
+    count: Optional[bool] = Field(default=True)
 
 
 @inbox_bp.get("/")
@@ -21,16 +24,27 @@ async def get_inbox_posts(query_args: GetInboxQueryArgs):
     if not request.user:
         abort(401)
 
-    # Get and return posts
+    # Make sure only one cursor was specified
+    if query_args.before and query_args.after:
+        abort(400)
+
+    # Get posts
     query = {"$or": [{"u": request.user}, {"u": "Server"}], "post_origin": "inbox", "isDeleted": False}
+    posts = await get_posts_page(query, query_args.page, query_args.before, query_args.after)
+    if posts is None:
+        abort(404)
+
+    # Return posts
+    if query_args.count:
+        pages = await get_total_pages("posts", query, item_count=(
+            await run_blocking(get_post_count, "inbox", request.user) +
+            await run_blocking(get_post_count, "inbox", "Server")
+        ))
+    else:
+        pages = None
     return {
         "error": False,
-        "autoget": app.supporter.parse_posts_v0(db.posts.find(
-            query,
-            sort=[("t.e", pymongo.DESCENDING)],
-            skip=(query_args.page-1)*25,
-            limit=25
-        ), requester=request.user),
+        "autoget": await run_blocking(app.supporter.parse_posts_v0, posts, requester=request.user),
         "page#": query_args.page,
-        "pages": (get_total_pages("posts", query) if request.user else 1)
+        "pages": pages
     }, 200
\ No newline at end of file
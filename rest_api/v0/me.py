@@ -11,8 +11,8 @@ import qrcode, qrcode.image.svg
 import uuid
 import secrets
 
-import security
-from database import db, rdb, get_total_pages
+import security, passwords
+from database import adb, ardb, run_blocking, get_total_pages
 from uploads import claim_file, unclaim_file
 from utils import log
 
@@ -74,7 +74,7 @@ async def get_me():
         abort(401)
         
     # Get and return account
-    return {"error": False, **security.get_account(request.user, include_config=True)}, 200
+    return {"error": False, **(await run_blocking(security.get_account, request.user, include_config=True))}, 200
 
 
 @me_bp.delete("/")
@@ -85,27 +85,27 @@ async def delete_account(data: DeleteAccountBody):
         abort(401)
 
     # Check ratelimit
-    if security.ratelimited(f"login:u:{request.user}"):
+    if await security.ratelimited_async(f"login:u:{request.user}"):
         abort(429)
 
     # Check password
-    account = db.usersv0.find_one({"_id": request.user}, projection={"pswd": 1})
-    if not security.check_password_hash(data.password, account["pswd"]):
-        security.ratelimit(f"login:u:{request.user}", 5, 60)
+    account = await adb.usersv0.find_one({"_id": request.user}, projection={"pswd": 1})
+    if not await passwords.check_password_async(data.password, account["pswd"]):
+        await security.ratelimit_async(f"login:u:{request.user}", 5, 60)
         return {"error": True, "type": "invalidCredentials"}, 401
 
     # Schedule account for deletion
-    db.usersv0.update_one({"_id": request.user}, {"$set": {
+    await adb.usersv0.update_one({"_id": request.user}, {"$set": {
         "tokens": [],
         "delete_after": int(time.time())
     }})
+    await run_blocking(security.invalidate_tokens, request.user)
 
     # Disconnect clients
-    for client in app.cl.usernames.get(request.user, []):
-        client.kick()
+    await run_blocking(app.cl.kick_users, [request.user])
 
     # Delete account
-    security.delete_account(request.user)
+    await run_blocking(security.delete_account, request.user)
 
     return {"error": False}, 200
 
@@ -117,12 +117,9 @@ async def update_config(data: UpdateConfigBody):
     if not request.user:
         abort(401)
 
-    # Check ratelimit
-    if security.ratelimited(f"config:{request.user}"):
-        abort(429)
-    
     # Ratelimit
-    security.ratelimit(f"config:{request.user}", 10, 5)
+    if await security.ratelimit_async(f"config:{request.user}", 10, 5):
+        abort(429)
 
     # Get new config
     new_config = data.model_dump()
@@ -133,7 +130,7 @@ async def update_config(data: UpdateConfigBody):
             del new_config[k]
 
     # Delete updated profile data if account is restricted
-    if security.is_restricted(request.user, security.Restrictions.EDITING_PROFILE):
+    if security.is_restricted(request.user, security.Restrictions.EDITING_PROFILE, ban=request.ban):
         if "pfp_data" in new_config:
             del new_config["pfp_data"]
         if "avatar" in new_config:
@@ -145,24 +142,24 @@ async def update_config(data: UpdateConfigBody):
 
     # Claim avatar (and delete old one)
     if "avatar" in new_config:
-        cur_avatar = db.usersv0.find_one({"_id": request.user}, projection={"avatar": 1})["avatar"]
+        cur_avatar = (await adb.usersv0.find_one({"_id": request.user}, projection={"avatar": 1}))["avatar"]
         if new_config["avatar"] != "":
             try:
-                claim_file(new_config["avatar"], "icons", request.user)
+                await run_blocking(claim_file, new_config["avatar"], "icons", request.user)
             except Exception as e:
                 log(f"Unable to claim avatar: {e}")
                 return {"error": True, "type": "unableToClaimAvatar"}, 500
         if cur_avatar:
             try:
-                unclaim_file(cur_avatar)
+                await run_blocking(unclaim_file, cur_avatar)
             except Exception as e:
                 log(f"Unable to delete avatar: {e}")
 
     # Update config
-    security.update_settings(request.user, new_config)
+    await run_blocking(security.update_settings, request.user, new_config)
 
     # Sync config between sessions
-    app.cl.send_event("update_config", new_config, usernames=[request.user])
+    await run_blocking(app.cl.send_event, "update_config", new_config, usernames=[request.user])
 
     # Send updated pfp and quote to other clients
     updated_profile_data = {"_id": request.user}
@@ -175,7 +172,7 @@ async def update_config(data: UpdateConfigBody):
     if "quote" in new_config:
         updated_profile_data["quote"] = new_config["quote"]
     if len(updated_profile_data) > 1:
-        app.cl.send_event("update_profile", updated_profile_data)
+        await run_blocking(app.cl.send_event, "update_profile", updated_profile_data)
 
     return {"error": False}, 200
 
@@ -188,11 +185,7 @@ async def get_relationships():
 
     return {
         "error": False,
-        "autoget": [{
-            "username": r["_id"]["to"],
-            "state": r["state"],
-            "updated_at": r["updated_at"]
-        } for r in db.relationships.find({"_id.from": request.user})],
+        "autoget": await run_blocking(security.get_relationships, request.user),
         "page#": 1,
         "pages": 1
     }, 200
@@ -206,20 +199,21 @@ async def change_password(data: ChangePasswordBody):
         abort(401)
 
     # Check ratelimit
-    if security.ratelimited(f"login:u:{request.user}"):
+    if await security.ratelimited_async(f"login:u:{request.user}"):
         abort(429)
 
     # Check password
-    account = db.usersv0.find_one({"_id": request.user}, projection={"pswd": 1})
-    if not security.check_password_hash(data.old, account["pswd"]):
-        security.ratelimit(f"login:u:{request.user}", 5, 60)
+    account = await adb.usersv0.find_one({"_id": request.user}, projection={"pswd": 1})
+    if not await passwords.check_password_async(data.old, account["pswd"]):
+        await security.ratelimit_async(f"login:u:{request.user}", 5, 60)
         return {"error": True, "type": "invalidCredentials"}, 401
 
     # Update password
-    db.usersv0.update_one({"_id": request.user}, {"$set": {"pswd": security.hash_password(data.new)}})
+    await adb.usersv0.update_one({"_id": request.user}, {"$set": {"pswd": await passwords.hash_password_async(data.new)}})
+    await run_blocking(security.invalidate_tokens, request.user)
 
     # Send alert
-    app.supporter.create_post("inbox", account["_id"], "Your account password has been changed. If this wasn't requested by you, please secure your account immediately.")
+    await run_blocking(app.supporter.create_post, "inbox", account["_id"], "Your account password has been changed. If this wasn't requested by you, please secure your account immediately.")
 
     return {"error": False}, 200
 
@@ -228,12 +222,12 @@ async def change_password(data: ChangePasswordBody):
 async def get_authenticators():
     return {
         "error": False,
-        "autoget": list(db.authenticators.find({"user": request.user}, projection={
+        "autoget": await adb.authenticators.find({"user": request.user}, projection={
             "_id": 1,
             "type": 1,
             "nickname": 1,
             "registered_at": 1,
-        })),
+        }),
         "page#": 1,
         "pages": 1
     }, 200
@@ -254,13 +248,13 @@ async def add_authenticator(data: AddAuthenticatorBody):
         abort(400)
 
     # Check ratelimit
-    if security.ratelimited(f"login:u:{request.user}"):
+    if await security.ratelimited_async(f"login:u:{request.user}"):
         abort(429)
 
     # Check password
-    account = db.usersv0.find_one({"_id": request.user}, projection={"pswd": 1, "mfa_recovery_code": 1})
-    if not security.check_password_hash(data.password, account["pswd"]):
-        security.ratelimit(f"login:u:{request.user}", 5, 60)
+    account = await adb.usersv0.find_one({"_id": request.user}, projection={"pswd": 1, "mfa_recovery_code": 1})
+    if not await passwords.check_password_async(data.password, account["pswd"]):
+        await security.ratelimit_async(f"login:u:{request.user}", 5, 60)
         return {"error": True, "type": "invalidCredentials"}, 401
     
     # Register
@@ -272,10 +266,10 @@ async def add_authenticator(data: AddAuthenticatorBody):
         "totp_secret": data.totp_secret,
         "registered_at": int(time.time())
     }
-    db.authenticators.insert_one(authenticator)
+    await adb.authenticators.insert_one(authenticator)
 
     # Send alert
-    app.supporter.create_post("inbox", account["_id"], "A multi-factor authenticator has been added to your account. If this wasn't requested by you, please secure your account immediately.")
+    await run_blocking(app.supporter.create_post, "inbox", account["_id"], "A multi-factor authenticator has been added to your account. If this wasn't requested by you, please secure your account immediately.")
 
     # Return authenticator and MFA recovery code
     del authenticator["user"]
@@ -295,7 +289,7 @@ async def update_authenticator(authenticator_id: str, data: UpdateAuthenticatorB
         abort(401)
 
     # Get authenticator
-    authenticator = db.authenticators.find_one({
+    authenticator = await adb.authenticators.find_one({
         "_id": authenticator_id,
         "user": request.user
     }, projection={
@@ -312,7 +306,7 @@ async def update_authenticator(authenticator_id: str, data: UpdateAuthenticatorB
     if data.nickname:
         updated["nickname"] = data.nickname
     authenticator.update(updated)
-    db.authenticators.update_one({
+    await adb.authenticators.update_one({
         "_id": authenticator_id,
         "user": request.user
     }, {"$set": updated})
@@ -328,17 +322,17 @@ async def remove_authenticator(authenticator_id: str, data: RemoveAuthenticatorB
         abort(401)
 
     # Check ratelimit
-    if security.ratelimited(f"login:u:{request.user}"):
+    if await security.ratelimited_async(f"login:u:{request.user}"):
         abort(429)
 
     # Check password
-    account = db.usersv0.find_one({"_id": request.user}, projection={"pswd": 1, "mfa_recovery_code": 1})
-    if not security.check_password_hash(data.password, account["pswd"]):
-        security.ratelimit(f"login:u:{request.user}", 5, 60)
+    account = await adb.usersv0.find_one({"_id": request.user}, projection={"pswd": 1, "mfa_recovery_code": 1})
+    if not await passwords.check_password_async(data.password, account["pswd"]):
+        await security.ratelimit_async(f"login:u:{request.user}", 5, 60)
         return {"error": True, "type": "invalidCredentials"}, 401
 
     # Unregister
-    result = db.authenticators.delete_one({
+    result = await adb.authenticators.delete_one({
         "_id": authenticator_id,
         "user": request.user
     })
@@ -346,7 +340,7 @@ async def remove_authenticator(authenticator_id: str, data: RemoveAuthenticatorB
         abort(404)
 
     # Send alert
-    app.supporter.create_post("inbox", account["_id"], "A multi-factor authenticator has been removed from your account. If this wasn't requested by you, please secure your account immediately.")
+    await run_blocking(app.supporter.create_post, "inbox", account["_id"], "A multi-factor authenticator has been removed from your account. If this wasn't requested by you, please secure your account immediately.")
 
     return {"error": False}
 
@@ -380,17 +374,17 @@ async def reset_mfa_recovery_code(data: ResetMFARecoveryCodeBody):
         abort(401)
 
     # Check password
-    account = db.usersv0.find_one({"_id": request.user}, projection={"pswd": 1})
-    if not security.check_password_hash(data.password, account["pswd"]):
-        security.ratelimit(f"login:u:{request.user}", 5, 60)
+    account = await adb.usersv0.find_one({"_id": request.user}, projection={"pswd": 1})
+    if not await passwords.check_password_async(data.password, account["pswd"]):
+        await security.ratelimit_async(f"login:u:{request.user}", 5, 60)
         return {"error": True, "type": "invalidCredentials"}, 401
     
     # Reset MFA recovery code
     mfa_recovery_code = secrets.token_hex(5)
-    db.usersv0.update_one({"_id": request.user}, {"$set": {"mfa_recovery_code": mfa_recovery_code}})
+    await adb.usersv0.update_one({"_id": request.user}, {"$set": {"mfa_recovery_code": mfa_recovery_code}})
 
     # Send alert
-    app.supporter.create_post("inbox", account["_id"], "Your multi-factor authentication recovery code has been reset. If this wasn't requested by you, please secure your account immediately.")
+    await run_blocking(app.supporter.create_post, "inbox", account["_id"], "Your multi-factor authentication recovery code has been reset. If this wasn't requested by you, please secure your account immediately.")
 
     return {"error": False, "mfa_recovery_code": mfa_recovery_code}
 
@@ -402,11 +396,11 @@ async def delete_tokens():
         abort(401)
     
     # Revoke tokens
-    db.usersv0.update_one({"_id": request.user}, {"$set": {"tokens": []}})
+    await adb.usersv0.update_one({"_id": request.user}, {"$set": {"tokens": []}})
+    await run_blocking(security.invalidate_tokens, request.user)
 
     # Disconnect clients
-    for client in app.cl.usernames.get(request.user, []):
-        client.kick()
+    await run_blocking(app.cl.kick_users, [request.user])
 
     return {"error": False}, 200
 
@@ -420,7 +414,7 @@ async def get_report_history(query_args: GetReportsQueryArgs):
 
     # Get reports
     reports = list(
-        db.reports.find(
+        await adb.reports.find(
             {"reports.user": request.user},
             projection={"escalated": 0},
             sort=[("reports.time", pymongo.DESCENDING)],
@@ -441,21 +435,24 @@ async def get_report_history(query_args: GetReportsQueryArgs):
         del report["reports"]
 
     # Get content
+    accounts = await run_blocking(security.get_accounts, [
+        report.get("content_id") for report in reports if report["type"] == "user"
+    ])
     for report in reports:
         if report["type"] == "post":
-            report["content"] = db.posts.find_one(
+            report["content"] = await adb.posts.find_one(
                 {"_id": report.get("content_id")},
                 projection={"_id": 1, "u": 1, "isDeleted": 1}
             )
         elif report["type"] == "user":
-            report["content"] = security.get_account(report.get("content_id"))
+            report["content"] = accounts.get(report.get("content_id"))
 
     # Return reports
     return {
         "error": False,
         "autoget": reports,
         "page#": query_args.page,
-        "pages": get_total_pages("reports", {"reports.user": request.user}),
+        "pages": await get_total_pages("reports", {"reports.user": request.user}),
     }, 200
 
 
@@ -466,7 +463,7 @@ async def get_current_data_export():
         abort(401)
 
     # Get current data export request from the database
-    data_export = db.data_exports.find_one({
+    data_export = await adb.data_exports.find_one({
         "user": request.user,
         "$or": [
             {"status": "pending"},
@@ -487,7 +484,7 @@ async def request_data_export():
         abort(401)
 
     # Make sure a current data export request doesn't already exist
-    if db.data_exports.count_documents({
+    if await adb.data_exports.count_documents({
         "user": request.user,
         "$or": [
             {"status": "pending"},
@@ -503,10 +500,10 @@ async def request_data_export():
         "status": "pending",
         "created_at": int(time.time())
     }
-    db.data_exports.insert_one(data_export)
+    await adb.data_exports.insert_one(data_export)
 
     # Tell the data export service to check for new requests
-    rdb.publish("data_exports", "0")
+    await ardb.publish("data_exports", "0")
 
     # Return data export request
     return data_export, 200
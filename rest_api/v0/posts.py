@@ -2,12 +2,12 @@ from quart import Blueprint, current_app as app, request, abort
 from quart_schema import validate_querystring, validate_request
 from pydantic import BaseModel, Field
 from typing import Optional
-from threading import Thread
 from copy import copy
-import pymongo, uuid, time, emoji, msgpack
+import pymongo, uuid, time, emoji
 
-import security
-from database import db, rdb, get_total_pages
+import security, automod, chatinfo, blocks
+from database import db, adb, run_blocking, get_total_pages, get_posts_page, get_expiry
+from counters import get_post_count, incr_post_count, incr_reaction_count
 from uploads import claim_file, unclaim_file
 from utils import log
 
@@ -21,6 +21,12 @@ class PostIdQueryArgs(BaseModel):
 class PagedQueryArgs(BaseModel):
     page: Optional[int] = Field(default=1, ge=1)
 
+class GetPostsQueryArgs(BaseModel):
+    page: Optional[int] = Field(default=1, ge=1)
+    before: Optional[str] = Field(default=None, max_length=50)
+    after: Optional[str] = Field(default=None, max_length=50)
+    count: Optional[bool] = Field(default=True)
+
 class PostBody(BaseModel):
     content: Optional[str] = Field(default="", max_length=4000)
     nonce: Optional[str] = Field(default=None, max_length=64)
@@ -45,7 +51,7 @@ class ReportBody(BaseModel):
 @validate_querystring(PostIdQueryArgs)
 async def get_post(query_args: PostIdQueryArgs):    
     # Get post
-    post = db.posts.find_one({"_id": query_args.id, "isDeleted": False})
+    post = await adb.posts.find_one({"_id": query_args.id, "isDeleted": False})
     if not post:
         abort(404)
 
@@ -53,16 +59,12 @@ async def get_post(query_args: PostIdQueryArgs):
     if (post["post_origin"] == "inbox") and (post["u"] not in ["Server", request.user]):
         abort(404)
     elif post["post_origin"] not in ["home", "inbox"]:
-        if not db.chats.count_documents({
-            "_id": post["post_origin"],
-            "members": request.user,
-            "deleted": False
-        }, limit=1):
+        if not await chatinfo.get_member_chat_async(post["post_origin"], request.user):
             abort(404)
     
     # Return post
     post["error"] = False
-    return app.supporter.parse_posts_v0([post], requester=request.user)[0], 200
+    return (await run_blocking(app.supporter.parse_posts_v0, [post], requester=request.user))[0], 200
 
 
 @posts_bp.patch("/")
@@ -74,15 +76,12 @@ async def update_post(query_args: PostIdQueryArgs, data: PostBody):
         abort(401)
 
     if not (request.flags & security.UserFlags.POST_RATELIMIT_BYPASS):
-        # Check ratelimit
-        if security.ratelimited(f"post:{request.user}"):
-            abort(429)
-
         # Ratelimit
-        security.ratelimit(f"post:{request.user}", 6, 5)
+        if await security.ratelimit_async(f"post:{request.user}", 6, 5):
+            abort(429)
     
     # Get post
-    post = db.posts.find_one({"_id": query_args.id, "isDeleted": False})
+    post = await adb.posts.find_one({"_id": query_args.id, "isDeleted": False})
     if not post:
         abort(404)
 
@@ -90,11 +89,7 @@ async def update_post(query_args: PostIdQueryArgs, data: PostBody):
     if (post["post_origin"] == "inbox") and (post["u"] != request.user):
         abort(404)
     elif post["post_origin"] not in ["home", "inbox"]:
-        chat = db.chats.find_one({
-            "_id": post["post_origin"],
-            "members": request.user,
-            "deleted": False
-        })
+        chat = await chatinfo.get_member_chat_async(post["post_origin"], request.user)
         if not chat:
             abort(404)
 
@@ -103,15 +98,15 @@ async def update_post(query_args: PostIdQueryArgs, data: PostBody):
         abort(403)
 
     # Check restrictions
-    if post["post_origin"] == "home" and security.is_restricted(request.user, security.Restrictions.HOME_POSTS):
+    if post["post_origin"] == "home" and security.is_restricted(request.user, security.Restrictions.HOME_POSTS, ban=request.ban):
         return {"error": True, "type": "accountBanned"}, 403
-    elif post["post_origin"] != "home" and security.is_restricted(request.user, security.Restrictions.CHAT_POSTS):
+    elif post["post_origin"] != "home" and security.is_restricted(request.user, security.Restrictions.CHAT_POSTS, ban=request.ban):
         return {"error": True, "type": "accountBanned"}, 403
 
     # Make sure new content isn't the same as the old content
     if post["p"] == data.content:
         post["error"] = False
-        return app.supporter.parse_posts_v0([post], requester=request.user)[0], 200
+        return (await run_blocking(app.supporter.parse_posts_v0, [post], requester=request.user))[0], 200
 
     # Make sure the post has text content
     if not data.content:
@@ -131,41 +126,43 @@ async def update_post(query_args: PostIdQueryArgs, data: PostBody):
     # Update post
     post["edited_at"] = int(time.time())
     post["p"] = data.content
-    db.posts.update_one({"_id": query_args.id}, {"$set": {
+    await adb.posts.update_one({"_id": query_args.id}, {"$set": {
         "p": post["p"],
         "edited_at": post["edited_at"]
     }})
 
     # Send update post event
-    app.cl.send_event("update_post", post, usernames=(None if post["post_origin"] == "home" else chat["members"]))
+    post = (await run_blocking(app.supporter.parse_posts_v0, [post]))[0]
+    await run_blocking(app.cl.send_event, "update_post", post, usernames=(None if post["post_origin"] == "home" else chat["members"]))
 
     # Return post
+    await run_blocking(app.supporter.add_user_reactions, [post], request.user)
     post["error"] = False
-    return app.supporter.parse_posts_v0([post], requester=request.user)[0], 200
+    return post, 200
 
 @posts_bp.post("/<post_id>/report")
 @validate_request(ReportBody)
 async def report_post(post_id, data: ReportBody):
     if not request.user:
         abort(401)
-    post = db.posts.find_one({"_id": post_id})
+    post = await adb.posts.find_one({"_id": post_id})
     if not post:
         abort(404)
 
     # Send to files automod if there are attachments
     if len(post["attachments"]):
-        rdb.publish("automod:files", msgpack.packb({
-            "type": 2,
-            "username": post["u"],
-            "file_bucket": "attachments",
-            "file_hashes": [file["hash"] for file in db.files.find({"_id": {"$in": post["attachments"]}})],
-            "post_id": post["_id"],
-            "post_content": post["p"]
-        }))
-
-    security.ratelimit(f"report:{request.user}", 3, 5)
+        await run_blocking(
+            automod.submit_files,
+            automod.REPORTED_POST,
+            post["u"],
+            post["_id"],
+            post["p"],
+            file_ids=post["attachments"]
+        )
+
+    await security.ratelimit_async(f"report:{request.user}", 3, 5)
     
-    report = db.reports.find_one({
+    report = await adb.reports.find_one({
         "content_id": post_id,
         "status": "pending",
         "type": "post"
@@ -194,17 +191,20 @@ async def report_post(post_id, data: ReportBody):
         "time": int(time.time())
     })
 
-    db.reports.update_one({"_id": report["_id"]}, {"$set": report}, upsert=True)
+    await adb.reports.update_one({"_id": report["_id"]}, {"$set": report}, upsert=True)
 
     unique_ips = set([_report["ip"] for _report in report["reports"]])
 
     if report["status"] == "pending" and not report["escalated"] and len(unique_ips) >= 3:
-        db.reports.update_one({"_id": report["_id"]}, {"$set": {"escalated": True}})
-        db.posts.update_one({"_id": post_id, "isDeleted": False}, {"$set": {
+        await adb.reports.update_one({"_id": report["_id"]}, {"$set": {"escalated": True}})
+        result = await adb.posts.update_one({"_id": post_id, "isDeleted": False}, {"$set": {
             "isDeleted": True,
             "mod_deleted": True,
-            "deleted_at": int(time.time())
+            "deleted_at": int(time.time()),
+            "expires_at": get_expiry()
         }})
+        if result.modified_count:
+            await run_blocking(incr_post_count, post["post_origin"], post["u"], -1)
 
     return {"error": False}, 200
 
@@ -213,35 +213,33 @@ async def report_post(post_id, data: ReportBody):
 async def pin_post(post_id):
     if not request.user:
         abort(401)
-    post = db.posts.find_one({"_id": post_id})
+    post = await adb.posts.find_one({"_id": post_id})
     if not post:
         abort(404)
-    query = {"_id": post["post_origin"]}
 
     has_perm = security.has_permission(request.permissions, security.AdminPermissions.EDIT_CHATS)
-    if not has_perm:
-        query["members"] = request.user
-        query["deleted"] = False
-
-
-
-    chat = db.chats.find_one(query)
+    if has_perm:
+        chat = await chatinfo.get_chat_async(post["post_origin"], include_deleted=True)
+    else:
+        chat = await chatinfo.get_member_chat_async(post["post_origin"], request.user)
     if not chat:
         abort(401)
 
     if not (request.user == chat["owner"] or chat["allow_pinning"] or has_perm):
         abort(401)
 
-    db.posts.update_one({"_id": post_id}, {"$set": {
+    await adb.posts.update_one({"_id": post_id}, {"$set": {
         "pinned": True
     }})
 
     post["pinned"] = True
 
-    app.cl.send_event("update_post", post, usernames=(None if post["post_origin"] == "home" else chat["members"]))
+    post = (await run_blocking(app.supporter.parse_posts_v0, [post]))[0]
+    await run_blocking(app.cl.send_event, "update_post", post, usernames=(None if post["post_origin"] == "home" else chat["members"]))
 
+    await run_blocking(app.supporter.add_user_reactions, [post], request.user)
     post["error"] = False
-    return app.supporter.parse_posts_v0([post], requester=request.user)[0], 200
+    return post, 200
 
 
 @posts_bp.delete("/<post_id>/pin")
@@ -249,17 +247,15 @@ async def unpin_post(post_id):
     if not request.user:
         abort(401)
 
-    post = db.posts.find_one({"_id": post_id})
+    post = await adb.posts.find_one({"_id": post_id})
     if not post:
         abort(404)
 
-    query = {"_id": post["post_origin"]}
     has_perm = security.has_permission(request.permissions, security.AdminPermissions.EDIT_CHATS)
-    if not has_perm:
-        query["members"] = request.user
-        query["deleted"] = False
-
-    chat = db.chats.find_one(query)
+    if has_perm:
+        chat = await chatinfo.get_chat_async(post["post_origin"], include_deleted=True)
+    else:
+        chat = await chatinfo.get_member_chat_async(post["post_origin"], request.user)
     if not chat:
         abort(401)
 
@@ -267,16 +263,18 @@ async def unpin_post(post_id):
         abort(401)
 
 
-    db.posts.update_one({"_id": post_id}, {"$set": {
+    await adb.posts.update_one({"_id": post_id}, {"$set": {
         "pinned": False
     }})
 
     post["pinned"] = False
 
-    app.cl.send_event("update_post", post, usernames=(None if post["post_origin"] == "home" else chat["members"]))
+    post = (await run_blocking(app.supporter.parse_posts_v0, [post]))[0]
+    await run_blocking(app.cl.send_event, "update_post", post, usernames=(None if post["post_origin"] == "home" else chat["members"]))
 
+    await run_blocking(app.supporter.add_user_reactions, [post], request.user)
     post["error"] = False
-    return app.supporter.parse_posts_v0([post], requester=request.user)[0], 200
+    return post, 200
 
 
 @posts_bp.delete("/<post_id>/attachments/<attachment_id>")
@@ -286,7 +284,7 @@ async def delete_attachment(post_id: str, attachment_id: str):
         abort(401)
     
     # Get post
-    post = db.posts.find_one({"_id": post_id, "isDeleted": False})
+    post = await adb.posts.find_one({"_id": post_id, "isDeleted": False})
     if not post:
         abort(404)
 
@@ -294,11 +292,7 @@ async def delete_attachment(post_id: str, attachment_id: str):
     if (post["post_origin"] == "inbox") and (post["u"] != request.user):
         abort(404)
     elif post["post_origin"] not in ["home", "inbox"]:
-        chat = db.chats.find_one({
-            "_id": post["post_origin"],
-            "members": request.user,
-            "deleted": False
-        })
+        chat = await chatinfo.get_member_chat_async(post["post_origin"], request.user)
         if not chat:
             abort(404)
 
@@ -309,34 +303,39 @@ async def delete_attachment(post_id: str, attachment_id: str):
     # Delete attachment
     if attachment_id in post["attachments"]:
         post["attachments"].remove(attachment_id)
-        unclaim_file(attachment_id)
+        await run_blocking(unclaim_file, attachment_id)
     else:
         abort(404)
 
     if post["p"] or post["attachments"] > 0:
         # Update post
-        db.posts.update_one({"_id": post_id}, {"$set": {
+        await adb.posts.update_one({"_id": post_id}, {"$set": {
             "attachments": post["attachments"]
         }})
 
         # Send update post event
-        app.cl.send_event("update_post", post, usernames=(None if post["post_origin"] == "home" else chat["members"]))
+        post = (await run_blocking(app.supporter.parse_posts_v0, [post]))[0]
+        await run_blocking(app.cl.send_event, "update_post", post, usernames=(None if post["post_origin"] == "home" else chat["members"]))
     else:  # delete post if no content and attachments remain
         # Update post
-        db.posts.update_one({"_id": post_id}, {"$set": {
+        await adb.posts.update_one({"_id": post_id}, {"$set": {
             "isDeleted": True,
-            "deleted_at": int(time.time())
+            "deleted_at": int(time.time()),
+            "expires_at": get_expiry()
         }})
+        await run_blocking(incr_post_count, post["post_origin"], post["u"], -1)
 
         # Send delete post event
-        app.cl.send_event("delete_post", {
+        await run_blocking(app.cl.send_event, "delete_post", {
             "chat_id": post["post_origin"],
             "post_id": post_id
         }, usernames=(None if post["post_origin"] == "home" else chat["members"]))
+        post = (await run_blocking(app.supporter.parse_posts_v0, [post]))[0]
 
     # Return post
+    await run_blocking(app.supporter.add_user_reactions, [post], request.user)
     post["error"] = False
-    return app.supporter.parse_posts_v0([post], requester=request.user)[0], 200
+    return post, 200
 
 
 @posts_bp.delete("/")
@@ -347,25 +346,18 @@ async def delete_post(query_args: PostIdQueryArgs):
         abort(401)
 
     if not (request.flags & security.UserFlags.POST_RATELIMIT_BYPASS):
-        # Check ratelimit
-        if security.ratelimited(f"post:{request.user}"):
-            abort(429)
-
         # Ratelimit
-        security.ratelimit(f"post:{request.user}", 6, 5)
+        if await security.ratelimit_async(f"post:{request.user}", 6, 5):
+            abort(429)
     
     # Get post
-    post = db.posts.find_one({"_id": query_args.id, "isDeleted": False})
+    post = await adb.posts.find_one({"_id": query_args.id, "isDeleted": False})
     if not post:
         abort(404)
 
     # Check access
     if post["post_origin"] not in {"home", "inbox"}:
-        chat = db.chats.find_one({
-            "_id": post["post_origin"],
-            "members": request.user,
-            "deleted": False
-        }, projection={"owner": 1, "members": 1})
+        chat = await chatinfo.get_member_chat_async(post["post_origin"], request.user)
         if not chat:
             abort(404)
     if post["post_origin"] == "inbox" or post["u"] != request.user:
@@ -375,18 +367,20 @@ async def delete_post(query_args: PostIdQueryArgs):
     # Delete attachments
     for attachment in post["attachments"]:
         try:
-            unclaim_file(attachment["id"])
+            await run_blocking(unclaim_file, attachment["id"])
         except Exception as e:
             log(f"Unable to delete attachment: {e}")
 
     # Update post
-    db.posts.update_one({"_id": query_args.id}, {"$set": {
+    await adb.posts.update_one({"_id": query_args.id}, {"$set": {
         "isDeleted": True,
-        "deleted_at": int(time.time())
+        "deleted_at": int(time.time()),
+        "expires_at": get_expiry()
     }})
+    await run_blocking(incr_post_count, post["post_origin"], post["u"], -1)
 
     # Send delete post event
-    app.cl.send_event("delete_post", {
+    await run_blocking(app.cl.send_event, "delete_post", {
         "chat_id": post["post_origin"],
         "post_id": query_args.id
     }, usernames=(None if post["post_origin"] == "home" else chat["members"]))
@@ -395,32 +389,32 @@ async def delete_post(query_args: PostIdQueryArgs):
 
 
 @posts_bp.get("/<chat_id>")
-@validate_querystring(PagedQueryArgs)
-async def get_chat_posts(chat_id, query_args: PagedQueryArgs):
+@validate_querystring(GetPostsQueryArgs)
+async def get_chat_posts(chat_id, query_args: GetPostsQueryArgs):
     # Check authorization
     if not request.user:
         abort(401)
 
     # Make sure chat exists
-    if not db.chats.count_documents({
-        "_id": chat_id,
-        "members": request.user,
-        "deleted": False
-    }, limit=1):
+    if not await chatinfo.get_member_chat_async(chat_id, request.user):
         abort(404)
 
-    # Get and return posts
+    # Make sure only one cursor was specified
+    if query_args.before and query_args.after:
+        abort(400)
+
+    # Get posts
     query = {"post_origin": chat_id, "isDeleted": False}
+    posts = await get_posts_page(query, query_args.page, query_args.before, query_args.after)
+    if posts is None:
+        abort(404)
+
+    # Return posts
     return {
         "error": False,
-        "autoget": app.supporter.parse_posts_v0(db.posts.find(
-            query,
-            sort=[("t.e", pymongo.DESCENDING)],
-            skip=(query_args.page-1)*25,
-            limit=25
-        ), requester=request.user),
+        "autoget": await run_blocking(app.supporter.parse_posts_v0, posts, requester=request.user),
         "page#": query_args.page,
-        "pages": (get_total_pages("posts", query) if request.user else 1)
+        "pages": (await get_total_pages("posts", query, item_count=await run_blocking(get_post_count, chat_id)) if query_args.count else None)
     }, 200
 
 
@@ -432,15 +426,12 @@ async def create_chat_post(chat_id, data: PostBody):
         abort(401)
 
     if not (request.flags & security.UserFlags.POST_RATELIMIT_BYPASS):
-        # Check ratelimit
-        if security.ratelimited(f"post:{request.user}"):
-            abort(429)
-
         # Ratelimit
-        security.ratelimit(f"post:{request.user}", 6, 5)
+        if await security.ratelimit_async(f"post:{request.user}", 6, 5):
+            abort(429)
 
     # Check restrictions
-    if security.is_restricted(request.user, security.Restrictions.CHAT_POSTS):
+    if security.is_restricted(request.user, security.Restrictions.CHAT_POSTS, ban=request.ban):
         return {"error": True, "type": "accountBanned"}, 403
 
     # Make sure there's not too many attachments
@@ -457,14 +448,14 @@ async def create_chat_post(chat_id, data: PostBody):
 
     # Make sure stickers exist
     for sticker_id in copy(data.stickers):
-        if not db.chat_stickers.count_documents({"_id": sticker_id}, limit=1):
+        if not await adb.chat_stickers.count_documents({"_id": sticker_id}, limit=1):
             data.stickers.remove(sticker_id)
 
     # Make sure replied to post IDs exist and are unique
     unique_reply_to_post_ids = []
     if chat_id != "livechat":
         for post_id in data.reply_to:
-            if db.posts.count_documents({"_id": post_id, "post_origin": chat_id}, limit=1) and \
+            if await adb.posts.count_documents({"_id": post_id, "post_origin": chat_id}, limit=1) and \
                 post_id not in unique_reply_to_post_ids:
                 unique_reply_to_post_ids.append(post_id)
 
@@ -475,7 +466,7 @@ async def create_chat_post(chat_id, data: PostBody):
             if attachment_id in attachments:
                 continue
             try:
-                claim_file(attachment_id, "attachments", request.user)
+                await run_blocking(claim_file, attachment_id, "attachments", request.user)
             except Exception as e:
                 log(f"Unable to claim attachment: {e}")
                 return {"error": True, "type": "unableToClaimAttachment"}, 500
@@ -488,25 +479,18 @@ async def create_chat_post(chat_id, data: PostBody):
 
     if chat_id != "livechat":
         # Get chat
-        chat = db.chats.find_one({
-            "_id": chat_id,
-            "members": request.user,
-            "deleted": False
-        }, projection={"type": 1, "members": 1})
+        chat = await chatinfo.get_member_chat_async(chat_id, request.user)
         if not chat:
             abort(404)
         
         # DM stuff
         if chat["type"] == 1:
             # Check privacy options
-            if db.relationships.count_documents({"$or": [
-                {"_id": {"from": chat["members"][0], "to": chat["members"][1]}},
-                {"_id": {"from": chat["members"][1], "to": chat["members"][0]}}
-            ], "state": 2}, limit=1) > 0:
+            if await blocks.is_blocked_async(chat["members"][0], chat["members"][1]):
                 abort(403)
 
             # Update user settings
-            Thread(target=db.user_settings.bulk_write, args=([
+            await adb.user_settings.bulk_write([
                 pymongo.UpdateMany({"$or": [
                     {"_id": chat["members"][0]},
                     {"_id": chat["members"][1]}
@@ -519,10 +503,11 @@ async def create_chat_post(chat_id, data: PostBody):
                     "$position": 0,
                     "$slice": -150
                 }}})
-            ],)).start()
+            ])
 
     # Create post
-    post = app.supporter.create_post(
+    post = await run_blocking(
+        app.supporter.create_post,
         chat_id,
         request.user,
         data.content,
@@ -535,13 +520,13 @@ async def create_chat_post(chat_id, data: PostBody):
 
     # Return new post
     post["error"] = False
-    return app.supporter.parse_posts_v0([post], requester=request.user)[0], 200
+    return post, 200
 
 @posts_bp.get("/<post_id>/reactions/<emoji_reaction>")
 @validate_querystring(PagedQueryArgs)
 async def get_post_reactors(query_args: PagedQueryArgs, post_id: str, emoji_reaction: str):
     # Get necessary post details and check access
-    post = db.posts.find_one({
+    post = await adb.posts.find_one({
         "_id": post_id,
         "isDeleted": {"$ne": True}
     }, projection={"_id": 1, "post_origin": 1, "u": 1})
@@ -552,25 +537,25 @@ async def get_post_reactors(query_args: PagedQueryArgs, post_id: str, emoji_reac
     elif post["post_origin"] == "inbox" and post["u"] not in ["Server", request.user]:
         abort(404)
     elif post["post_origin"] not in ["home", "inbox"]:
-        if not db.chats.count_documents({
-            "_id": post["post_origin"],
-            "members": request.user,
-            "deleted": False
-        }, limit=1):
+        if not await chatinfo.get_member_chat_async(post["post_origin"], request.user):
             abort(404)
 
-    # Get and return reactors
+    # Get reactors
     query = {"_id.post_id": post_id, "_id.emoji": emoji_reaction}
+    usernames = [r["_id"]["user"] for r in await adb.post_reactions.find(
+        query,
+        sort=[("time", pymongo.DESCENDING)],
+        skip=(query_args.page-1)*25,
+        limit=25
+    )]
+    accounts = await run_blocking(security.get_accounts, usernames)
+
+    # Return reactors
     return {
         "error": False,
-        "autoget": [security.get_account(r["_id"]["user"]) for r in db.post_reactions.find(
-            query,
-            sort=[("time", pymongo.DESCENDING)],
-            skip=(query_args.page-1)*25,
-            limit=25
-        )],
+        "autoget": [accounts.get(username) for username in usernames],
         "page#": query_args.page,
-        "pages": (get_total_pages("post_reactions", query) if request.user else 1)
+        "pages": (await get_total_pages("post_reactions", query) if request.user else 1)
     }, 200
 
 @posts_bp.post("/<post_id>/reactions/<emoji_reaction>")
@@ -580,18 +565,17 @@ async def add_post_reaction(post_id: str, emoji_reaction: str):
         abort(401)
 
     # Ratelimit
-    if security.ratelimited(f"react:{request.user}"):
+    if await security.ratelimit_async(f"react:{request.user}", 5, 5):
         abort(429)
-    security.ratelimit(f"react:{request.user}", 5, 5)
 
     # Check if the emoji is only one emoji, with support for variants
     if not (emoji.purely_emoji(emoji_reaction) and len(emoji.distinct_emoji_list(emoji_reaction)) == 1):
         # Check if the emoji is a custom emoji
-        if not db.chat_emojis.count_documents({"_id": emoji_reaction}, limit=1):
+        if not await adb.chat_emojis.count_documents({"_id": emoji_reaction}, limit=1):
             abort(400)
 
     # Get necessary post details and check access
-    post = db.posts.find_one({
+    post = await adb.posts.find_one({
         "_id": post_id,
         "isDeleted": {"$ne": True}
     }, projection={
@@ -605,11 +589,7 @@ async def add_post_reaction(post_id: str, emoji_reaction: str):
     elif post["post_origin"] == "inbox" and post["u"] not in ["Server", request.user]:
         abort(404)
     elif post["post_origin"] not in ["home", "inbox"]:
-        if not db.chats.count_documents({
-            "_id": post["post_origin"],
-            "members": request.user,
-            "deleted": False
-        }, limit=1):
+        if not await chatinfo.get_member_chat_async(post["post_origin"], request.user):
             abort(404)
 
     # Make sure there's not too many reactions (50)
@@ -617,34 +597,18 @@ async def add_post_reaction(post_id: str, emoji_reaction: str):
         return {"error": True, "type": "tooManyReactions"}, 403
 
     # Add reaction
-    db.post_reactions.update_one({"_id": {
+    result = await adb.post_reactions.update_one({"_id": {
         "post_id": post["_id"],
         "emoji": emoji_reaction,
         "user": request.user
     }}, {"$set": {"time": int(time.time())}}, upsert=True)
 
     # Update post
-    existing_reaction = None
-    for reaction in post["reactions"]:
-        if reaction["emoji"] == emoji_reaction:
-            existing_reaction = reaction
-            break
-    if existing_reaction:
-        existing_reaction["count"] = db.post_reactions.count_documents({
-            "_id.post_id": post["_id"],
-            "_id.emoji": reaction["emoji"]
-        })
-    else:
-        post["reactions"].append({
-            "emoji": emoji_reaction,
-            "count": 1
-        })
-    db.posts.update_one({"_id": post["_id"]}, {"$set": {
-        "reactions": post["reactions"]
-    }})
+    if result.upserted_id is not None:
+        await run_blocking(incr_reaction_count, post["_id"], emoji_reaction, 1)
 
     # Send event
-    app.cl.send_event("post_reaction_add", {
+    await run_blocking(app.cl.send_event, "post_reaction_add", {
         "chat_id": post["post_origin"],
         "post_id": post["_id"],
         "emoji": emoji_reaction,
@@ -664,12 +628,11 @@ async def remove_post_reaction(post_id: str, emoji_reaction: str, username: str)
         username = request.user
 
     # Ratelimit
-    if security.ratelimited(f"react:{request.user}"):
+    if await security.ratelimit_async(f"react:{request.user}", 5, 5):
         abort(429)
-    security.ratelimit(f"react:{request.user}", 5, 5)
 
     # Make sure reaction exists
-    if not db.post_reactions.count_documents({"_id": {
+    if not await adb.post_reactions.count_documents({"_id": {
         "post_id": post_id,
         "emoji": emoji_reaction,
         "user": username
@@ -677,7 +640,7 @@ async def remove_post_reaction(post_id: str, emoji_reaction: str, username: str)
         abort(404)
 
     # Get necessary post details and check access
-    post = db.posts.find_one({
+    post = await adb.posts.find_one({
         "_id": post_id,
         "isDeleted": {"$ne": True}
     }, projection={
@@ -691,11 +654,7 @@ async def remove_post_reaction(post_id: str, emoji_reaction: str, username: str)
     elif post["post_origin"] == "inbox" and post["u"] not in ["Server", request.user]:
         abort(404)
     elif post["post_origin"] not in ["home", "inbox"]:
-        chat = db.chats.find_one({
-            "_id": post["post_origin"],
-            "members": request.user,
-            "deleted": False
-        }, projection={"owner": 1})
+        chat = await chatinfo.get_member_chat_async(post["post_origin"], request.user)
         if not chat:
             abort(404)
 
@@ -705,29 +664,18 @@ async def remove_post_reaction(post_id: str, emoji_reaction: str, username: str)
             abort(403)
 
     # Remove reaction
-    db.post_reactions.delete_one({"_id": {
+    result = await adb.post_reactions.delete_one({"_id": {
         "post_id": post["_id"],
         "emoji": emoji_reaction,
         "user": username
     }})
 
     # Update post
-    for reaction in post["reactions"]:
-        if reaction["emoji"] != emoji_reaction:
-            continue
-        reaction["count"] = db.post_reactions.count_documents({
-            "_id.post_id": post["_id"],
-            "_id.emoji": reaction["emoji"]
-        })
-        if not reaction["count"]:
-            post["reactions"].remove(reaction)
-        break
-    db.posts.update_one({"_id": post["_id"]}, {"$set": {
-        "reactions": post["reactions"]
-    }})
+    if result.deleted_count:
+        await run_blocking(incr_reaction_count, post["_id"], emoji_reaction, -1)
 
     # Send event
-    app.cl.send_event("post_reaction_remove", {
+    await run_blocking(app.cl.send_event, "post_reaction_remove", {
         "chat_id": post["post_origin"],
         "post_id": post["_id"],
         "emoji": emoji_reaction,
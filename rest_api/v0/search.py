@@ -3,8 +3,8 @@ from quart_schema import validate_querystring
 from pydantic import BaseModel, Field
 from typing import Optional
 
-import security
-from database import db, get_total_pages
+import security, blocks
+from database import adb, run_blocking, get_total_pages
 
 
 search_bp = Blueprint("search_bp", __name__, url_prefix="/search")
@@ -13,21 +13,25 @@ search_bp = Blueprint("search_bp", __name__, url_prefix="/search")
 class SearchQueryArgs(BaseModel):
     q: str = Field(min_length=1, max_length=4000)
     page: Optional[int] = Field(default=1, ge=1)
+    count: Optional[bool] = Field(default=True)
 
 
 @search_bp.get("/home")
 @validate_querystring(SearchQueryArgs)
 async def search_home(query_args: SearchQueryArgs):
+    # Get posts (in text index order, sorting every match by time would be done in memory)
     query = {"post_origin": "home", "isDeleted": False, "$text": {"$search": query_args.q}}
+    hidden_users = await blocks.get_hidden_users(request.user)
+    if hidden_users:
+        query["u"] = {"$nin": hidden_users}
+    posts = await adb.posts.find(query, skip=(query_args.page-1)*25, limit=25)
+
+    # Return posts
     return {
         "error": False,
-        "autoget": app.supporter.parse_posts_v0(db.posts.find(
-            query,
-            skip=(query_args.page-1)*25,
-            limit=25
-        ), requester=request.user),
+        "autoget": await run_blocking(app.supporter.parse_posts_v0, posts, requester=request.user),
         "page#": query_args.page,
-        "pages": get_total_pages("posts", query)
+        "pages": (await get_total_pages("posts", query) if query_args.count else None)
     }, 200
 
 
@@ -36,12 +40,13 @@ async def search_home(query_args: SearchQueryArgs):
 async def search_users(query_args: SearchQueryArgs):
     # Get users
     query = {"pswd": {"$type": "string"}, "$text": {"$search": query_args.q}}
-    usernames = [user["_id"] for user in db.usersv0.find(query, skip=(query_args.page-1)*25, limit=25, projection={"_id": 1})]
+    usernames = [user["_id"] for user in await adb.usersv0.find(query, skip=(query_args.page-1)*25, limit=25, projection={"_id": 1})]
+    accounts = await run_blocking(security.get_accounts, usernames)
 
     # Return users
     return {
         "error": False,
-        "autoget": [security.get_account(username) for username in usernames],
+        "autoget": [accounts.get(username) for username in usernames],
         "page#": query_args.page,
-        "pages": get_total_pages("usersv0", query)
+        "pages": await get_total_pages("usersv0", query)
     }, 200
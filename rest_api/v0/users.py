@@ -2,18 +2,21 @@ from quart import Blueprint, current_app as app, request, abort
 from quart_schema import validate_querystring, validate_request
 from pydantic import BaseModel, Field
 from typing import Literal, Optional
-import pymongo
 import uuid
 import time
 
-import security
-from database import db, get_total_pages
+import security, chatinfo, blocks
+from database import adb, run_blocking, get_total_pages, get_posts_page
+from counters import get_post_count
 
 
 users_bp = Blueprint("users_bp", __name__, url_prefix="/users/<username>")
 
 class GetPostsQueryArgs(BaseModel):
     page: Optional[int] = Field(default=1, ge=1)
+    before: Optional[str] = Field(default=None, max_length=50)
+    after: Optional[str] = Field(default=None, max_length=50)
+    count: Optional[bool] = Field(default=True)
 
 class UpdateRelationshipBody(BaseModel):
     state: Literal[
@@ -36,7 +39,7 @@ class ReportBody(BaseModel):
 @users_bp.before_request
 async def check_user_exists():
     username = request.view_args.get("username")
-    user = db.usersv0.find_one({"lower_username": username.lower()}, projection={"_id": 1, "flags": 1})
+    user = await adb.usersv0.find_one({"lower_username": username.lower()}, projection={"_id": 1, "flags": 1})
     if (not user) or (user["flags"] & security.UserFlags.DELETED == security.UserFlags.DELETED):
         abort(404)
     else:
@@ -45,7 +48,7 @@ async def check_user_exists():
 
 @users_bp.get("/")
 async def get_user(username):
-    account = security.get_account(username, (request.user and request.user.lower() == username.lower()))
+    account = await run_blocking(security.get_account, username, (request.user and request.user.lower() == username.lower()))
     account["error"] = False
     return account, 200
 
@@ -53,17 +56,26 @@ async def get_user(username):
 @users_bp.get("/posts")
 @validate_querystring(GetPostsQueryArgs)
 async def get_user_posts(username, query_args: GetPostsQueryArgs):
+    # Make sure only one cursor was specified
+    if query_args.before and query_args.after:
+        abort(400)
+
+    # Get posts
     query = {"post_origin": "home", "isDeleted": False, "u": username}
+    posts = await get_posts_page(query, query_args.page, query_args.before, query_args.after)
+    if posts is None:
+        abort(404)
+
+    # Return posts
+    if query_args.count:
+        pages = await get_total_pages("posts", query, item_count=await run_blocking(get_post_count, "home", username))
+    else:
+        pages = None
     return {
         "error": False,
-        "autoget": app.supporter.parse_posts_v0(db.posts.find(
-            query,
-            sort=[("t.e", pymongo.DESCENDING)],
-            skip=(query_args.page-1)*25,
-            limit=25
-        ), requester=request.user),
+        "autoget": await run_blocking(app.supporter.parse_posts_v0, posts, requester=request.user),
         "page#": query_args.page,
-        "pages": get_total_pages("posts", query)
+        "pages": pages
     }, 200
 
 
@@ -78,7 +90,7 @@ async def get_relationship(username):
         abort(400)
 
     # Get relationship
-    relationship = db.relationships.find_one({"_id": {"from": request.user, "to": username}})
+    relationship = await adb.relationships.find_one({"_id": {"from": request.user, "to": username}})
 
     # Return relationship
     if relationship:
@@ -98,19 +110,16 @@ async def update_relationship(username, data: UpdateRelationshipBody):
     if not request.user:
         abort(401)
 
-    # Check ratelimit
-    if security.ratelimited(f"relationships:{request.user}"):
-        abort(429)
-
     # Ratelimit
-    security.ratelimit(f"relationships:{request.user}", 10, 15)
+    if await security.ratelimit_async(f"relationships:{request.user}", 10, 15):
+        abort(429)
 
     # Make sure the requested user isn't the requester
     if request.user == username:
         abort(400)
 
     # Get relationship
-    relationship = db.relationships.find_one({"_id": {"from": request.user, "to": username}})
+    relationship = await adb.relationships.find_one({"_id": {"from": request.user, "to": username}})
     if not relationship:
         relationship = {
             "_id": {"from": request.user, "to": username},
@@ -127,12 +136,13 @@ async def update_relationship(username, data: UpdateRelationshipBody):
     relationship["state"] = data.state
     relationship["updated_at"] = int(time.time())
     if data.state == 0:
-        db.relationships.delete_one({"_id": {"from": request.user, "to": username}})
+        await adb.relationships.delete_one({"_id": {"from": request.user, "to": username}})
     else:
-        db.relationships.update_one({"_id": {"from": request.user, "to": username}}, {"$set": relationship}, upsert=True)
+        await adb.relationships.update_one({"_id": {"from": request.user, "to": username}}, {"$set": relationship}, upsert=True)
+    await run_blocking(blocks.invalidate_graph, request.user, username)
 
     # Sync relationship between sessions
-    app.cl.send_event("update_relationship", {
+    await run_blocking(app.cl.send_event, "update_relationship", {
         "username": username,
         "state": relationship["state"],
         "updated_at": relationship["updated_at"]
@@ -148,9 +158,9 @@ async def report_post(username, data: ReportBody):
     if not request.user:
         abort(401)
 
-    security.ratelimit(f"report:{request.user}", 3, 5)
+    await security.ratelimit_async(f"report:{request.user}", 3, 5)
     
-    report = db.reports.find_one({
+    report = await adb.reports.find_one({
         "content_id": username,
         "status": "pending",
         "type": "user"
@@ -179,7 +189,7 @@ async def report_post(username, data: ReportBody):
         "time": int(time.time())
     })
 
-    db.reports.update_one({"_id": report["_id"]}, {"$set": report}, upsert=True)
+    await adb.reports.update_one({"_id": report["_id"]}, {"$set": report}, upsert=True)
 
     return {"error": False}, 200
 
@@ -190,26 +200,23 @@ async def get_dm_chat(username):
     if not request.user:
         abort(401)
 
-    # Check ratelimit
-    if security.ratelimited(f"create_chat:{request.user}"):
-        abort(429)
-
     # Ratelimit
-    security.ratelimit(f"create_chat:{request.user}", 5, 30)
+    if await security.ratelimit_async(f"create_chat:{request.user}", 5, 30):
+        abort(429)
 
     # Make sure the requested user isn't the requester
     if request.user == username:
         abort(400)
 
     # Get existing chat or create new chat
-    chat = db.chats.find_one({
+    chat = await adb.chats.find_one({
         "members": {"$all": [request.user, username]},
         "type": 1,
         "deleted": False
     })
     if not chat:
         # Check restrictions
-        if security.is_restricted(request.user, security.Restrictions.NEW_CHATS):
+        if security.is_restricted(request.user, security.Restrictions.NEW_CHATS, ban=request.ban):
             return {"error": True, "type": "accountBanned"}, 403
 
         # Create chat
@@ -223,18 +230,14 @@ async def get_dm_chat(username):
             "last_active": 0,
             "deleted": False
         }
-        db.chats.insert_one(chat)
+        await adb.chats.insert_one(chat)
+        await run_blocking(chatinfo.invalidate_chat, chat["_id"])
 
     # Return chat
     if chat["last_active"] == 0:
         chat["last_active"] = int(time.time())
     chat.update({
         "error": False,
-        "emojis": list(db.chat_emojis.find({
-            "chat_id": chat["_id"]
-        }, projection={"chat_id": 0, "created_at": 0, "created_by": 0})),
-        "stickers": list(db.chat_stickers.find({
-            "chat_id": chat["_id"]
-        }, projection={"chat_id": 0, "created_at": 0, "created_by": 0}))
+        **(await chatinfo.get_chat_emotes_async(chat["_id"]))
     })
     return chat, 200
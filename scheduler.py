@@ -0,0 +1,105 @@
+from typing import Any, Callable, Optional
+import asyncio, time, os, msgpack
+
+from database import db, rdb, run_blocking
+from utils import log
+
+"""
+Meower Scheduler Module
+This module provides periodic background tasks, each run by only one node per interval (or by every node, for node-local work).
+"""
+
+TASK_BATCH_SIZE = int(os.getenv("TASK_BATCH_SIZE", 1000))
+TASK_BATCH_PAUSE = float(os.getenv("TASK_BATCH_PAUSE", 0.1))  # seconds between batches, to not starve the database
+METRICS_KEY = "scheduler:metrics"
+
+
+class Task:
+    def __init__(self, name: str, interval: float, func: Callable[[], Any], per_node: bool = False):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.per_node = per_node
+
+
+class Scheduler:
+    """
+    Runs registered tasks on the event loop, with the blocking task bodies on the database executor.
+
+    A Redis lock per task and interval makes sure only one node runs each task,
+    and every run's timing and result is stored in Redis for the admin API.
+    Per-node tasks skip the lock and run on every node, for work on state that only lives in a node's memory.
+    """
+
+    def __init__(self):
+        self.tasks: dict[str, Task] = {}
+
+    def task(self, name: str, interval: float, per_node: bool = False):
+        def decorator(func):
+            self.tasks[name] = Task(name, interval, func, per_node=per_node)
+            return func
+        return decorator
+
+    async def run(self):
+        await asyncio.gather(*[self._run_task(task) for task in self.tasks.values()])
+
+    async def _run_task(self, task: Task):
+        while True:
+            await asyncio.sleep(task.interval)
+
+            # Only one node needs to run the task per interval
+            if not task.per_node and not await run_blocking(rdb.set, f"scheduler:lock:{task.name}", "", ex=task.interval, nx=True):
+                continue
+
+            # Run task
+            if not task.per_node:  # per-node tasks run too often to log every run
+                log(f"Running background task {task.name}...")
+            started = time.monotonic()
+            metrics = {"last_run": int(time.time()), "error": None, "result": None}
+            try:
+                metrics["result"] = await run_blocking(task.func)
+            except Exception as e:
+                log(f"Background task {task.name} failed: {e}")
+                metrics["error"] = str(e)
+            metrics["duration"] = round(time.monotonic()-started, 3)
+            if not task.per_node:
+                log(f"Finished background task {task.name} in {metrics['duration']}s")
+
+            # Save metrics
+            try:
+                await run_blocking(rdb.hset, METRICS_KEY, task.name, msgpack.packb(metrics))
+            except Exception as e:
+                log(f"Failed to save metrics for background task {task.name}: {e}")
+
+
+def get_metrics() -> dict[str, dict]:
+    return {
+        name.decode(): msgpack.unpackb(metrics)
+        for name, metrics in rdb.hgetall(METRICS_KEY).items()
+    }
+
+
+def delete_in_batches(
+    collection: str,
+    query: dict,
+    on_batch: Optional[Callable[[list[Any]], None]] = None
+) -> int:
+    """
+    Delete every document matching a query, TASK_BATCH_SIZE documents at a time.
+    on_batch gets called with the IDs of every batch before it's deleted.
+    Returns how many documents were deleted.
+    """
+
+    deleted = 0
+    while True:
+        ids = [doc["_id"] for doc in db[collection].find(query, projection={"_id": 1}, limit=TASK_BATCH_SIZE)]
+        if not ids:
+            return deleted
+
+        if on_batch:
+            on_batch(ids)
+        deleted += db[collection].delete_many({"$and": [query, {"_id": {"$in": ids}}]}).deleted_count
+
+        if len(ids) < TASK_BATCH_SIZE:
+            return deleted
+        time.sleep(TASK_BATCH_PAUSE)
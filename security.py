@@ -1,10 +1,13 @@
-from hashlib import sha256
-from typing import Optional
-import time, requests, uuid, secrets, bcrypt, msgpack
+from threading import Thread
+from typing import Optional, Iterable
+import time, requests, asyncio, uuid, secrets, msgpack, os, re, pyotp
 
-from database import db, rdb
+from database import db, adb, rdb, get_expiry, run_blocking
 from utils import log
 from uploads import unclaim_all_files
+from cache import Cache
+from counters import reset_post_counts
+import ratelimits, netinfo, netblocks, passwords, chatinfo, blocks
 
 """
 Meower Security Module
@@ -37,12 +40,70 @@ DEFAULT_USER_SETTINGS = {
 }
 
 
+TOKEN_ACCOUNT_PROJECTION = {
+    "_id": 1,
+    "uuid": 1,
+    "flags": 1,
+    "permissions": 1,
+    "ban": 1
+}
+
+
+# Audit log types that only record moderators viewing things, these expire after database.RETENTION
+EPHEMERAL_AUDIT_LOG_TYPES = {
+    "got_reports",
+    "got_report",
+    "got_notes",
+    "got_users",
+    "got_user",
+    "got_user_posts",
+    "got_chat",
+    "got_netinfo",
+    "got_netblocks",
+    "got_netblock",
+    "got_announcements"
+}
+
 USERNAME_REGEX = "[a-zA-Z0-9-_]{1,20}"
 TOTP_REGEX = "[0-9]{6}"
-BCRYPT_SALT_ROUNDS = 14
 TOKEN_BYTES = 64
 
 
+# Token -> account details used for authenticating requests
+token_cache = Cache(
+    "tokens",
+    max_size=int(os.getenv("TOKEN_CACHE_SIZE", 10000)),
+    ttl=int(os.getenv("TOKEN_CACHE_TTL", 300))
+)
+
+# Lowercase username -> sanitized account (including ban) used for public profiles
+account_cache = Cache(
+    "accounts",
+    max_size=int(os.getenv("ACCOUNT_CACHE_SIZE", 10000)),
+    ttl=int(os.getenv("ACCOUNT_CACHE_TTL", 60))
+)
+
+# Lowercase username -> ban state used for restriction checks outside of REST requests
+ban_cache = Cache(
+    "bans",
+    max_size=int(os.getenv("BAN_CACHE_SIZE", 10000)),
+    ttl=int(os.getenv("BAN_CACHE_TTL", 300))
+)
+
+
+class AuthError(Exception):
+    """
+    Raised by the authentication services.
+    type, status and extra map directly onto an API error response.
+    """
+
+    def __init__(self, type: str, status: int = 401, **extra):
+        super().__init__(type)
+        self.type = type
+        self.status = status
+        self.extra = extra
+
+
 class UserFlags:
     SYSTEM = 1
     DELETED = 2
@@ -88,31 +149,43 @@ class Restrictions:
     EDITING_PROFILE = 16
 
 
-def ratelimited(bucket_id: str):
-    remaining = rdb.get(f"rtl:{bucket_id}")
-    if remaining is not None and int(remaining.decode()) < 1:
-        return True
-    else:
+def ratelimited(bucket_id: str) -> bool:
+    rtl = ratelimits.peek(bucket_id)
+    return rtl is not None and rtl["limited"]
+
+
+def ratelimit(bucket_id: str, limit: int, seconds: int, policy: str = ratelimits.FIXED_WINDOW) -> ratelimits.Ratelimit:
+    """
+    Consume from a bucket in one atomic round trip.
+
+    Returns the bucket's state, limited is whether it was already ratelimited (in which case nothing is consumed).
+    """
+
+    return ratelimits.hit(bucket_id, limit, seconds, policy=policy)
+
+
+async def ratelimited_async(bucket_id: str) -> bool:
+    rtl = await run_blocking(ratelimits.peek, bucket_id)
+    if rtl is None or not rtl["limited"]:
         return False
+    ratelimits.record(rtl)
+    return True
 
 
-def ratelimit(bucket_id: str, limit: int, seconds: int):
-    remaining = rdb.get(f"rtl:{bucket_id}")
-    if remaining is None:
-        remaining = limit
-    else:
-        remaining = int(remaining.decode())
+async def ratelimit_async(bucket_id: str, limit: int, seconds: int, policy: str = ratelimits.FIXED_WINDOW) -> bool:
+    """
+    Consume from a bucket off the event loop, and record it for the request's ratelimit headers.
 
-    expires = rdb.ttl(f"rtl:{bucket_id}")
-    if expires <= 0:
-        expires = seconds
+    Returns whether the bucket was already ratelimited (in which case nothing is consumed).
+    """
 
-    remaining -= 1
-    rdb.set(f"rtl:{bucket_id}", remaining, ex=expires)
+    rtl = await run_blocking(ratelimit, bucket_id, limit, seconds, policy)
+    ratelimits.record(rtl)
+    return rtl["limited"]
 
 
 def clear_ratelimit(bucket_id: str):
-    rdb.delete(f"rtl:{bucket_id}")
+    ratelimits.clear(bucket_id)
 
 
 def account_exists(username, ignore_case=False):
@@ -124,7 +197,7 @@ def account_exists(username, ignore_case=False):
     return (db.usersv0.count_documents(query, limit=1) > 0)
 
 
-def create_account(username: str, password: str, ip: str):
+def create_account(username: str, password_hash: str, ip: str):
     # Create user
     db.usersv0.insert_one({
         "_id": username,
@@ -135,7 +208,7 @@ def create_account(username: str, password: str, ip: str):
         "avatar": "",
         "avatar_color": "000000",
         "quote": "",
-        "pswd": hash_password(password),
+        "pswd": password_hash,
         "mfa_recovery_code": secrets.token_hex(5),
         "tokens": [],
         "flags": 0,
@@ -158,39 +231,81 @@ def create_account(username: str, password: str, ip: str):
         "content": "Welcome to Meower! We welcome you with open arms! You can get started by making friends in the global chat or home, or by searching for people and adding them to a group chat. We hope you have fun!"
     }))
 
-    # Automatically report if VPN is detected
-    if get_netinfo(ip)["vpn"]:
-        db.reports.insert_one({
-            "_id": str(uuid.uuid4()),
-            "type": "user",
-            "content_id": username,
-            "status": "pending",
-            "escalated": False,
-            "reports": [{
-                "user": "Server",
-                "ip": ip,
-                "reason": "User registered while using a VPN.",
-                "comment": "",
-                "time": int(time.time())
-            }]
-        })
+    # Automatically report if VPN is detected (in the background, so registering doesn't wait on netinfo providers)
+    Thread(target=report_vpn_registration, args=(username, ip), daemon=True).start()
 
 
-def get_account(username, include_config=False):
-    # Check datatype
-    if not isinstance(username, str):
-        log(f"Error on get_account: Expected str for username, got {type(username)}")
-        return None
+def report_vpn_registration(username: str, ip: str):
+    try:
+        if not asyncio.run(netinfo.get_netinfo(ip))["vpn"]:
+            return
+    except Exception as e:
+        log(f"Failed to check netinfo of {username}'s registration: {e}")
+        return
 
-    # Get account
-    account = db.usersv0.find_one({"lower_username": username.lower()}, projection=SENSITIVE_ACCOUNT_FIELDS_DB_PROJECTION)
-    if not account:
-        return None
+    db.reports.insert_one({
+        "_id": str(uuid.uuid4()),
+        "type": "user",
+        "content_id": username,
+        "status": "pending",
+        "escalated": False,
+        "reports": [{
+            "user": "Server",
+            "ip": ip,
+            "reason": "User registered while using a VPN.",
+            "comment": "",
+            "time": int(time.time())
+        }]
+    })
+
+
+def _get_sanitized_accounts(usernames: Iterable[str]) -> dict[str, dict]:
+    # Get cached accounts
+    accounts = {}
+    missing = set()
+    for username in usernames:
+        account = account_cache.get(username.lower())
+        if account:
+            accounts[username.lower()] = account
+        else:
+            missing.add(username.lower())
+
+    # Get the rest in one query
+    if missing:
+        generation = account_cache.generation()
+        for account in db.usersv0.find(
+            {"lower_username": {"$in": list(missing)}},
+            projection=SENSITIVE_ACCOUNT_FIELDS_DB_PROJECTION
+        ):
+            # Make sure there's nothing sensitive on the account obj
+            for key in SENSITIVE_ACCOUNT_FIELDS:
+                if key in account:
+                    del account[key]
 
-    # Make sure there's nothing sensitive on the account obj
-    for key in SENSITIVE_ACCOUNT_FIELDS:
-        if key in account:
-            del account[key]
+            account_cache.set(account["lower_username"], account, generation=generation)
+            accounts[account["lower_username"]] = account
+
+    return accounts
+
+
+def get_accounts(usernames: Iterable[str]) -> dict[str, dict]:
+    """
+    Get the public accounts of many users at once, from the account cache where possible.
+    Returns {username: account}, usernames that don't exist are left out.
+    """
+
+    usernames = [username for username in usernames if isinstance(username, str)]
+    accounts = _get_sanitized_accounts(usernames)
+    return {
+        username: _public_account(accounts[username.lower()])
+        for username in usernames if username.lower() in accounts
+    }
+
+
+def _public_account(account: dict, include_ban: bool = False) -> dict:
+    account = account.copy()
+    if account.get("ban"):
+        account["ban"] = account["ban"].copy()
 
     # Add lvl and banned
     account["lvl"] = 0
@@ -204,6 +319,25 @@ def get_account(username, include_config=False):
     else:
         account["banned"] = False
 
+    # Remove ban if not including config
+    if not include_ban:
+        del account["ban"]
+
+    return account
+
+
+def get_account(username, include_config=False):
+    # Check datatype
+    if not isinstance(username, str):
+        log(f"Error on get_account: Expected str for username, got {type(username)}")
+        return None
+
+    # Get account
+    account = _get_sanitized_accounts([username]).get(username.lower())
+    if not account:
+        return None
+    account = _public_account(account, include_ban=include_config)
+
     # Include config
     if include_config:
         account.update(DEFAULT_USER_SETTINGS)
@@ -211,13 +345,19 @@ def get_account(username, include_config=False):
         if user_settings:
             del user_settings["_id"]
             account.update(user_settings)
-    else:
-        # Remove ban if not including config
-        del account["ban"]
 
     return account
 
 
+def invalidate_account(username: str):
+    """
+    Drop a user's cached account on all nodes.
+    Must be called whenever a user's public profile, permissions, flags or ban state change.
+    """
+
+    account_cache.invalidate(username.lower())
+
+
 def create_user_token(username: str, ip: str, used_token: Optional[str] = None) -> str:
     # Get required account details
     account = db.usersv0.find_one({"_id": username}, projection={
@@ -230,7 +370,7 @@ def create_user_token(username: str, ip: str, used_token: Optional[str] = None)
     db.netlog.update_one({"_id": {
         "ip": ip,
         "user": username,
-    }}, {"$set": {"last_used": int(time.time())}}, upsert=True)
+    }}, {"$set": {"last_used": int(time.time()), "expires_at": get_expiry()}}, upsert=True)
 
     # Restore account
     if account["delete_after"]:
@@ -260,6 +400,253 @@ def create_user_token(username: str, ip: str, used_token: Optional[str] = None)
     return new_token
 
 
+def get_account_by_token(token: str) -> Optional[dict]:
+    # Get from cache
+    account = token_cache.get(token)
+    if account:
+        return account
+
+    # Get from database and cache it
+    generation = token_cache.generation()
+    account = db.usersv0.find_one({"tokens": token}, projection=TOKEN_ACCOUNT_PROJECTION)
+    if account:
+        token_cache.set(token, account, generation=generation)
+
+    return account
+
+
+def invalidate_tokens(username: str):
+    """
+    Drop every cached token of a user on all nodes.
+    Must be called whenever a user's tokens, permissions, flags or ban state change.
+    """
+
+    token_cache.invalidate_matching(_id=username)
+
+
+async def login(
+    username: str,
+    password: str,
+    ip: str,
+    totp_code: Optional[str] = None,
+    mfa_recovery_code: Optional[str] = None
+) -> tuple[dict, str]:
+    # Check datatypes
+    if not isinstance(username, str) or not (1 <= len(username) <= 20):
+        raise AuthError("badRequest", 400)
+    if not isinstance(password, str) or not (1 <= len(password) <= 255):
+        raise AuthError("badRequest", 400)
+
+    # Make sure IP isn't blocked
+    if netblocks.is_blocked(ip):
+        raise AuthError("ipBlocked", 403)
+
+    # Make sure IP isn't ratelimited
+    if await ratelimit_async(f"login:i:{ip}", 50, 900):
+        raise AuthError("tooManyRequests", 429)
+
+    # Get basic account details
+    account = await run_blocking(_get_login_account, username)
+
+    # Make sure account isn't ratelimited
+    if await ratelimited_async(f"login:u:{account['_id']}"):
+        raise AuthError("tooManyRequests", 429)
+
+    # Check credentials
+    if password not in account["tokens"]:
+        # Check password
+        password_valid = await _check_login_password(password, account["pswd"])
+
+        # Maybe they put their MFA credentials at the end of their password?
+        if (not password_valid) and await adb.authenticators.count_documents({"user": account["_id"]}, limit=1):
+            if (not mfa_recovery_code) and password.endswith(account["mfa_recovery_code"]):
+                try:
+                    mfa_recovery_code = password[-10:]
+                    password = password[:-10]
+                except: pass
+                else:
+                    password_valid = await _check_login_password(password, account["pswd"])
+            elif not totp_code:
+                try:
+                    totp_code = password[-6:]
+                    password = password[:-6]
+                except: pass
+                else:
+                    if re.fullmatch(TOTP_REGEX, totp_code):
+                        password_valid = await _check_login_password(password, account["pswd"])
+
+        # Abort if password is invalid
+        if not password_valid:
+            await ratelimit_async(f"login:u:{account['_id']}", 5, 60)
+            raise AuthError("Unauthorized", 401)
+
+        # Check MFA
+        if not await run_blocking(_check_login_mfa, account, totp_code, mfa_recovery_code):
+            await ratelimit_async(f"login:u:{account['_id']}", 5, 60)
+            raise AuthError("Unauthorized", 401)
+
+        # Rehash password if the cost factor has changed
+        if passwords.needs_rehash(account["pswd"]):
+            try:
+                await adb.usersv0.update_one({"_id": account["_id"]}, {"$set": {
+                    "pswd": await passwords.hash_password_async(password)
+                }})
+            except passwords.PoolOverloaded:
+                pass  # try again next login
+
+    # Return account and token
+    return await run_blocking(_get_account_and_token, account["_id"], ip)
+
+
+def _get_login_account(username: str) -> dict:
+    # Get basic account details
+    account = db.usersv0.find_one({"lower_username": username.lower()}, projection={
+        "_id": 1,
+        "flags": 1,
+        "tokens": 1,
+        "pswd": 1,
+        "mfa_recovery_code": 1
+    })
+    if not account:
+        raise AuthError("Unauthorized", 401)
+
+    # Make sure account isn't deleted
+    if account["flags"] & UserFlags.DELETED:
+        raise AuthError("accountDeleted", 401)
+
+    return account
+
+
+def _check_login_mfa(account: dict, totp_code: Optional[str], mfa_recovery_code: Optional[str]) -> bool:
+    """
+    Returns whether the MFA credentials are valid (or the account has no MFA),
+    raises mfaRequired if none were given.
+    """
+
+    authenticators = list(db.authenticators.find({"user": account["_id"]}))
+    if len(authenticators) == 0:
+        return True
+
+    if totp_code:
+        passed = False
+        for authenticator in authenticators:
+            if authenticator["type"] != "totp":
+                continue
+            if pyotp.TOTP(authenticator["totp_secret"]).verify(totp_code, valid_window=1):
+                passed = True
+                break
+        return passed
+    elif mfa_recovery_code:
+        if mfa_recovery_code == account["mfa_recovery_code"]:
+            db.authenticators.delete_many({"user": account["_id"]})
+            db.usersv0.update_one({"_id": account["_id"]}, {"$set": {
+                "mfa_recovery_code": secrets.token_hex(5)
+            }})
+            rdb.publish("admin", msgpack.packb({
+                "op": "alert_user",
+                "user": account["_id"],
+                "content": "All multi-factor authenticators have been removed from your account by someone who used your multi-factor authentication recovery code. If this wasn't you, please secure your account immediately."
+            }))
+            return True
+        else:
+            return False
+    else:
+        raise AuthError("mfaRequired", 401, mfa_methods=list({
+            authenticator["type"] for authenticator in authenticators
+        }))
+
+
+def _get_account_and_token(username: str, ip: str) -> tuple[dict, str]:
+    return get_account(username, True), create_user_token(username, ip)
+
+
+async def register(
+    username: str,
+    password: str,
+    ip: str,
+    captcha: Optional[str] = None,
+    bypass_captcha: bool = False
+) -> tuple[dict, str]:
+    # Check datatypes
+    if not isinstance(username, str) or not isinstance(password, str):
+        raise AuthError("badRequest", 400)
+
+    # Make sure IP isn't blocked
+    if netblocks.is_blocked(ip):
+        raise AuthError("ipBlocked", 403)
+
+    # Make sure IP isn't being ratelimited
+    if await ratelimited_async(f"register:{ip}:f") or await ratelimited_async(f"register:{ip}:s"):
+        raise AuthError("tooManyRequests", 429)
+
+    # Make sure password is between 8-72 characters
+    if len(password) < 8 or len(password) > 72:
+        raise AuthError("badRequest", 400)
+
+    # Make sure username matches regex
+    if not re.fullmatch(USERNAME_REGEX, username):
+        raise AuthError("badRequest", 400)
+
+    # Make sure IP isn't blocked from creating new accounts
+    if netblocks.is_registration_blocked(ip):
+        await ratelimit_async(f"register:{ip}:f", 5, 30)
+        raise AuthError("registrationBlocked", 403)
+
+    # Make sure username isn't taken
+    if await run_blocking(account_exists, username, ignore_case=True):
+        await ratelimit_async(f"register:{ip}:f", 5, 30)
+        raise AuthError("usernameExists", 409)
+
+    # Check captcha
+    if os.getenv("CAPTCHA_SECRET") and not bypass_captcha:
+        if not await run_blocking(_check_captcha, captcha):
+            raise AuthError("invalidCaptcha", 403)
+
+    # Hash password
+    try:
+        password_hash = await passwords.hash_password_async(password)
+    except passwords.PoolOverloaded:
+        raise AuthError("tooManyRequests", 429)
+
+    # Create account
+    await run_blocking(create_account, username, password_hash, ip)
+
+    # Ratelimit
+    await ratelimit_async(f"register:{ip}:s", 5, 900)
+
+    # Return account and token
+    return await run_blocking(_get_account_and_token, username, ip)
+
+
+def _check_captcha(captcha: Optional[str]) -> bool:
+    return requests.post("https://api.hcaptcha.com/siteverify", data={
+        "secret": os.getenv("CAPTCHA_SECRET"),
+        "response": captcha,
+    }).json()["success"]
+
+
+def authenticate_token(token: str, ip: str) -> dict:
+    # Make sure IP isn't blocked
+    if netblocks.is_blocked(ip):
+        raise AuthError("ipBlocked", 403)
+
+    # Get account
+    account = get_account_by_token(token)
+    if not account:
+        raise AuthError("Unauthorized", 401)
+
+    # Make sure account isn't banned
+    if account["ban"]["state"] == "perm_ban" or (account["ban"]["state"] == "temp_ban" and account["ban"]["expires"] > time.time()):
+        raise AuthError("accountBanned", 403)
+
+    # Return full account
+    return get_account(account["_id"], True)
+
+
+def get_relationships(username: str) -> list[dict]:
+    return blocks.get_graph(username)["relationships"]
+
+
 def update_settings(username, newdata):
     # Check datatype
     if not isinstance(username, str):
@@ -302,8 +689,11 @@ def update_settings(username, newdata):
     # Update database items
     if len(updated_user_vals) > 0:
         db.usersv0.update_one({"_id": account["_id"]}, {"$set": updated_user_vals})
+        invalidate_account(account["_id"])
     if len(updated_user_settings_vals) > 0:
         db.user_settings.update_one({"_id": account["_id"]}, {"$set": updated_user_settings_vals}, upsert=True)
+        if "hide_blocked_users" in updated_user_settings_vals:
+            blocks.invalidate_graph(account["_id"])
 
     return True
 
@@ -327,7 +717,38 @@ def has_permission(user_permissions, permission):
         return ((user_permissions & permission) == permission)
 
 
-def is_restricted(username, restriction):
+def get_ban(username: str) -> Optional[dict]:
+    # Get from cache
+    ban = ban_cache.get(username.lower())
+    if ban:
+        return ban
+
+    # Get from database and cache it
+    generation = ban_cache.generation()
+    account = db.usersv0.find_one({"lower_username": username.lower()}, projection={"ban.state": 1, "ban.restrictions": 1, "ban.expires": 1})
+    if not account or not account.get("ban"):
+        return None
+    ban_cache.set(username.lower(), account["ban"], generation=generation)
+
+    return account["ban"]
+
+
+def invalidate_ban(username: str):
+    """
+    Drop a user's cached ban state on all nodes.
+    Must be called whenever a user's ban state changes.
+    """
+
+    ban_cache.invalidate(username.lower())
+
+
+def is_restricted(username, restriction, ban: Optional[dict] = None):
+    """
+    Whether a user is restricted from a feature.
+    ban can be the user's ban state if it's already known, such as the one check_auth loaded for the request,
+    otherwise it's taken from the ban cache.
+    """
+
     # Check datatypes
     if not isinstance(username, str):
         log(f"Error on is_restricted: Expected str for username, got {type(username)}")
@@ -336,21 +757,22 @@ def is_restricted(username, restriction):
         log(f"Error on is_restricted: Expected int for username, got {type(restriction)}")
         return False
 
-    # Get account
-    account = db.usersv0.find_one({"lower_username": username.lower()}, projection={"ban.state": 1, "ban.restrictions": 1, "ban.expires": 1})
-    if not account:
-        return False
+    # Get ban state
+    if ban is None:
+        ban = get_ban(username)
+        if not ban:
+            return False
     
     # Check type
-    if account["ban"]["state"] == "none":
+    if ban["state"] == "none":
         return False
     
     # Check expiration
-    if "perm" not in account["ban"]["state"] and account["ban"]["expires"] < int(time.time()):
+    if "perm" not in ban["state"] and ban["expires"] < int(time.time()):
         return False
     
     # Return whether feature is restricted
-    return (account["ban"]["restrictions"] & restriction) == restriction
+    return (ban["restrictions"] & restriction) == restriction
 
 
 def delete_account(username, purge=False):
@@ -378,6 +800,11 @@ def delete_account(username, purge=False):
         "delete_after": None
     }})
 
+    # Revoke cached tokens, profile and ban state
+    invalidate_tokens(username)
+    invalidate_account(username)
+    invalidate_ban(username)
+
     # Delete authenticators
     db.authenticators.delete_many({"user": username})
 
@@ -396,17 +823,27 @@ def delete_account(username, purge=False):
     }})
 
     # Delete relationships
+    related_usernames = {username}
+    for relationship in db.relationships.find({"$or": [
+        {"_id.from": username},
+        {"_id.to": username}
+    ]}, projection={"_id": 1}):
+        related_usernames.update(relationship["_id"].values())
     db.relationships.delete_many({"$or": [
         {"_id.from": username},
         {"_id.to": username}
     ]})
+    blocks.invalidate_graph(*related_usernames)
 
     # Update or delete chats
+    chat_ids = []
     for chat in db.chats.find({
         "members": username
     }, projection={"type": 1, "owner": 1, "members": 1}):
+        chat_ids.append(chat["_id"])
         if chat["type"] == 1 or len(chat["members"]) == 1:
             db.posts.delete_many({"post_origin": chat["_id"], "isDeleted": False})
+            reset_post_counts(chat["_id"])
             db.chats.delete_one({"_id": chat["_id"]})
         else:
             if chat["owner"] == username:
@@ -416,9 +853,14 @@ def delete_account(username, purge=False):
                 "owner": chat["owner"],
                 "members": chat["members"]
             }})
+    if chat_ids:
+        chatinfo.invalidate_chat(*chat_ids)
 
     # Delete posts
+    origins = db.posts.distinct("post_origin", {"u": username})
     db.posts.delete_many({"u": username})
+    for origin in origins:
+        reset_post_counts(origin, username)
 
     # Purge user
     if purge:
@@ -427,124 +869,22 @@ def delete_account(username, purge=False):
         db.usersv0.delete_one({"_id": username})
 
 
-def get_netinfo(ip_address):
-    """
-    Get IP info from IP-API.
-
-    Returns:
-    ```json
-    {
-        "_id": str,
-        "country_code": str,
-        "country_name": str,
-        "asn": int,
-        "isp": str,
-        "vpn": bool
-    }
-    ```
-    """
-
-    # Get IP hash
-    ip_hash = sha256(ip_address.encode()).hexdigest()
-
-    # Get from database or IP-API if not cached
-    netinfo = db.netinfo.find_one({"_id": ip_hash})
-    if not netinfo:
-        resp = requests.get(f"http://ip-api.com/json/{ip_address}?fields=25349915")
-        if resp.ok and resp.json()["status"] == "success":
-            resp_json = resp.json()
-            netinfo = {
-                "_id": ip_hash,
-                "country_code": resp_json["countryCode"],
-                "country_name": resp_json["country"],
-                "region": resp_json["regionName"],
-                "city": resp_json["city"],
-                "timezone": resp_json["timezone"],
-                "currency": resp_json["currency"],
-                "as": resp_json["as"],
-                "isp": resp_json["isp"],
-                "vpn": (resp_json.get("hosting") or resp_json.get("proxy")),
-                "last_refreshed": int(time.time())
-            }
-            db.netinfo.update_one({"_id": ip_hash}, {"$set": netinfo}, upsert=True)
-        else:
-            netinfo = {
-                "_id": ip_hash,
-                "country_code": "Unknown",
-                "country_name": "Unknown",
-                "region": "Unknown",
-                "city": "Unknown",
-                "timezone": "Unknown",
-                "currency": "Unknown",
-                "as": "Unknown",
-                "isp": "Unknown",
-                "vpn": False,
-                "last_refreshed": int(time.time())
-            }
-
-    return netinfo
-
-
 def add_audit_log(action_type, mod_username, mod_ip, data):
-    db.audit_log.insert_one({
+    audit_log = {
         "_id": str(uuid.uuid4()),
         "type": action_type,
         "mod_username": mod_username,
         "mod_ip": mod_ip,
         "time": int(time.time()),
         "data": data
-    })
-
-
-def background_tasks_loop():
-    while True:
-        time.sleep(1800)  # Once every 30 minutes
-
-        log("Running background tasks...")
-
-        # Delete accounts scheduled for deletion
-        for user in db.usersv0.find({"delete_after": {"$lt": int(time.time())}}, projection={"_id": 1}):
-            try:
-                delete_account(user["_id"])
-            except Exception as e:
-                log(f"Failed to delete account {user['_id']}: {e}")
-
-        # Purge old netinfo
-        db.netinfo.delete_many({"last_refreshed": {"$lt": int(time.time())-2419200}})
-
-        # Purge old netlogs
-        db.netlog.delete_many({"last_used": {"$lt": int(time.time())-2419200}})
-
-        # Purge old deleted posts
-        db.posts.delete_many({"deleted_at": {"$lt": int(time.time())-2419200}})
-
-        # Purge old post revisions
-        db.post_revisions.delete_many({"time": {"$lt": int(time.time())-2419200}})
-
-        # Purge old admin audit logs
-        db.audit_log.delete_many({
-            "time": {"$lt": int(time.time())-2419200},
-            "type": {"$in": [
-                "got_reports",
-                "got_report",
-                "got_notes",
-                "got_users",
-                "got_user",
-                "got_user_posts",
-                "got_chat",
-                "got_netinfo",
-                "got_netblocks",
-                "got_netblock",
-                "got_announcements"
-            ]}
-        })
-
-        log("Finished background tasks!")
-
-
-def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds=BCRYPT_SALT_ROUNDS)).decode()
+    }
+    if action_type in EPHEMERAL_AUDIT_LOG_TYPES:
+        audit_log["expires_at"] = get_expiry()
+    db.audit_log.insert_one(audit_log)
 
 
-def check_password_hash(password: str, hashed_password: str) -> bool:
-    return bcrypt.checkpw(password.encode(), hashed_password.encode())
+async def _check_login_password(password: str, hashed_password: str) -> bool:
+    try:
+        return await passwords.check_password_async(password, hashed_password)
+    except passwords.PoolOverloaded:
+        raise AuthError("tooManyRequests", 429)
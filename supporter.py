@@ -1,9 +1,12 @@
 from threading import Thread
 from typing import Optional, Iterable, Any
-import uuid, time, msgpack, pymongo, re, copy
+import uuid, time, msgpack, pymongo, re
 
 from cloudlink import CloudlinkServer
-from database import db, rdb
+from database import db, rdb, get_expiry
+from cache import listen_for_invalidations
+from counters import incr_post_count
+import security, automod, chatinfo
 
 """
 Meower Supporter Module
@@ -26,6 +29,9 @@ class Supporter:
         # Start admin pub/sub listener
         Thread(target=self.listen_for_admin_pubsub, daemon=True).start()
 
+        # Start cache invalidation listener
+        Thread(target=listen_for_invalidations, daemon=True).start()
+
     def get_chats(self, username: str) -> list[dict[str, Any]]:
         # Get active DMs and favorited chats
         user_settings = db.user_settings.find_one({"_id": username}, projection={
@@ -42,8 +48,8 @@ class Supporter:
         if "favorited_chats" not in user_settings:
             user_settings["favorited_chats"] = []
 
-        # Get and return chats
-        return list(db.chats.find({"$or": [
+        # Get chats
+        chats = list(db.chats.find({"$or": [
             {  # DMs
                 "_id": {
                     "$in": user_settings["active_dms"] + user_settings["favorited_chats"]
@@ -58,6 +64,13 @@ class Supporter:
             }
         ]}))
 
+        # Add emotes
+        emotes = chatinfo.get_chats_emotes([chat["_id"] for chat in chats])
+        for chat in chats:
+            chat.update(emotes[chat["_id"]])
+
+        return chats
+
     def create_post(
         self,
         origin: str,
@@ -99,27 +112,30 @@ class Supporter:
         # Add database item
         if origin != "livechat":
             db.posts.insert_one(post)
-
-        # Send to files automod if there are attachments
-        if len(attachments):
-            rdb.publish("automod:files", msgpack.packb({
-                "type": 1,
-                "username": author,
-                "file_bucket": "attachments",
-                "file_hashes": [file["hash"] for file in db.files.find({"_id": {"$in": attachments}})],
-                "post_id": post_id,
-                "post_content": content
-            }))
+            incr_post_count(origin, author)
 
         # Add nonce for WebSocket
         if nonce:
             post["nonce"] = nonce
 
-        # Send live packet
+        # Send live packet and hydrate the post once for both the live packet and the caller
+        file_hashes = {}
         if origin == "inbox":
-            self.cl.send_event("inbox_message", copy.copy(post), usernames=(None if author == "Server" else [author]))
+            self.cl.send_event("inbox_message", post, usernames=(None if author == "Server" else [author]))
+            post = self.parse_posts_v0([post], file_hashes=file_hashes)[0]
         else:
-            self.cl.send_event("post", copy.copy(post), usernames=(None if origin in ["home", "livechat"] else chat_members))
+            post = self.parse_posts_v0([post], file_hashes=file_hashes)[0]
+            self.cl.send_event("post", post, usernames=(None if origin in ["home", "livechat"] else chat_members))
+
+        # Send to files automod if there are attachments
+        if len(attachments):
+            automod.submit_files(
+                automod.NEW_POST,
+                author,
+                post_id,
+                content,
+                file_hashes=[file_hashes[file_id] for file_id in attachments if file_hashes.get(file_id)]
+            )
 
         # Update other database items
         if origin == "inbox":
@@ -159,6 +175,9 @@ class Supporter:
 
                         # Set new ban state
                         db.usersv0.update_one({"_id": username}, {"$set": {"ban": ban_state}})
+                        security.invalidate_tokens(username)
+                        security.invalidate_account(username)
+                        security.invalidate_ban(username)
 
                         # Add note to admin notes
                         if "note" in msg:
@@ -171,24 +190,26 @@ class Supporter:
                                 "last_modified_at": int(time.time())
                             }}, upsert=True)
 
-                        # Logout user (can't kick because of async stuff)
-                        for c in self.cl.usernames.get(username, []):
-                            c.logout()
+                        # Logout user
+                        self.cl.logout_users([username])
                     case "delete_post":
                         # Get post
-                        post = db.posts.find_one({"_id": msg.pop("id")}, projection={"_id": 1, "post_origin": 1})
+                        post = db.posts.find_one({"_id": msg.pop("id")}, projection={"_id": 1, "post_origin": 1, "u": 1})
 
                         # Delete post
-                        db.posts.update_one(
-                            {"_id": post["_id"]},
+                        result = db.posts.update_one(
+                            {"_id": post["_id"], "isDeleted": False},
                             {
                                 "$set": {
                                     "isDeleted": True,
                                     "deleted_at": int(time.time()),
                                     "mod_deleted": True,
+                                    "expires_at": get_expiry(),
                                 }
                             },
                         )
+                        if result.modified_count:
+                            incr_post_count(post["post_origin"], post["u"], -1)
 
                         # Emit deletion
                         if post["post_origin"] == "home" or (post["post_origin"] == "inbox" and post["u"] == "Server"):
@@ -202,10 +223,7 @@ class Supporter:
                                 "post_id": post["_id"]
                             }, usernames=[post["u"]])
                         else:
-                            chat = db.chats.find_one({
-                                "_id": post["post_origin"],
-                                "deleted": False
-                            }, projection={"members": 1})
+                            chat = chatinfo.get_chat(post["post_origin"])
                             if chat:
                                 self.cl.send_event("delete_post", {
                                     "chat_id": post["post_origin"],
@@ -224,44 +242,70 @@ class Supporter:
         posts: Iterable[dict[str, Any]],
         requester: Optional[str] = None,
         include_replies: bool = True,
-        include_revisions: bool = False
+        include_revisions: bool = False,
+        file_hashes: Optional[dict[str, str]] = None
     ) -> Iterable[dict[str, Any]]:
+        """
+        Hydrate posts for the v0 API.
+        If file_hashes is given, it gets filled with {file_id: hash} for every attachment.
+        """
+
         posts = list(posts)
-        for post in posts:
-            if post is None:
-                continue
+        parsed_posts = [post for post in posts if post is not None]
+
+        # Replies (fetched for the whole page at once)
+        replies = {}
+        if include_replies:
+            reply_ids = {post_id for post in parsed_posts for post_id in post.get("reply_to", [])}
+            if reply_ids:
+                replies = {reply["_id"]: reply for reply in db.posts.find({
+                    "_id": {"$in": list(reply_ids)},
+                    "isDeleted": {"$ne": True}
+                })}
+            for post in parsed_posts:
+                post.update({"reply_to": [
+                    (replies[post_id] if post_id in replies and replies[post_id]["post_origin"] == post["post_origin"] else None)
+                    for post_id in post.pop("reply_to", [])
+                ]})
+            for reply in replies.values():
+                reply.update({"reply_to": [None for _ in reply.pop("reply_to", [])]})
+        else:
+            for post in parsed_posts:
+                post.update({"reply_to": [None for _ in post.pop("reply_to", [])]})
 
-            # Stupid legacy stuff
+        # Everything below is hydrated for both the posts and their replies
+        hydrated_posts = parsed_posts + list(replies.values())
+        if not hydrated_posts:
+            return posts
+
+        # Stupid legacy stuff (and the TTL field of deleted posts)
+        for post in hydrated_posts:
+            post.pop("expires_at", None)
             post.update({
                 "type": 2 if post["post_origin"] == "inbox" else 1,
                 "post_id": post["_id"]
             })
 
-            # Author
-            post.update({"author": db.usersv0.find_one({"_id": post["u"]}, projection={
-                "_id": 1,
-                "uuid": 1,
-                "flags": 1,
-                "pfp_data": 1,
-                "avatar": 1,
-                "avatar_color": 1
-            })})
-
-            # Replies
-            if include_replies:
-                post.update({"reply_to": [
-                    self.parse_posts_v0([db.posts.find_one({
-                        "_id": post_id,
-                        "post_origin": post["post_origin"],
-                        "isDeleted": {"$ne": True}
-                    })], include_replies=False, requester=requester)[0] for post_id in post.pop("reply_to", [])
-                ]})
-            else:
-                post.update({"reply_to": [None for _ in post.pop("reply_to", [])]})
-
-            # Attachments
-            post["attachments"] = list(db.files.aggregate([
-                {"$match": {"_id": {"$in": post["attachments"]}}},
+        # Authors
+        authors = {author["_id"]: author for author in db.usersv0.find({
+            "_id": {"$in": list({post["u"] for post in hydrated_posts})}
+        }, projection={
+            "_id": 1,
+            "uuid": 1,
+            "flags": 1,
+            "pfp_data": 1,
+            "avatar": 1,
+            "avatar_color": 1
+        })}
+        for post in hydrated_posts:
+            post.update({"author": authors.get(post["u"])})
+
+        # Attachments
+        attachment_ids = {attachment_id for post in hydrated_posts for attachment_id in post["attachments"]}
+        attachments = {}
+        if attachment_ids:
+            attachments = {attachment["id"]: attachment for attachment in db.files.aggregate([
+                {"$match": {"_id": {"$in": list(attachment_ids)}}},
                 {"$project": {
                     "id": "$_id",
                     "_id": 0,
@@ -271,38 +315,75 @@ class Supporter:
                     "thumbnail_size": 1,
                     "filename": 1,
                     "width": 1,
-                    "height": 1
+                    "height": 1,
+                    "hash": 1
                 }}
-            ]))
+            ])}
+            for attachment in attachments.values():
+                file_hash = attachment.pop("hash", None)
+                if file_hashes is not None:
+                    file_hashes[attachment["id"]] = file_hash
+        for post in hydrated_posts:
+            post["attachments"] = [
+                attachments[attachment_id]
+                for attachment_id in post["attachments"]
+                if attachment_id in attachments
+            ]
+
+        # Custom emojis and stickers
+        for key, collection in [("emojis", db.chat_emojis), ("stickers", db.chat_stickers)]:
+            emote_ids = {emote_id for post in hydrated_posts for emote_id in (post.get(key) or [])}
+            if not emote_ids:
+                continue
+            emotes = {emote["_id"]: emote for emote in collection.find({
+                "_id": {"$in": list(emote_ids)}
+            }, projection={"created_at": 0, "created_by": 0})}
+            for post in hydrated_posts:
+                if post.get(key):
+                    post[key] = [emotes[emote_id] for emote_id in post[key] if emote_id in emotes]
+
+        # Reactions
+        self.add_user_reactions(parsed_posts, requester)
+
+        # Revisions
+        if include_revisions and parsed_posts:
+            revisions = {}
+            for revision in db.post_revisions.find(
+                {"post_id": {"$in": [post["_id"] for post in parsed_posts]}},
+                sort=[("time", pymongo.DESCENDING)]
+            ):
+                revisions.setdefault(revision["post_id"], []).append(revision)
+            for post in parsed_posts:
+                post.update({"revisions": revisions.get(post["_id"], [])})
 
-            # Custom emojis
-            if post.get("emojis"):
-                post["emojis"] = list(db.chat_emojis.find({
-                    "_id": {"$in": post.get("emojis", [])}
-                }, projection={"created_at": 0, "created_by": 0}))
+        return posts
 
-            # Stickers
-            if post.get("stickers"):
-                post["stickers"] = list(db.chat_stickers.find({
-                    "_id": {"$in": post.get("stickers", [])}
-                }, projection={"created_at": 0, "created_by": 0}))
+    def add_user_reactions(self, posts: Iterable[dict[str, Any]], requester: Optional[str] = None):
+        """
+        Set user_reacted on every reaction of parsed posts (and their replies) for the requester.
+        """
 
-            # Reactions
+        # Get posts and replies
+        hydrated_posts = []
+        for post in posts:
+            hydrated_posts.append(post)
+            hydrated_posts += [reply for reply in post.get("reply_to", []) if isinstance(reply, dict)]
+
+        # Get requester's reactions (one query for the whole page, using the user_reactions index)
+        user_reactions = set()
+        if requester:
+            post_ids = list({post["_id"] for post in hydrated_posts if post.get("reactions")})
+            if post_ids:
+                user_reactions = {
+                    (reaction["_id"]["post_id"], reaction["_id"]["emoji"])
+                    for reaction in db.post_reactions.find({
+                        "_id.user": requester,
+                        "_id.post_id": {"$in": post_ids}
+                    }, projection={"_id": 1})
+                }
+
+        # Set user_reacted
+        for post in hydrated_posts:
             [reaction.update({
-                "user_reacted": (db.post_reactions.count_documents({"_id": {
-                    "post_id": post["_id"],
-                    "emoji": reaction["emoji"],
-                    "user": requester
-                }}, limit=1) > 0) if requester else False
+                "user_reacted": (post["_id"], reaction["emoji"]) in user_reactions
             }) for reaction in post.get("reactions", [])]
-
-            # Revisions
-            if include_revisions:
-                post.update({
-                    "revisions": list(db.post_revisions.find(
-                        {"post_id": post["_id"]},
-                        sort=[("time", pymongo.DESCENDING)]
-                    ))
-                })
-
-        return posts
@@ -0,0 +1,67 @@
+from datetime import datetime, timezone
+import time
+
+from database import db
+from scheduler import Scheduler, TASK_BATCH_SIZE, delete_in_batches
+from counters import (
+    RECONCILE_INTERVAL,
+    REACTION_FLUSH_INTERVAL,
+    REACTION_RECONCILE_INTERVAL,
+    reconcile_post_counts,
+    flush_reaction_counts,
+    reconcile_dirty_reaction_counts
+)
+from utils import log
+import security
+
+"""
+Meower Tasks Module
+This module provides the background tasks that delete scheduled accounts, purge expired deleted posts
+and keep post and reaction counters in sync.
+Netinfo, netlogs, post revisions and ephemeral audit logs expire through TTL indexes instead.
+"""
+
+scheduler = Scheduler()
+
+
+@scheduler.task("delete_scheduled_accounts", 1800)
+def delete_scheduled_accounts():
+    deleted = 0
+    for user in db.usersv0.find(
+        {"delete_after": {"$lt": int(time.time())}},
+        projection={"_id": 1},
+        limit=TASK_BATCH_SIZE
+    ):
+        try:
+            security.delete_account(user["_id"])
+            deleted += 1
+        except Exception as e:
+            log(f"Failed to delete account {user['_id']}: {e}")
+    return {"deleted": deleted}
+
+
+# Deleted posts don't use a TTL index, since their reactions have to be deleted with them
+@scheduler.task("purge_deleted_posts", 1800)
+def purge_deleted_posts():
+    return {"deleted": delete_in_batches(
+        "posts",
+        {"isDeleted": True, "expires_at": {"$lt": datetime.now(timezone.utc)}},
+        on_batch=lambda post_ids: db.post_reactions.delete_many({"_id.post_id": {"$in": post_ids}})
+    )}
+
+
+@scheduler.task("reconcile_post_counts", RECONCILE_INTERVAL)
+def reconcile_post_counts_task():
+    return {"reconciled": reconcile_post_counts()}
+
+
+# Reaction deltas and reacted to posts are tracked in each node's memory, so every node runs these
+@scheduler.task("flush_reaction_counts", REACTION_FLUSH_INTERVAL, per_node=True)
+def flush_reaction_counts_task():
+    return {"flushed": flush_reaction_counts()}
+
+
+@scheduler.task("reconcile_reaction_counts", REACTION_RECONCILE_INTERVAL, per_node=True)
+def reconcile_reaction_counts_task():
+    return {"reconciled": reconcile_dirty_reaction_counts()}
+
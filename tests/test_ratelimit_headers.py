@@ -0,0 +1,58 @@
+from types import SimpleNamespace
+import asyncio
+
+import pytest
+
+pytest.importorskip("quart")
+
+import ratelimits, security
+from rest_api import app
+
+
+def _ratelimit(bucket_id: str, limit: int, seconds: int, limited: bool = False) -> ratelimits.Ratelimit:
+    return {
+        "bucket": bucket_id,
+        "limited": limited,
+        "limit": limit,
+        "remaining": 0 if limited else limit-1,
+        "reset": seconds
+    }
+
+
+def _login(username: str = "test", password: str = "password"):
+    async def request():
+        return await app.test_client().post("/auth/login", json={"username": username, "password": password})
+    return asyncio.run(request())
+
+
+@pytest.fixture(autouse=True)
+def supporter(monkeypatch):
+    monkeypatch.setattr(app, "supporter", SimpleNamespace(repair_mode=False), raising=False)
+
+
+def test_headers_sent_when_ratelimited(monkeypatch):
+    monkeypatch.setattr(ratelimits, "hit", lambda bucket_id, limit, seconds, **_: _ratelimit(bucket_id, limit, seconds, limited=True))
+
+    response = _login()
+
+    assert response.status_code == 429
+    assert response.headers["X-RateLimit-Limit"] == "50"
+    assert response.headers["X-RateLimit-Remaining"] == "0"
+    assert response.headers["X-RateLimit-Reset"] == "900"
+    assert response.headers["Retry-After"] == "900"
+
+
+def test_headers_sent_when_not_ratelimited(monkeypatch):
+    def get_login_account(username: str):
+        raise security.AuthError("Unauthorized", 401)
+
+    monkeypatch.setattr(ratelimits, "hit", lambda bucket_id, limit, seconds, **_: _ratelimit(bucket_id, limit, seconds))
+    monkeypatch.setattr(ratelimits, "peek", lambda bucket_id: None)
+    monkeypatch.setattr(security, "_get_login_account", get_login_account)
+
+    response = _login()
+
+    assert response.status_code == 401
+    assert response.headers["X-RateLimit-Limit"] == "50"
+    assert response.headers["X-RateLimit-Remaining"] == "49"
+    assert "Retry-After" not in response.headers